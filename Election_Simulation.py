@@ -21,15 +21,23 @@ import random
 import json
 import os.path
 import sys
-from math import log, ceil 
+from math import log, ceil, sqrt
 import csv
 from adaptive_backend import *
+from round_planner import *
+from phase_timers import *
+from sweep_progress import *
+from rng_streams import *
+from comparison_traces import TailTraces
+from variance_reduction import ElectionControls
 
 
 class Ballot(object):
     '''
     Summary: Ballot object containing values necessary to conduct an audit
     '''
+    __slots__ = ('number', 'error', 'vote', 'batch', 'town') #an election holds one per ballot; no per-object dict
+
     def __init__(self, id = None):
         self.number = id  
         self.error = "normal" #normal, undervote1, undervote2, overvote1, overvote2 for no error, 1/2-vote understatements, 1/2-vote overstatments
@@ -39,7 +47,7 @@ class Ballot(object):
         
         
 class Election(object):
-    def __init__(self, numBallots, margin, o1, u1, o2, u2, riskLimit = 0.05, gamma = 1.1, simulationType = 1, jsonFile = None):
+    def __init__(self, numBallots, margin, o1, u1, o2, u2, riskLimit = 0.05, gamma = 1.1, simulationType = 1, jsonFile = None, roundTarget = None, rng = None):
         self.numBallots = numBallots
         self.margin = margin
         self.overvotes1 = o1
@@ -49,6 +57,8 @@ class Election(object):
         self.riskLimit = riskLimit 
         self.gamma = gamma
         self.simulationType = simulationType
+        self.roundTarget = roundTarget #Probability of stopping each round is sized for when doing rounds; None for the ASN/Kaplan-Markov sizes
+        self.randomStream = None if rng is None else randomSource(rng) #Seeded stream (numpy Generator) the simulation draws from; None for the global random module
             
         self.winnerBallots = self.runnerupBallots = 0 #Number of ballots the winner/runnerup receives; set with _marginOfVictory
         self.ballotList = {} #ID: ballot object; set with _distributeBallots
@@ -84,6 +94,11 @@ class Election(object):
                 self.tabulatorBatch[town].append(0)
                 self.batchMaxSize[town].append(absentee)
             self.staticBatchSize = self.batchMaxSize #Total number of voters in a precinct; also static
+
+    @property
+    def random(self):
+        #What the simulation draws from: the seeded stream, or the global random module when the election has none
+        return random if self.randomStream is None else self.randomStream
         
     def _marginOfVictory(self):
         '''
@@ -102,6 +117,7 @@ class Election(object):
         self.winnerBallots = round(1/2 * (ballots + ballotsInMargin))
         self.runnerupBallots = round(1/2 * (ballots - ballotsInMargin))
            
+    @timed('_distributeBallots')
     def _distributeBallots(self):
         '''
         Summary: Randomly distributes the ballots by ID between overstatements, understatements, winner, and runner-up
@@ -144,8 +160,7 @@ class Election(object):
                 undervote2Counter -= 1
             ballots.append(b)
         #Shuffles the list of ballots for "randomness"
-        #TO DO: seed randomness
-        random.shuffle(ballots)
+        self.random.shuffle(ballots)
         #Assigns ballot IDs to the now shuffled-order of ballots and adds to ballotList dict
         i = 0
         for ballot in ballots:
@@ -163,19 +178,17 @@ class Election(object):
         Returns: The town and batch a ballot belongs to
         '''
         #Selects random town then updates the distribution
-        #TO DO: seed randomness
         batchID = None
-        ballotTown = random.choices(self.townList, weights = self.townPopulation, k = 1)
+        ballotTown = self.random.choices(self.townList, weights = self.townPopulation, k = 1)
         ballotTown = ballotTown[0]
         townIndex = self.townList.index(ballotTown)
         self.townPopulation[townIndex] -= 1
         if (auditID == "Comparison"):
             while 1:
                 numBatches = self.batchMaxSize[ballotTown][0] #Finds the number of batches in the town
-                #TO DO: seed randomness
                 #Issue with seed randomness - what if the batch gets full? Not sure how to implement in a way to prevent that
                 #Possible solution: make a list of Batch IDs and use random to find index? Then remove Batch ID from list when full
-                batchID = random.randint(0, numBatches - 1) #Selects a random batch
+                batchID = self.random.randint(0, numBatches - 1) #Selects a random batch
                 if (self.batchMaxSize[ballotTown][batchID + 1] > 0): #Checks that the random batch isn't full already
                     self.batchMaxSize[ballotTown][batchID + 1] -= 1 #Adjusts the remaining ballots that can be added to the batch
                     self.tabulatorBatch[ballotTown][batchID] += 1 #Adds one ballot to that batch
@@ -255,8 +268,7 @@ class Election(object):
         while 1:
             numToAudit += 1
             #Sampling with replacement, then add the pulled ballot to the list of ballots for ballot polling
-            #TO DO: seed randomness
-            pullID = random.randint(0, self.numBallots - 1)
+            pullID = self.random.randint(0, self.numBallots - 1)
             randomBallot = self.ballotList[pullID]
             self.ballotPolling.append(randomBallot)
             #Checks that ballot isn't an understatement or overstatement; then check the vote and adjust T accordingly
@@ -281,7 +293,11 @@ class Election(object):
                     if (roundCounter > 10):
                         raise RuntimeError("Excessive Number of Rounds. Please run the simulation with less discrepancies.")
                     numToAudit = 0
-                    if (winnerCounter >= runnerupCounter):
+                    if (winnerCounter >= runnerupCounter and self.roundTarget is not None):
+                        #smallest round with roundTarget probability of stopping, given the reported results and T so far
+                        maxBallots = pollingRoundSize(self.winnerBallots/self.numBallots, self.runnerupBallots/self.numBallots, self.riskLimit,
+                                                      log(T) if T > 0 else -float('inf'), self.roundTarget, self.numBallots)
+                    elif (winnerCounter >= runnerupCounter):
                         #Note: using cumulative results from previous rounds
                         #TO DO: Verify if correct method
                         maxBallots = self._pollingSample(prvRound, winnerCounter, runnerupCounter)
@@ -347,6 +363,8 @@ class Election(object):
         if (maxBallots == -1):
             maxBallots = self.numBallots
         dilutedMargin = (self.winnerBallots - self.runnerupBallots)/self.numBallots
+        self.dilutedMargin = dilutedMargin #kept with the draws in ballotComparison for comparison_traces
+        self.comparisonRounds = [] #size of every round that ended without meeting the risk limit
         alpha = self.riskLimit
         numToAudit = 0
         observedrisk = 1
@@ -362,8 +380,7 @@ class Election(object):
         while 1:
             numToAudit += 1
             #Sampling with replacement, then add the pulled ballot to the list of ballots for ballot comparison
-            #TO DO: seed randomness
-            pullID = random.randint(0, self.numBallots - 1)
+            pullID = self.random.randint(0, self.numBallots - 1)
             randomBallot = self.ballotList[pullID]
             self.ballotComparison.append(randomBallot)
             #Determines if one- or two-vote over/understatement, then updates the discrepancy counter
@@ -393,15 +410,22 @@ class Election(object):
                 else:
                     prvRound += numToAudit
                     roundCounter += 1
+                    self.comparisonRounds.append(numToAudit)
                     if (roundCounter > 10):
                         raise RuntimeError("Excessive Number of Rounds. Please run the simulation with less discrepancies.")
-                    maxBallots = self._comparisonSample(o1Counter, o2Counter, u1Counter, u2Counter, numToAudit)
+                    if (self.roundTarget is not None):
+                        #smallest round with roundTarget probability of stopping at the overstatement rates seen in this round
+                        maxBallots = comparisonRoundSize(dilutedMargin, o1Counter/numToAudit, o2Counter/numToAudit, alpha, gamma, log(observedrisk),
+                                                         self.roundTarget, self.numBallots)
+                    else:
+                        maxBallots = self._comparisonSample(o1Counter, o2Counter, u1Counter, u2Counter, numToAudit)
                     print("Risk limit was not met for ballot comparison audit, starting new round. New sample size =", maxBallots)
                     numToAudit, o1Counter, o2Counter, u1Counter, u2Counter = 0, 0, 0, 0, 0
             elif (observedrisk < alpha and numToAudit >= minBallots and self.simulationType == 1):
                 successTracker = 100
                 return numToAudit + prvRound, successTracker
             
+    @timed('_ballotsPerTown')
     def _ballotsPerTown(self):
         '''
         Summary: Iterates through the list of ballots for each method and calls _setTownAndBatch for every ballot that does not yet have a town
@@ -524,28 +548,97 @@ def dataToValues(simulationData):
     gamma = float(simulationData[7])
     return numBallots, overvotes1, undervotes1, overvotes2, undervotes2, riskLimit, num, gamma
 
+class RunningStatistics(object):
+    '''
+    Summary: Stands in for the list of whole numbers statisticsData averages, keeping only their count, sum and sum of squares;
+    the mean and (population) variance are exact, so statisticsData gives the same figures as it would for the list
+    '''
+    __slots__ = ('n', 'total', 'squares')
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0
+        self.squares = 0
+
+    def append(self, value):
+        value = int(value)
+        self.n += 1
+        self.total += value
+        self.squares += value*value
+
+    def __len__(self):
+        return self.n
+
+    def mean(self):
+        return np.float64(self.total/self.n) if self.n else np.float64(np.nan)
+
+    def variance(self):
+        return np.float64((self.n*self.squares - self.total*self.total)/(self.n*self.n)) if self.n else np.float64(np.nan)
+
 def statisticsData(dataList):
+    if isinstance(dataList, RunningStatistics):
+        variance = dataList.variance()
+        return round(dataList.mean(), 2), round(np.sqrt(variance), 2), round(variance, 2)
     mean = round(np.mean(dataList), 2)
     stdev = round(np.std(dataList), 2)
     variance = round(np.var(dataList), 2)
     return mean, stdev, variance
 
-def collectData(jsonFile, simulationData, margins, flag = 0, simulationType = 2):
+def trialElection(jsonFile, simulationData, margin, seed, run, trial, simulationType = 2, roundTarget = None):
+    '''
+    Summary: Rebuilds the Election of one collectData trial run with a seed, for replaying it: calling _marginOfVictory,
+    _distributeBallots, then the audits the way collectData does draws exactly what that trial drew
+    Parameters: Data from readInput() function, margin, seed given to collectData, index of the margin in margins, trial number (from 1)
+    Returns: Election object
+    '''
+    numBallots, overvotes1, undervotes1, overvotes2, undervotes2, riskLimit, num, gamma = dataToValues(simulationData)
+    return Election(numBallots, margin, overvotes1, undervotes1, overvotes2, undervotes2, riskLimit, gamma, simulationType, jsonFile, roundTarget,
+                    childGenerator(seed, run, trial))
+
+def collectData(jsonFile, simulationData, margins, flag = 0, simulationType = 2, roundTarget = None, profile = None, max_memory = False, progress = None, seed = None,
+                trace_quantile = 0.99, control_variates = False):
     '''
     Summary: Runs the simulation num number of times and averages the data. Records all data in one file: 
     Adaptive_CVR_Data.csv - includes number of ballots pulled, ballots per town, number of precincts flagged for audit, etc.
     Variables contain C if they track data for comparison audits, and P if they track data for polling audits
     Flag parameter set to 0 by default to only conduct a ballot comparison audit; other options is 1 to conduct both polling and comparison audit
     Type 1 for incremental ballot audit, type 2 for rounds
+    roundTarget (e.g. 0.9) sizes every round for that probability of meeting the risk limit, instead of the ASN/Kaplan-Markov estimates
+    profile: JSON file to write per-phase times and counters to (also switched on by the RLA_PROFILE environment variable)
+    max_memory: keep memory flat in the number of trials: every trial is written to Adaptive_CVR_Trials.csv as it finishes, only
+    running sums are kept for the averages, and each election is released before the next one is built
+    progress: seconds between progress reports on stderr, one cell per margin (also switched on by the RLA_PROGRESS environment variable)
+    seed: draw every trial from its own stream, childGenerator(seed, margin index, trial number), instead of the global random
+    module; the seed is written to the CSV header, and trialElection rebuilds any one trial for replaying it
+    trace_quantile: write traces of the comparison audits with sample sizes above this quantile in each margin, and of any that
+    raises, to Adaptive_CVR_Traces.bin (see comparison_traces; None for no traces, 0 for every trial)
+    control_variates: also estimate the mean number of comparison ballots with the discrepancy counts of every audit as control
+    variates (see variance_reduction), and write the adjusted mean and its standard error under each margin
     Parameters: Data from readInput() function
     '''
+    if profile is not None:
+        enableProfiling(profile)
     #Simulation Data from readInput()
     numBallots, overvotes1, undervotes1, overvotes2, undervotes2, riskLimit, num, gamma = dataToValues(simulationData)
+    ownProgress = progress is not None and not progressEnabled()
+    if ownProgress:
+        startProgress(len(margins), num, progress)
+    else:
+        planProgress(len(margins), num)
 
     #Create CSV file and write header
     simulation = open('Adaptive_CVR_Data.csv', mode = 'w', newline='')
     simulation_writer = csv.writer(simulation)
-    simulation_writer.writerow(["Number of ballots", numBallots, "Overvotes", overvotes1 + overvotes2, "Undervotes", undervotes1 + undervotes2, "Number of Simulations", num, "Risk Limit", riskLimit])
+    simulation_writer.writerow(["Number of ballots", numBallots, "Overvotes", overvotes1 + overvotes2, "Undervotes", undervotes1 + undervotes2, "Number of Simulations", num, "Risk Limit", riskLimit]
+                               + (["Seed", seedEntropy(seed)] if seed is not None else []))
+    if max_memory:
+        trials = open('Adaptive_CVR_Trials.csv', mode = 'w', newline='')
+        trials_writer = csv.writer(trials)
+        trials_writer.writerow(["Margin of Victory", "Trial", "Polling Ballots", "Polling Success", "Comparison Ballots", "Comparison Success", "Polling Non-Zero Towns", "Comparison Non-Zero Towns"])
+    #Lists of per-trial values, or running sums of them in max_memory mode
+    trialValues = RunningStatistics if max_memory else list
+    if trace_quantile is not None:
+        open('Adaptive_CVR_Traces.bin', mode = 'wb').close()
 
     #Run the simulation for each margin
     for run in range(0, len(margins)):
@@ -553,12 +646,18 @@ def collectData(jsonFile, simulationData, margins, flag = 0, simulationType = 2)
         townC, townClist, townCdata = {}, {}, {} #Comparison data: ballots per town, collection of townC (to average), average data per town
         #Fill in dictionaries with town names
         for town in jsonFile:
-            townPlist[town["Town"]], townClist[town["Town"]], townPdata[town["Town"]], townCdata[town["Town"]] = [], [], [], []
-        tabulatorSize, tabulatorAverage = {}, {} #Tabulator batches audited for Lazy CVR, average tabulated batch data per town
-        tabulatorList = [] #List of tabulatorSize
-        numPolling, numComparison, countPtown, countCtown = [], [], [], [] #List of ballot polling/comparison numbers, non-zero towns for polling/comparison
+            townPlist[town["Town"]], townClist[town["Town"]], townPdata[town["Town"]], townCdata[town["Town"]] = trialValues(), trialValues(), [], []
+        tabulatorSize, tabulatorAverage = {}, {} #Tabulator batches audited for Lazy CVR, tabulated batch data per town summed over the trials
+        for town in townPlist:
+            tabulatorAverage[town] = [0, 0]
+        numPolling, numComparison, countPtown, countCtown = trialValues(), trialValues(), trialValues(), trialValues() #Ballot polling/comparison numbers, non-zero towns for polling/comparison
         observedCSuccess = observedPSuccess = 0 #Times the risk limit was met
         margin = margins[run][0]
+        traces = None
+        if trace_quantile is not None:
+            traces = TailTraces('Adaptive_CVR_Traces.bin', num, trace_quantile, {'margin': margin, 'run': run, 'overvotes1': overvotes1, 'undervotes1': undervotes1,
+                                'overvotes2': overvotes2, 'undervotes2': undervotes2, 'roundTarget': roundTarget, 'seed': None if seed is None else seedEntropy(seed)})
+        controls = None #ElectionControls of the margin, with control_variates
         #minBallots = margins[run][1]
         #maxBallots = margins[run][2]
         
@@ -570,26 +669,47 @@ def collectData(jsonFile, simulationData, margins, flag = 0, simulationType = 2)
         for i in range(1, num + 1):
             print("Running Simulation #", i, "for", margin, "%")
             townPcount = townCcount = 0 #Tracks the number of towns with a ballot pulled from it
-            E1 = Election(numBallots, margin, overvotes1, undervotes1, overvotes2, undervotes2, riskLimit, gamma, simulationType, jsonFile) 
-            #Distribute ballots between winner and runnerup
-            E1._marginOfVictory() 
+            with phase('election build'):
+                E1 = Election(numBallots, margin, overvotes1, undervotes1, overvotes2, undervotes2, riskLimit, gamma, simulationType, jsonFile, roundTarget,
+                              None if seed is None else childGenerator(seed, run, i))
+                #Distribute ballots between winner and runnerup
+                E1._marginOfVictory() 
             E1._distributeBallots()
+            count('trials')
             #Set up initial sample if done in rounds
-            if (simulationType == 2):
+            if (simulationType == 2 and roundTarget is not None):
+                initialCSample = comparisonRoundSize(E1.margin/100, overvotes1/numBallots, overvotes2/numBallots, riskLimit, gamma, 0.0, roundTarget, numBallots)
+                initialPSample = pollingRoundSize(E1.winnerBallots/numBallots, E1.runnerupBallots/numBallots, riskLimit, 0.0, roundTarget, numBallots)
+            elif (simulationType == 2):
                 initialCSample = E1._comparisonSample()
                 initialPSample = E1._pollingSample() 
             #Run ballot polling audit
+            pBallots = pSuccess = 0
             if (flag == 1):
-                ballots, success = E1._ballotPolling(initialPSample)
-                numPolling.append(ballots)
-                observedPSuccess += success
-            else:
-                numPolling.append(0)
+                with phase('sampling: ballot polling'):
+                    pBallots, pSuccess = E1._ballotPolling(initialPSample)
+                count('sampling loop iterations: ballot polling', pBallots)
+                observedPSuccess += pSuccess
+            numPolling.append(pBallots)
             #Run ballot comparison audit
-            ballots, success = E1._ballotComparison()
+            with phase('sampling: ballot comparison'):
+                try:
+                    ballots, success = E1._ballotComparison()
+                except RuntimeError as error:
+                    if traces is not None:
+                        traces.failed(E1, (run, i), error)
+                    raise
+            count('sampling loop iterations: ballot comparison', ballots)
+            progressTrial(pBallots + ballots)
+            if traces is not None:
+                traces.offer(E1, (run, i), ballots, success)
+            if control_variates:
+                if controls is None:
+                    controls = ElectionControls(E1)
+                controls.add(E1, ballots)
             numComparison.append(ballots)
             observedCSuccess += success
-            #Get the number of ballots and batches per town and record it into townPlist, townClist, and tabulatorList
+            #Get the number of ballots and batches per town and record it into townPlist, townClist, and tabulatorAverage
             townP, townC, tabulatorSize = E1._ballotsPerTown()
             for town in townP:
                 townPlist[town].append(townP[town])
@@ -600,18 +720,23 @@ def collectData(jsonFile, simulationData, margins, flag = 0, simulationType = 2)
                     townCcount += 1
             countPtown.append(townPcount)
             countCtown.append(townCcount)
-            tabulatorList.append(tabulatorSize)
+            for town in tabulatorSize:
+                tabulatorAverage[town][0] += tabulatorSize[town][0]
+                tabulatorAverage[town][1] += tabulatorSize[town][1]
+            if max_memory:
+                trials_writer.writerow([margin, i, pBallots, pSuccess, ballots, success, townPcount, townCcount])
+                #drop the election (its ballot lists) before the next one is built
+                del E1, townP, townC, tabulatorSize
         
         #Averages the simulations and calculates stdev and variance
         pollingMean, pollingStdev, pollingVariance = statisticsData(numPolling)
-        pollingTownCount = round(np.mean(countPtown), 2)
+        pollingTownCount = statisticsData(countPtown)[0]
         pollingSuccess = round(observedPSuccess/num, 2)
         comparisonMean, comparisonStdev, comparisonVariance = statisticsData(numComparison)
-        comparisonTownCount = round(np.mean(countCtown), 2)
+        comparisonTownCount = statisticsData(countCtown)[0]
         comparisonSuccess = round(observedCSuccess/num, 2)
         #Gets mean, stdev, and variance per town and stores it in a list; 0: Average ballots, 1: standard deviation, 2: variance
         for town in townPlist:
-            tabulatorAverage[town] = [0, 0] #Initialize tabulator average per town
             townMean, townStdev, townVariance = statisticsData(townPlist[town])
             townPdata[town] = [townMean, townStdev, townVariance]
             townMean, townStdev, townVariance = statisticsData(townClist[town])
@@ -620,40 +745,54 @@ def collectData(jsonFile, simulationData, margins, flag = 0, simulationType = 2)
         #Lazy CVR data
         flagForCVR = {} #town: [number of precincts flagged, population for CVR]
         #Organizes data into flagForCVR
-        for dct in tabulatorList:
-            for town in dct:
-                tabulatorAverage[town][0] += dct[town][0]
-                tabulatorAverage[town][1] += dct[town][1]
         for town in tabulatorAverage:
             flagForCVR[town] = [0, 0]
             flagForCVR[town][0] = round(tabulatorAverage[town][0]/num, 2)
             flagForCVR[town][1] = round(tabulatorAverage[town][1]/num, 2)
             
         #Write data to CSV
-        if (flag == 1):
-            simulation_writer.writerow([''])
-            simulation_writer.writerow(["Margin of Victory", margin])
-            simulation_writer.writerow(['', "Ballot Comparison", '', '', '', '', '', '', '', '', "Ballot Polling"])
-            simulation_writer.writerow(['', "Number of Ballots", "Stdev", "Variance", "Risk Limit Success", "Average Non-Zero Towns", '', '', '', '', "Number of Ballots", "Stdev", "Variance", "Risk Limit Success", "Average Non-Zero Towns"])
-            simulation_writer.writerow(['', comparisonMean, comparisonStdev, comparisonVariance, str(comparisonSuccess) + "%", comparisonTownCount, '', '', '', '', pollingMean, pollingStdev, pollingVariance, str(pollingSuccess) + "%", pollingTownCount])
-            simulation_writer.writerow(["Per Town:", '', '', '', "Precincts Flagged to Audit", "Population of Flagged Precincts", '', '', '', "Per Town:"])
-            #Per town data
-            for town in townPdata:
-                simulation_writer.writerow([town, townCdata[town][0], townCdata[town][1], townCdata[town][2], flagForCVR[town][0], flagForCVR[town][1], '', '', '', town, townPdata[town][0], townPdata[town][1], townPdata[town][2]])
-        #Exclude polling data if flag = 0
-        if (flag == 0):
-            simulation_writer.writerow([''])
-            simulation_writer.writerow(["Margin of Victory", margin])
-            simulation_writer.writerow(['', "Ballot Comparison"])
-            simulation_writer.writerow(['', "Number of Ballots", "Stdev", "Variance", "Risk Limit Success", "Average Non-Zero Towns"])
-            simulation_writer.writerow(['', comparisonMean, comparisonStdev, comparisonVariance, str(comparisonSuccess) + "%", comparisonTownCount])
-            simulation_writer.writerow(["Per Town:", '', '', '', "Precincts Flagged to Audit", "Population of Flagged Precincts"])
-            #Per town data
-            for town in townPdata:
-                simulation_writer.writerow([town, townCdata[town][0], townCdata[town][1], townCdata[town][2], flagForCVR[town][0], flagForCVR[town][1]])
+        with phase('CSV writing: simulation data'):
+            if (flag == 1):
+                simulation_writer.writerow([''])
+                simulation_writer.writerow(["Margin of Victory", margin])
+                simulation_writer.writerow(['', "Ballot Comparison", '', '', '', '', '', '', '', '', "Ballot Polling"])
+                simulation_writer.writerow(['', "Number of Ballots", "Stdev", "Variance", "Risk Limit Success", "Average Non-Zero Towns", '', '', '', '', "Number of Ballots", "Stdev", "Variance", "Risk Limit Success", "Average Non-Zero Towns"])
+                simulation_writer.writerow(['', comparisonMean, comparisonStdev, comparisonVariance, str(comparisonSuccess) + "%", comparisonTownCount, '', '', '', '', pollingMean, pollingStdev, pollingVariance, str(pollingSuccess) + "%", pollingTownCount])
+                simulation_writer.writerow(["Per Town:", '', '', '', "Precincts Flagged to Audit", "Population of Flagged Precincts", '', '', '', "Per Town:"])
+                #Per town data
+                for town in townPdata:
+                    simulation_writer.writerow([town, townCdata[town][0], townCdata[town][1], townCdata[town][2], flagForCVR[town][0], flagForCVR[town][1], '', '', '', town, townPdata[town][0], townPdata[town][1], townPdata[town][2]])
+            #Exclude polling data if flag = 0
+            if (flag == 0):
+                simulation_writer.writerow([''])
+                simulation_writer.writerow(["Margin of Victory", margin])
+                simulation_writer.writerow(['', "Ballot Comparison"])
+                simulation_writer.writerow(['', "Number of Ballots", "Stdev", "Variance", "Risk Limit Success", "Average Non-Zero Towns"])
+                simulation_writer.writerow(['', comparisonMean, comparisonStdev, comparisonVariance, str(comparisonSuccess) + "%", comparisonTownCount])
+                simulation_writer.writerow(["Per Town:", '', '', '', "Precincts Flagged to Audit", "Population of Flagged Precincts"])
+                #Per town data
+                for town in townPdata:
+                    simulation_writer.writerow([town, townCdata[town][0], townCdata[town][1], townCdata[town][2], flagForCVR[town][0], flagForCVR[town][1]])
+            if controls is not None:
+                adjusted = controls.estimate()
+                simulation_writer.writerow(['', "Control Variate Mean", round(adjusted['mean'], 2), "Standard Error", round(adjusted['standardError'], 3),
+                                            "Plain Standard Error", round(adjusted['plainStandardError'], 3)])
+        if traces is not None:
+            traces.flush()
+        progressCellDone()
 
     simulation.close()  
     print("Simulation complete, check Adaptive_CVR_Data.csv for the simulation data.")
+    if max_memory:
+        trials.close()
+        print("Check Adaptive_CVR_Trials.csv for the result of every trial.")
+    if trace_quantile is not None:
+        print("Check Adaptive_CVR_Traces.bin (python comparison_traces.py Adaptive_CVR_Traces.bin) for the traces of the largest audits.")
+    if ownProgress:
+        stopProgress()
+    if profile is not None:
+        writeProfile()
+        print("Check " + profile + " for the time spent in each phase.")
 
 def main():
     if (os.path.exists("2020_CT_Election_Data.json")):
@@ -6,12 +6,19 @@ import sys
 from math import log, ceil
 import csv
 from adaptive_backend import *
+from Election_Simulation import RunningStatistics
+from rng_streams import *
+from phase_timers import *
+from sweep_progress import *
+from comparison_traces import TailTraces
+from variance_reduction import ElectionControls
 
 
 class Ballot(object):
     '''
     Summary: Ballot object containing values necessary to conduct an audit
     '''
+    __slots__ = ('number', 'error', 'vote', 'batch', 'town')  # an election holds one per ballot; no per-object dict
 
     def __init__(self, id=None):
         self.number = id
@@ -23,7 +30,7 @@ class Ballot(object):
 
 class Election(object):
     def __init__(self, numBallots, margin, o1, u1, o2, u2, q, riskLimit=0.05, gamma=1.1, simulationType=1,
-                 questionableMath=0, qOverStateRate =1, qAuditorRate = 1, jsonFile=None):
+                 questionableMath=0, qOverStateRate =1, qAuditorRate = 1, jsonFile=None, rng=None):
         self.numBallots = numBallots
         self.margin = margin
         self.overvotes1 = o1
@@ -37,6 +44,7 @@ class Election(object):
         self.questionableMath = questionableMath
         self.qAsMark = qOverStateRate
         self.qAuditorRate = qAuditorRate
+        self.randomStream = None if rng is None else randomSource(rng)  # Seeded stream (numpy Generator) the simulation draws from; None for the global random module
 
         self.winnerBallots = self.runnerupBallots = 0  # Number of ballots the winner/runnerup receives; set with _marginOfVictory
         self.ballotList = {}  # ID: ballot object; set with _distributeBallots
@@ -74,6 +82,11 @@ class Election(object):
                 self.batchMaxSize[town].append(absentee)
             self.staticBatchSize = self.batchMaxSize  # Total number of voters in a precinct; also static
 
+    @property
+    def random(self):
+        # What the simulation draws from: the seeded stream, or the global random module when the election has none
+        return random if self.randomStream is None else self.randomStream
+
     def _marginOfVictory(self):
         '''
         Summary: Calculates the number of ballots each candidate will receive depending on the margin-of-victory
@@ -91,6 +104,7 @@ class Election(object):
         self.winnerBallots = round(1 / 2 * (ballots + ballotsInMargin))
         self.runnerupBallots = round(1 / 2 * (ballots - ballotsInMargin))
 
+    @timed('_distributeBallots')
     def _distributeBallots(self):
         '''
         Summary: Randomly distributes the ballots by ID between overstatements, understatements, winner, and runner-up
@@ -138,8 +152,7 @@ class Election(object):
                 qCounter -= 1
             ballots.append(b)
         # Shuffles the list of ballots for "randomness"
-        # TO DO: seed randomness
-        random.shuffle(ballots)
+        self.random.shuffle(ballots)
         # Assigns ballot IDs to the now shuffled-order of ballots and adds to ballotList dict
         i = 0
         for ballot in ballots:
@@ -157,19 +170,17 @@ class Election(object):
         Returns: The town and batch a ballot belongs to
         '''
         # Selects random town then updates the distribution
-        # TO DO: seed randomness
         batchID = None
-        ballotTown = random.choices(self.townList, weights=self.townPopulation, k=1)
+        ballotTown = self.random.choices(self.townList, weights=self.townPopulation, k=1)
         ballotTown = ballotTown[0]
         townIndex = self.townList.index(ballotTown)
         self.townPopulation[townIndex] -= 1
         if (auditID == "Comparison"):
             while 1:
                 numBatches = self.batchMaxSize[ballotTown][0]  # Finds the number of batches in the town
-                # TO DO: seed randomness
                 # Issue with seed randomness - what if the batch gets full? Not sure how to implement in a way to prevent that
                 # Possible solution: make a list of Batch IDs and use random to find index? Then remove Batch ID from list when full
-                batchID = random.randint(0, numBatches - 1)  # Selects a random batch
+                batchID = self.random.randint(0, numBatches - 1)  # Selects a random batch
                 if (self.batchMaxSize[ballotTown][batchID + 1] > 0):  # Checks that the random batch isn't full already
                     self.batchMaxSize[ballotTown][
                         batchID + 1] -= 1  # Adjusts the remaining ballots that can be added to the batch
@@ -209,6 +220,9 @@ class Election(object):
             maxBallots = self.numBallots
         #dilutedMargin = (self.winnerBallots - self.runnerupBallots) / self.numBallots
         dilutedMargin = self.margin/100
+        self.dilutedMargin = dilutedMargin  # kept with the draws in ballotComparison for comparison_traces
+        self.comparisonRounds = []  # size of every round that ended without meeting the risk limit
+        self.questionableDiscrepancies = []  # discrepancy drawn for every questionable ballot, in order
         alpha = self.riskLimit
         numToAudit = 0
         observedrisk = 1
@@ -226,8 +240,7 @@ class Election(object):
         while 1:
             numToAudit += 1
             # Sampling with replacement, then add the pulled ballot to the list of ballots for ballot comparison
-            # TODO: seed randomness
-            pullID = random.randint(0, self.numBallots - 1)
+            pullID = self.random.randint(0, self.numBallots - 1)
             randomBallot = self.ballotList[pullID]
             self.ballotComparison.append(randomBallot)
             # Determines if one- or two-vote over/understatement, then updates the discrepancy counter
@@ -245,7 +258,7 @@ class Election(object):
                 discCounter = discCounter - 2
                 u2Counter += 1
             elif (randomBallot.error == "questionable"):
-                choice = random.random()
+                choice = self.random.random()
                 qCounter+=1
                 if self.questionableMath == 0:    #Baseline Approach
                     if choice <= self.qAsMark*(1-self.qAuditorRate):
@@ -259,6 +272,7 @@ class Election(object):
                         discCounter -= self.qAsMark
                 elif self.questionableMath == 2 and choice <= self.qAsMark:    #Conservative Approach
                     discCounter -= 1
+                self.questionableDiscrepancies.append(discCounter)
 
             # Calculates the current risk limit
             observedrisk = observedrisk * (1 - (dilutedMargin / (2 * gamma))) / (1 - (discCounter / (2 * gamma)))
@@ -274,6 +288,7 @@ class Election(object):
                 else:
                     prvRound += numToAudit
                     roundCounter += 1
+                    self.comparisonRounds.append(numToAudit)
                     if (roundCounter > 10):
                         raise RuntimeError(
                             "Excessive Number of Rounds. Please run the simulation with less discrepancies.")
@@ -285,6 +300,7 @@ class Election(object):
                 successTracker = 100
                 return numToAudit + prvRound, successTracker
 
+    @timed('_ballotsPerTown')
     def _ballotsPerTown(self):
         '''
         Summary: Iterates through the list of ballots for each method and calls _setTownAndBatch for every ballot that does not yet have a town
@@ -314,9 +330,11 @@ class Election(object):
         return self.numPollingPerTown, self.numComparisonPerTown, lazyBallots
 
 
-def tests(jsonFile):
+def tests(jsonFile, progress=None, progress_file=None):
     '''
     Control setup/audit/simulation from terminal
+    progress: seconds between progress reports (trials and ballots per second, cells done and remaining, ETA) on stderr, and
+    to progress_file as NDJSON if given
 
     Questionable Math = 0 = Baeline Approach
                       = 1 = Bayesian Approach 
@@ -324,17 +342,26 @@ def tests(jsonFile):
     '''
     # call readInput (needed for any audit/simulation run)
     numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionableVotes, riskLimit, num, gamma, margin = readInput()
+    if progress is not None or progress_file is not None:
+        startProgress(interval=progress or 10.0, ndjson_file=progress_file)
+    # Every cell appends its tail traces to the file of its QMath, started fresh once for the whole sweep
+    traceFiles = ['Adaptive_CVR_Traces'+str(questionableMath)+'.bin' for questionableMath in range(3)]
+    for trace_file in traceFiles:
+        open(trace_file, mode='wb').close()
+    # Three collectData cells for each margin and for each auditor rate in [0, 1]
+    planProgress(3 * 3 + 3 * sum(1 for qMark in [1,.9,.8,.7,.6,.5,.4,.3,.2,.1,0] for auditorRate in [qMark-.4, qMark-.2, qMark, qMark+.2, qMark+0.4]
+                                 if not(auditorRate < 0) and not(auditorRate > 1)), num)
 
     print("Margin, q_CVR_Rate, q_auditor_rate, QMath, Mean, stdev, median, 95%")
     for margin in [1,2,3]:
         qMark=.5
         auditorRate=.5
         largeMargin = 100 * (margin / 100 + questionableVotes / numBallots * qMark)
-        numComparisonNormal = collectData(jsonFile, numBallots, overvotes1,undervotes1, overvotes2, undervotes2,questionableVotes, riskLimit, num, gamma, largeMargin, 0, 1, 0, qMark, auditorRate)
+        numComparisonNormal = collectData(jsonFile, numBallots, overvotes1,undervotes1, overvotes2, undervotes2,questionableVotes, riskLimit, num, gamma, largeMargin, 0, 1, 0, qMark, auditorRate, trace_file=traceFiles[0])
         numComparisonNormal.sort()
-        numComparisonQuestionableProb = collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2,undervotes2,questionableVotes, riskLimit, num, gamma, largeMargin, 0, 1, 1, qMark, auditorRate)
+        numComparisonQuestionableProb = collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2,undervotes2,questionableVotes, riskLimit, num, gamma, largeMargin, 0, 1, 1, qMark, auditorRate, trace_file=traceFiles[1])
         numComparisonQuestionableProb.sort()
-        numComparisonQuestionable = collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, undervotes2,questionableVotes, riskLimit, num, gamma, margin, 0, 1, 2, qMark, auditorRate)
+        numComparisonQuestionable = collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, undervotes2,questionableVotes, riskLimit, num, gamma, margin, 0, 1, 2, qMark, auditorRate, trace_file=traceFiles[2])
         numComparisonQuestionable.sort()
 
         print(str(margin)+", "+str(qMark)+", "+str(auditorRate)+", "+str(0)+", "+str(np.mean(numComparisonNormal))+", "+str(np.std(numComparisonNormal))+", "+str(np.median(numComparisonNormal))+", "+str(numComparisonNormal[round(len(numComparisonNormal) * .95)]))
@@ -346,15 +373,17 @@ def tests(jsonFile):
         for auditorRate in [qMark-.4, qMark-.2, qMark, qMark+.2, qMark+0.4]:
             if not(auditorRate < 0) and not(auditorRate > 1):
                 largeMargin = 100 * (margin / 100 + questionableVotes / numBallots * qMark)
-                numComparisonNormal = collectData(jsonFile, numBallots, overvotes1,undervotes1, overvotes2, undervotes2,questionableVotes, riskLimit, num, gamma, largeMargin, 0, 1, 0, qMark, auditorRate)
+                numComparisonNormal = collectData(jsonFile, numBallots, overvotes1,undervotes1, overvotes2, undervotes2,questionableVotes, riskLimit, num, gamma, largeMargin, 0, 1, 0, qMark, auditorRate, trace_file=traceFiles[0])
                 numComparisonNormal.sort()
-                numComparisonQuestionableProb = collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, undervotes2,questionableVotes, riskLimit, num, gamma, largeMargin, 0, 1, 1, qMark, auditorRate)
+                numComparisonQuestionableProb = collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, undervotes2,questionableVotes, riskLimit, num, gamma, largeMargin, 0, 1, 1, qMark, auditorRate, trace_file=traceFiles[1])
                 numComparisonQuestionableProb.sort()
-                numComparisonQuestionable = collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, undervotes2,questionableVotes, riskLimit, num, gamma, margin, 0, 1, 2, qMark, auditorRate)
+                numComparisonQuestionable = collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, undervotes2,questionableVotes, riskLimit, num, gamma, margin, 0, 1, 2, qMark, auditorRate, trace_file=traceFiles[2])
                 numComparisonQuestionable.sort()
                 print(str(margin)+", "+str(qMark)+", "+str(auditorRate)+", "+str(0)+", "+str(np.mean(numComparisonNormal))+", "+str(np.std(numComparisonNormal))+", "+str(np.median(numComparisonNormal))+", "+str(numComparisonNormal[round(len(numComparisonNormal) * .95)]))
                 print(str(margin) + ", "+str(qMark)+", "+str(auditorRate)+", "+ str(1) + ", " + str(np.mean(numComparisonQuestionableProb)) + ", " + str(np.std(numComparisonQuestionableProb)) + ", "+ str(np.median(numComparisonQuestionableProb)) + ", " + str(numComparisonQuestionableProb[round(len(numComparisonQuestionableProb) * .95)]))
                 print(str(margin)+", "+str(qMark)+", "+str(auditorRate)+", "+str(2)+", "+str(np.mean(numComparisonQuestionable)) + ", " + str(np.std(numComparisonQuestionable)) + ", " + str(np.median(numComparisonQuestionable)) + ", " + str(numComparisonQuestionable[round(len(numComparisonQuestionable) * .95)]))
+    if progress is not None or progress_file is not None:
+        stopProgress()
 
 def readInput():
     '''
@@ -412,40 +441,112 @@ def readInput():
 
 
 def statisticsData(dataList):
+    if isinstance(dataList, RunningStatistics):
+        variance = dataList.variance()
+        return round(dataList.mean(), 2), round(np.sqrt(variance), 2), round(variance, 2)
     mean = round(np.mean(dataList), 2)
     stdev = round(np.std(dataList), 2)
     variance = round(np.var(dataList), 2)
     return mean, stdev, variance
 
 
+def comparisonTrial(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, gamma, margin,
+                    simulationType=2, questionableMath=0, qAsMark=1, qAuditor=0, rng=None, traces=None, key=()):
+    '''
+    Summary: One simulated election and ballot comparison audit (one trial of collectData). Trial i of a collectData run with a
+    seed draws from rng=childGenerator(seed, i), so passing that replays it.
+    Parameters: as in collectData, numpy Generator to draw from (None for the global random module), TailTraces to offer the
+    trial's trace to and the trial's key for it
+    Returns: number of ballots compared, risk limit success (0 or 100), the Election (for its per-town counts)
+    '''
+    with phase('election build'):
+        E1 = Election(numBallots, margin, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit,
+                      gamma, simulationType, questionableMath, qAsMark, qAuditor, jsonFile, rng)
+        # Distribute ballots between winner and runnerup
+        E1._marginOfVictory()
+    E1._distributeBallots()
+    count('trials')
+
+    with phase('sampling: ballot comparison'):
+        try:
+            ballots, success = E1._ballotComparison()
+        except RuntimeError as error:
+            if traces is not None:
+                traces.failed(E1, key, error)
+            raise
+    count('sampling loop iterations: ballot comparison', ballots)
+    progressTrial(ballots)
+    if traces is not None:
+        traces.offer(E1, key, ballots, success)
+    return ballots, success, E1
+
+
 def collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable,
-                riskLimit, num, gamma, margin, flag=0, simulationType=2, questionableMath=0, qAsMark=1, qAuditor=0):
+                riskLimit, num, gamma, margin, flag=0, simulationType=2, questionableMath=0, qAsMark=1, qAuditor=0, profile=None, max_memory=False, progress=None, seed=None, trace_quantile=0.99,
+                control_variates=False, trace_file=None):
     '''
     Summary: Runs the simulation num number of times and averages the data. Records all data in one file: 
     Adaptive_CVR_Data.csv - includes number of ballots pulled, ballots per town, number of precincts flagged for audit, etc.
     Variables contain C if they track data for comparison audits, and P if they track data for polling audits
     Flag parameter set to 0 by default to only conduct a ballot comparison audit; other options is 1 to conduct both polling and comparison audit
     Type 1 for incremental ballot audit, type 2 for rounds
+    profile: JSON file to write per-phase times and counters to (also switched on by the RLA_PROFILE environment variable)
+    max_memory: keep memory flat in the number of trials: every trial is written to Adaptive_CVR_Trials<questionableMath>.csv as it
+    finishes, only running sums are kept for the averages, and each election is released before the next one is built
+    progress: seconds between progress reports on stderr (also switched on by the RLA_PROGRESS environment variable)
+    seed: draw trial i from its own stream, childGenerator(seed, i), instead of the global random module (see comparisonTrial)
+    trace_quantile: write traces of the trials with sample sizes above this quantile, and of any trial that raises, to
+    Adaptive_CVR_Traces<questionableMath>.bin (see comparison_traces; None for no traces, 0 for every trial)
+    trace_file: file to append the traces to, for a sweep of cells sharing one file (tests() starts it once); if None, this
+    call starts Adaptive_CVR_Traces<questionableMath>.bin over
+    control_variates: also estimate the mean number of comparison ballots with the discrepancy counts of every audit as control
+    variates (see variance_reduction), and write the adjusted mean and its standard error to the CSV
     Parameters: Data from readInput() function
+    Returns: number of ballots compared in each trial (a numpy array in max_memory mode)
     '''
+    if profile is not None:
+        enableProfiling(profile)
+    ownProgress = progress is not None and not progressEnabled()
+    if ownProgress:
+        startProgress(1, num, progress)
 
     # Create CSV file and write header
     simulation = open('Adaptive_CVR_Data'+str(questionableMath)+'.csv', mode='w', newline='')
     simulation_writer = csv.writer(simulation)
     simulation_writer.writerow(
         ["Number of ballots", numBallots, "Overvotes", overvotes1 + overvotes2, "Undervotes", undervotes1 + undervotes2,
-         "Number of Simulations", num, "Risk Limit", riskLimit, "Questionable", questionable])
+         "Number of Simulations", num, "Risk Limit", riskLimit, "Questionable", questionable]
+        + (["Seed", seedEntropy(seed)] if seed is not None else []))
+    if max_memory:
+        trials = open('Adaptive_CVR_Trials'+str(questionableMath)+'.csv', mode='w', newline='')
+        trials_writer = csv.writer(trials)
+        trials_writer.writerow(["Margin of Victory", "Trial", "Comparison Ballots", "Comparison Success", "Polling Non-Zero Towns", "Comparison Non-Zero Towns"])
+    # Lists of per-trial values, or running sums of them in max_memory mode
+    trialValues = RunningStatistics if max_memory else list
+    traces = None
+    if trace_quantile is not None:
+        if trace_file is None:
+            trace_file = 'Adaptive_CVR_Traces'+str(questionableMath)+'.bin'
+            open(trace_file, mode='wb').close()
+        traces = TailTraces(trace_file, num, trace_quantile,
+                            {'margin': margin, 'overvotes1': overvotes1, 'undervotes1': undervotes1, 'overvotes2': overvotes2,
+                             'undervotes2': undervotes2, 'questionable': questionable, 'questionableMath': questionableMath,
+                             'qAsMark': qAsMark, 'qAuditor': qAuditor, 'seed': None if seed is None else seedEntropy(seed)})
 
     townP, townPlist, townPdata = {}, {}, {}  # Polling data: ballots per town, collection of townP (to average), average data per town
     townC, townClist, townCdata = {}, {}, {}  # Comparison data: ballots per town, collection of townC (to average), average data per town
     # Fill in dictionaries with town names
     for town in jsonFile:
         townPlist[town["Town"]], townClist[town["Town"]], townPdata[town["Town"]], townCdata[
-            town["Town"]] = [], [], [], []
-    tabulatorSize, tabulatorAverage = {}, {}  # Tabulator batches audited for Lazy CVR, average tabulated batch data per town
-    tabulatorList = []  # List of tabulatorSize
-    numPolling, numComparison, countPtown, countCtown = [], [], [], []  # List of ballot polling/comparison numbers, non-zero towns for polling/comparison
+            town["Town"]] = trialValues(), trialValues(), [], []
+    tabulatorSize, tabulatorAverage = {}, {}  # Tabulator batches audited for Lazy CVR, tabulated batch data per town summed over the trials
+    for town in townPlist:
+        tabulatorAverage[town] = [0, 0]
+    numPolling, countPtown, countCtown = trialValues(), trialValues(), trialValues()  # Ballot polling numbers, non-zero towns for polling/comparison
+    # Ballot comparison numbers; returned, so kept per trial, in a compact array in max_memory mode
+    numComparison = np.zeros(num, dtype=np.int64) if max_memory else []
     observedCSuccess = observedPSuccess = 0  # Times the risk limit was met
+    controls = None  # ElectionControls, with control_variates
 
     # Initial sample sizes; set below
     initialCSample = numBallots
@@ -455,17 +556,19 @@ def collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, under
     for i in range(0, num):
         # print("Running Simulation #", i, "for", margin, "%")
         townPcount = townCcount = 0  # Tracks the number of towns with a ballot pulled from it
-        E1 = Election(numBallots, margin, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit,
-                      gamma, simulationType, questionableMath, qAsMark, qAuditor, jsonFile)
-        # Distribute ballots between winner and runnerup
-        E1._marginOfVictory()
-        E1._distributeBallots()
-        # Set up initial sample if done in rounds
-
-        ballots, success = E1._ballotComparison()
-        numComparison.append(ballots)
+        ballots, success, E1 = comparisonTrial(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable,
+                                               riskLimit, gamma, margin, simulationType, questionableMath, qAsMark, qAuditor,
+                                               None if seed is None else childGenerator(seed, i), traces, (i,))
+        if max_memory:
+            numComparison[i] = ballots
+        else:
+            numComparison.append(ballots)
         observedCSuccess += success
-        # Get the number of ballots and batches per town and record it into townPlist, townClist, and tabulatorList
+        if control_variates:
+            if controls is None:
+                controls = ElectionControls(E1)
+            controls.add(E1, ballots)
+        # Get the number of ballots and batches per town and record it into townPlist, townClist, and tabulatorAverage
         townP, townC, tabulatorSize = E1._ballotsPerTown()
         for town in townP:
             townPlist[town].append(townP[town])
@@ -476,18 +579,23 @@ def collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, under
                 townCcount += 1
         countPtown.append(townPcount)
         countCtown.append(townCcount)
-        tabulatorList.append(tabulatorSize)
+        for town in tabulatorSize:
+            tabulatorAverage[town][0] += tabulatorSize[town][0]
+            tabulatorAverage[town][1] += tabulatorSize[town][1]
+        if max_memory:
+            trials_writer.writerow([margin, i, ballots, success, townPcount, townCcount])
+            # drop the election (its ballot lists) before the next one is built
+            del E1, townP, townC, tabulatorSize
 
     # Averages the simulations and calculates stdev and variance
     pollingMean, pollingStdev, pollingVariance = statisticsData(numPolling)
-    pollingTownCount = round(np.mean(countPtown), 2)
+    pollingTownCount = statisticsData(countPtown)[0]
     pollingSuccess = round(observedPSuccess / num, 2)
     comparisonMean, comparisonStdev, comparisonVariance = statisticsData(numComparison)
-    comparisonTownCount = round(np.mean(countCtown), 2)
+    comparisonTownCount = statisticsData(countCtown)[0]
     comparisonSuccess = round(observedCSuccess / num, 2)
     # Gets mean, stdev, and variance per town and stores it in a list; 0: Average ballots, 1: standard deviation, 2: variance
     for town in townPlist:
-        tabulatorAverage[town] = [0, 0]  # Initialize tabulator average per town
         townMean, townStdev, townVariance = statisticsData(townPlist[town])
         townPdata[town] = [townMean, townStdev, townVariance]
         townMean, townStdev, townVariance = statisticsData(townClist[town])
@@ -496,10 +604,6 @@ def collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, under
     # Lazy CVR data
     flagForCVR = {}  # town: [number of precincts flagged, population for CVR]
     # Organizes data into flagForCVR
-    for dct in tabulatorList:
-        for town in dct:
-            tabulatorAverage[town][0] += dct[town][0]
-            tabulatorAverage[town][1] += dct[town][1]
     for town in tabulatorAverage:
         flagForCVR[town] = [0, 0]
         flagForCVR[town][0] = round(tabulatorAverage[town][0] / num, 2)
@@ -541,6 +645,20 @@ def collectData(jsonFile, numBallots, overvotes1, undervotes1, overvotes2, under
     #           for town in townPdata:
     #               simulation_writer.writerow([town, townCdata[town][0], townCdata[town][1], townCdata[town][2], flagForCVR[town][0], flagForCVR[town][1]])
 
+    if controls is not None:
+        adjusted = controls.estimate()
+        simulation_writer.writerow(['', "Control Variate Mean", round(adjusted['mean'], 2), "Standard Error", round(adjusted['standardError'], 3),
+                                    "Plain Standard Error", round(adjusted['plainStandardError'], 3)])
+
+    if max_memory:
+        trials.close()
+    if traces is not None:
+        traces.flush()
+    progressCellDone()
+    if ownProgress:
+        stopProgress()
+    if profile is not None:
+        writeProfile()
     return numComparison
     simulation.close()
     print("Simulation complete, check Adaptive_CVR_Data.csv for the simulation data.")
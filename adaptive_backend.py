@@ -19,8 +19,13 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SO
 
 from Election_Simulation import *
 from election_files import *
-from math import log, ceil
+from binary_cvr import *
+from retrieval_planner import *
+from round_planner import *
+from phase_timers import *
+from math import log, ceil, exp
 from shutil import copy2, rmtree
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 def readCVR(cvr_file):
@@ -28,41 +33,22 @@ def readCVR(cvr_file):
     Function to read CVR file
     Returns: total number of ballots, ballots for winner, ballots for runnerup, margin
     '''
-    #open file, skip headers
-    readCVR = open(cvr_file, mode = 'r', newline = '')
-    CVRreader = csv.reader(readCVR)
+    return loadCVR(cvr_file).totals()
 
-    for i in range(4):
-        next(CVRreader)
-
-    numBallots = winnerBallots = runnerupBallots = 0
-
-    #count number ballots total, winner, runnerup 
-    for ballot in CVRreader: 
-        numBallots += 1
-        if ballot[8] == '1' and ballot[9] == '0':
-            winnerBallots += 1
-        elif ballot[8] == '0' and ballot [9] == '1':
-            runnerupBallots += 1
-        elif ballot[8] == '1' and ballot[9] == '1':
-            #is this possible?
-            winnerBallots += 1
-            runnerupBallots += 1
-
-    #calculate margin
-    margin = ((winnerBallots / numBallots) - (runnerupBallots / numBallots))*100
-
-    readCVR.close()
-
-    return numBallots, winnerBallots, runnerupBallots, margin
-
-def selectBatches(manifest_file, numToAudit, seed):
+def selectBatches(manifest_file, numToAudit, seed, index = None, verbose = True, manifest = None):
     '''
-    Parameters: manifest, number of ballots to audit, seed
+    Parameters: manifest, number of ballots to audit, seed, ElectionIndex (optional, manifest is read from file if not given),
+    verbose (False to select without printing, e.g. on a background thread), manifest (the manifestTotals() values read
+    beforehand, so a background thread does not touch the shared ElectionIndex)
     Summary: selects batches for audit weighted to account for num ballots per batch
     Returns: set of batches to audit, dicts with num ballots per batch total/to audit 
     '''
-    numBallots, batchNames, batchSizes, ballotsPerBatchTotal = readManifest(manifest_file)
+    if manifest is not None:
+        numBallots, batchNames, batchSizes, ballotsPerBatchTotal = manifest
+    elif index is None:
+        numBallots, batchNames, batchSizes, ballotsPerBatchTotal = readManifest(manifest_file)
+    else:
+        numBallots, batchNames, batchSizes, ballotsPerBatchTotal = index.manifestTotals()
     batchWeight = [] #list with batch weights based on election size 
     ballotsPerBatchAudit = {} #key: batch name, value: num ballots in batch to audit 
 
@@ -73,13 +59,8 @@ def selectBatches(manifest_file, numToAudit, seed):
     #select ballots.  This code is deterministic if one repeatedly audits an election.  However, the
     #infrastructure for setting up an election is non-deterministic.  To verify deterministic
     #behavior one needs to conduct multiple audits
-    random.seed(seed)
-    batchesToAudit = random.choices(batchNames, weights=batchWeight, k=round(numToAudit))
-
-
-    #check to see if duplicates allowed 
-    print(str(len(batchesToAudit)) + ' ballots to audit')
-    print('ballots selected from ' + str(len(set(batchesToAudit))) + ' different batches')
+    #own generator (same draws as random.seed(seed)) so a selection made on a background thread leaves the shared one alone
+    batchesToAudit = random.Random(seed).choices(batchNames, weights=batchWeight, k=round(numToAudit))
 
     #intialize values at 0
     for i in batchesToAudit: 
@@ -90,35 +71,38 @@ def selectBatches(manifest_file, numToAudit, seed):
 
     #store set of batches to audit, dict of ballots per batch to audit, dict of ballots per batch total 
     batchSelect = {'batchesToAudit': set(batchesToAudit), 'ballotsPerBatchAudit': ballotsPerBatchAudit, 'ballotsPerBatchTotal': ballotsPerBatchTotal}
+    if verbose:
+        describeSelection(batchSelect)
 
     return batchSelect
 
+def describeSelection(batchSelect):
+    #check to see if duplicates allowed 
+    print(str(sum(batchSelect['ballotsPerBatchAudit'].values())) + ' ballots to audit')
+    print('ballots selected from ' + str(len(batchSelect['batchesToAudit'])) + ' different batches')
+
 def correctTabulation(tabulation_file, manifest_file):
     '''
     Check if tabulation consistent with manifest, if not, adjust accordingly 
     Write any changes to electionTabulationChanges.txt
     '''
-    #write contents of files to lists to make changes
-    tabList = []
-    manList = []
-    with open(tabulation_file, mode= 'r', newline = '') as readTabulation, open(manifest_file, mode = 'r', newline = '') as readManifest:
-        tabulationReader = csv.reader(readTabulation)
-        manifestReader = csv.reader(readManifest) 
-        next(tabulationReader) #skip header
-        next(manifestReader)
-        for row in tabulationReader:
-            tabList.append(row)
-        for row in manifestReader:
-            manList.append(row)
+    #copy rows out of the shared index to make changes
+    index = getElectionIndex(manifest_file, tabulation_file)
+    index.refresh()
+    tabList = [list(row) for row in index.tabulationRows]
             
     #open file to write any changes to 
     with open('electionTabulationChanges.txt', 'w') as writeChanges:
         changes = False 
-        #compare the lists, if total num ballots different, then change tab total to match man total 
-        for row1, row2 in zip(tabList, manList):
-            if row1[2] != row2[3]:
-                writeChanges.write(row1[1] + ' had total ballots changed from ' + row1[2] + ' to ' + row2[3] + '\n')
-                row1[2] = row2[3]
+        #compare by batch name, if total num ballots different, then change tab total to match man total 
+        for row in tabList:
+            i = index.manifestIndex.get(row[1])
+            if i is None:
+                continue
+            manSize = index.manifestRows[i][3]
+            if row[2] != manSize:
+                writeChanges.write(row[1] + ' had total ballots changed from ' + row[2] + ' to ' + manSize + '\n')
+                row[2] = manSize
                 changes = True 
 
         #if winner or runnerup size larger than batch size, change winner or runnerup size to batch size 
@@ -136,11 +120,16 @@ def correctTabulation(tabulation_file, manifest_file):
         if not changes: 
             writeChanges.write('No changes were made to the tabulation.\n')
 
+    #nothing to write back if the tabulation was already consistent 
+    if not changes:
+        return
+
     #write corrected information back to tabulation file 
-    with open(tabulation_file, mode='w', newline = '') as writeTabulation:
+    with openFile(tabulation_file, mode='w', newline = '') as writeTabulation:
         tabulationWriter = csv.writer(writeTabulation)
         tabulationWriter.writerow(['Town', 'BatchNum', 'Size', 'Winner', 'Loser']) #write header 
         tabulationWriter.writerows(tabList)
+    index.invalidate()
 
 def batchSelect(manifest_file, tabulation_file, seed, overvotes1 = 1, undervotes1 = 1, overvotes2 = 1, undervotes2 = 1, prvRound = -1):
     '''
@@ -152,7 +141,8 @@ def batchSelect(manifest_file, tabulation_file, seed, overvotes1 = 1, undervotes
     correctTabulation(tabulation_file, manifest_file)
 
     #read information from tabulation
-    numBallots, winnerBallots, runnerupBallots, margin = readTabulation(tabulation_file)
+    index = getElectionIndex(manifest_file, tabulation_file)
+    numBallots, winnerBallots, runnerupBallots, margin = index.tabulationTotals()
 
     print('numBallots, winnerBallots, runnerupBallots, margin')
     print(numBallots, winnerBallots, runnerupBallots, margin) 
@@ -166,7 +156,7 @@ def batchSelect(manifest_file, tabulation_file, seed, overvotes1 = 1, undervotes
     #if sample size greater than election size, raise error, go to full hand recount
     if numToAudit > numBallots: 
         raise ValueError('Sample is larger than population or is negative. Go to full hand recount.')                       
-    selectedBatches = selectBatches(manifest_file, numToAudit, seed)
+    selectedBatches = selectBatches(manifest_file, numToAudit, seed, index)
     
     #returns dict:
     #'batchesToAudit': set of batches that need CVR, 'ballotsPerBatchAudit': dict w num ballots per batch to audit, 
@@ -174,10 +164,12 @@ def batchSelect(manifest_file, tabulation_file, seed, overvotes1 = 1, undervotes
     return(selectedBatches)
 
 
-def lazyCVR_gen(batchesToAudit):
+@timed('lazyCVR_gen')
+def lazyCVR_gen(batchesToAudit, binary = False):
     '''
     Summary: generate CVRs for selected batches
              in a real audit, this wouldn't be necessary, as the files would come from user 
+             binary = True reads each batch straight from electionCVR2.cvrb instead of scanning electionCVR2.csv
     Returns: Files for batches to be audited
     '''
     lazyCVR_files = set() #set of files names for lazy RLA CVRs
@@ -188,9 +180,25 @@ def lazyCVR_gen(batchesToAudit):
     if not isdir:
         os.mkdir(path)
         
-    CVR2 = str(os.path.join(sys.path[0], 'electionCVR2.csv'))
+    CVR2 = str(os.path.join(sys.path[0], csvName('electionCVR2.csv')))
+
+    if binary:
+        cvr = binaryCVR(CVR2)
+        for batch in sorted(batchesToAudit):
+            positions = cvr.batchPositions(batch)
+            if len(positions) == 0:
+                continue
+            completeName = os.path.join(sys.path[0], path, csvName(batch + 'CVR.csv'))
+            file_exists = os.path.exists(completeName)
+            lazyCVR_files.add(completeName)
+            with openFile(completeName, mode = 'a', newline = '') as writeBatchCVR:
+                batchCVRwriter = csv.writer(writeBatchCVR)
+                if not file_exists:
+                    writeCVRHeaders(batchCVRwriter)
+                batchCVRwriter.writerows(cvr.rows(positions))
+        return lazyCVR_files
 
-    with open(CVR2, mode = 'r', newline = '') as readCVR2:
+    with openFile(CVR2, mode = 'r', newline = '') as readCVR2:
         #open file, skip headers 
         CVR2reader = csv.reader(readCVR2)
         for i in range(4):
@@ -200,11 +208,11 @@ def lazyCVR_gen(batchesToAudit):
             batch = ballot[2]
             if batch in batchesToAudit:
                 save_path = 'adaptive_rla_cvr' #save files to own directory
-                filename = batch + 'CVR.csv'
+                filename = csvName(batch + 'CVR.csv')
                 completeName = os.path.join(sys.path[0], save_path, filename) 
                 file_exists = os.path.exists(completeName) #check to see if file exists yet 
                 lazyCVR_files.add(completeName) #add filename to set 
-                writeBatchCVR = open(completeName, mode = 'a', newline = '')
+                writeBatchCVR = openFile(completeName, mode = 'a', newline = '')
                 batchCVRwriter = csv.writer(writeBatchCVR)
                 if not file_exists:
                     #write headers if file does not exist yet 
@@ -217,6 +225,55 @@ def lazyCVR_gen(batchesToAudit):
 
     return lazyCVR_files
 
+@timed('lazyCVR_rows')
+def lazyCVR_rows(batchesToAudit, binary = False, CVR2 = None, cvr = None):
+    '''
+    Summary: read the rows lazyCVR_gen would write for the selected batches, without writing any files
+    Parameters: batches, binary (True to read electionCVR2.cvrb), election CVR (default electionCVR2.csv in sys.path[0]),
+    cvr (the BinaryCVR already opened, so a background thread does not touch the binary CVR cache)
+    Returns: dict of batch name: CVR rows
+    '''
+    if CVR2 is None:
+        CVR2 = str(os.path.join(sys.path[0], csvName('electionCVR2.csv')))
+    batchRows = {}
+    if binary:
+        if cvr is None:
+            cvr = binaryCVR(CVR2)
+        for batch in sorted(batchesToAudit):
+            rows = cvr.batchRows(batch)
+            if rows:
+                batchRows[batch] = rows
+        return batchRows
+
+    with openFile(CVR2, mode = 'r', newline = '') as readCVR2:
+        CVR2reader = csv.reader(readCVR2)
+        for i in range(4):
+            next(CVR2reader)
+        for ballot in CVR2reader:
+            if ballot[2] in batchesToAudit:
+                batchRows.setdefault(ballot[2], []).append(ballot)
+    return batchRows
+
+@timed('lazyCVR_write')
+def lazyCVR_write(batchRows):
+    '''
+    Summary: write batch CVRs from rows read by lazyCVR_rows, to the same files lazyCVR_gen writes
+    Returns: Files for batches written
+    '''
+    path = os.path.join(sys.path[0], 'adaptive_rla_cvr')
+    os.makedirs(path, exist_ok = True)
+    lazyCVR_files = set()
+    for batch in sorted(batchRows):
+        completeName = os.path.join(path, csvName(batch + 'CVR.csv'))
+        file_exists = os.path.exists(completeName)
+        lazyCVR_files.add(completeName)
+        with openFile(completeName, mode = 'a', newline = '') as writeBatchCVR:
+            batchCVRwriter = csv.writer(writeBatchCVR)
+            if not file_exists:
+                writeCVRHeaders(batchCVRwriter)
+            batchCVRwriter.writerows(batchRows[batch])
+    return lazyCVR_files
+
 
 def ballotSelect(lazyCVR_files, ballotsPerBatchAudit, ballotsPerBatchTotal, seed):
     '''
@@ -227,8 +284,8 @@ def ballotSelect(lazyCVR_files, ballotsPerBatchAudit, ballotsPerBatchTotal, seed
 
     for batch in ballotsPerBatchAudit:
         path = 'adaptive_rla_cvr'
-        filename = str(os.path.join(sys.path[0], path, batch + 'CVR.csv'))
-        new_filename_blank = str(os.path.join(sys.path[0], path, batch + 'CVR_blank.csv'))
+        filename = str(os.path.join(sys.path[0], path, csvName(batch + 'CVR.csv')))
+        new_filename_blank = str(os.path.join(sys.path[0], path, csvName(batch + 'CVR_blank.csv')))
         #add filenames to list 
         auditCVR_blank.append(new_filename_blank) 
         
@@ -238,13 +295,13 @@ def ballotSelect(lazyCVR_files, ballotsPerBatchAudit, ballotsPerBatchTotal, seed
         #determine which ballots to audit per batch using recordID (with replacement)
         #There are two different SEEDs read in by a lazy RLA, the first to select batches and the second to
         #select ballots.  This code is deterministic if one repeatedly audits an election.  However, the
-        #infrastructure for setting up an election is non-deterministic.  To verify deterministic
-        #behavior one needs to conduct multiple audits without setting up another election
-        random.seed(seed)
-        ballotsToAudit = random.choices(range(1, ballotsTotal+1), k=ballotsAudit)
+        #infrastructure for setting up an election is non-deterministic unless the Election is given a seeded rng.  To verify
+        #deterministic behavior one needs to conduct multiple audits without setting up another election
+        #(random.Random(seed) draws the same as random.seed(seed) without resetting the global stream)
+        ballotsToAudit = random.Random(seed).choices(range(1, ballotsTotal+1), k=ballotsAudit)
  
         #open CVR for batch 
-        with open(filename, mode = 'r', newline = '') as readCVR, open(new_filename_blank, mode = 'a', newline = '') as writeCVR:
+        with openFile(filename, mode = 'r', newline = '') as readCVR, openFile(new_filename_blank, mode = 'a', newline = '') as writeCVR:
             CVRreader = csv.reader(readCVR)
             #skip headers 
             for i in range(4):
@@ -281,8 +338,8 @@ def ballotSelect_check(lazyCVR_files, ballotsPerBatchAudit, ballotsPerBatchTotal
 
     for batch in ballotsPerBatchAudit:
         path = 'adaptive_rla_cvr'
-        filename = str(os.path.join(sys.path[0], path, batch + 'CVR.csv'))
-        new_filename_check = str(os.path.join(sys.path[0], path, batch + 'CVR_check.csv'))
+        filename = str(os.path.join(sys.path[0], path, csvName(batch + 'CVR.csv')))
+        new_filename_check = str(os.path.join(sys.path[0], path, csvName(batch + 'CVR_check.csv')))
         #add filenames to list 
         auditCVR_check.append(new_filename_check)
 
@@ -293,12 +350,11 @@ def ballotSelect_check(lazyCVR_files, ballotsPerBatchAudit, ballotsPerBatchTotal
         #This intentionally selects the same ballots as in ballotSelect function.  Recall
         #that this function will not be called in a real audit, as manual interpretations will
         #be input
-        random.seed(seed)
-        ballotsToAudit = random.choices(range(1, ballotsTotal+1), k = ballotsAudit)
+        ballotsToAudit = random.Random(seed).choices(range(1, ballotsTotal+1), k = ballotsAudit)
  
         #this creates the cvr files the user would return with the correct/manual interpretations of votes
-        CVR1 = str(os.path.join(sys.path[0], 'electionCVR1.csv'))
-        with open('electionCVR1.csv', mode = 'r', newline = '') as readCVR, open(new_filename_check, mode = 'w', newline = '') as writeCVR:
+        CVR1 = str(os.path.join(sys.path[0], csvName('electionCVR1.csv')))
+        with openFile(csvName('electionCVR1.csv'), mode = 'r', newline = '') as readCVR, openFile(new_filename_check, mode = 'w', newline = '') as writeCVR:
             CVRreader = csv.reader(readCVR)
             #skip headers 
             for i in range(4):
@@ -318,67 +374,524 @@ def ballotSelect_check(lazyCVR_files, ballotsPerBatchAudit, ballotsPerBatchTotal
     return auditCVR_check
 
 
-def calculateRisk(interpretation_files, lazyCVR_files, tabulation_file, manifest_file, riskLimit, seed1, seed2, flag = 0):
+def calculateRisk(interpretation_files, lazyCVR_files, tabulation_file, manifest_file, riskLimit, seed1, seed2, flag = 0, numTeams = 0, roundTarget = None,
+                  interpretations = None, speculate = False, draws = None):
     '''
     Summary: takes in files from user with manual interpretation of audited ballots, 
             compares with tabulated interpretations
             flag = 0 for simulated audit; flag = 1 for own audit
+            numTeams > 0 writes a retrieval plan for every later round
+            roundTarget (e.g. 0.9) sizes later rounds for that probability of meeting the risk limit
+            interpretations: for flag = 1, a function (round number, blank files) -> filled-in interpretation files,
+            used instead of pausing for the user to fill in the blank files
+            speculate = True prepares the likely next rounds in the background while a round's interpretations are entered
+            draws: batch name: recordIDs drawn in the first round (repeats kept), from drawBallots; a ballot drawn twice
+            counts twice in the risk, as in later rounds
     Returns: risk level
     '''
-    #get values from tabulation to calculate dilutedMargin
-    numBallots, winnerBallots, runnerupBallots, margin = readTabulation(tabulation_file)
-    dilutedMargin = (winnerBallots - runnerupBallots)/numBallots
-    observedrisk = 1
-    flag = 0
-
-    #log any forceConsistent changes
-    with open('forceConsistentChanges.txt', mode = 'w') as cvrChanges:
-        cvrChanges.write('Batches that were forcedConsistent will be logged here. \n')
+    #the first round is scored from the given files, later rounds only extract and compare new ballots
+    engine = AdaptiveRounds(manifest_file, tabulation_file, riskLimit, seed1, seed2, flag, numTeams = numTeams, roundTarget = roundTarget,
+                            speculate = speculate)
+    observedrisk = engine.scoreFiles(interpretation_files, lazyCVR_files, draws)
 
     while 1:
-        #sort files in alphabetical order so that they are compared properly
-        interpretation_files.sort()
-        lazy_list = list(lazyCVR_files)
-        lazy_list.sort()
-
-        #Conduct the audit, return the risk limit 
-        observedrisk, forced, o1, o2, u1, u2, prvRound = auditMath(interpretation_files, lazy_list, manifest_file, tabulation_file, dilutedMargin, observedrisk)
-
-        if forced == True:
-            flag = 1
-        
         print("In that round, risk limit =", observedrisk)
         if observedrisk < riskLimit:
             break
         else:
             print("Risk limit not met in current round, starting next round.")
             print("")
-            selectedBatches = batchSelect(manifest_file, tabulation_file, seed1, o1, u1, o2, u2, prvRound)
-            removeWorkingDir()
-            lazyCVR_files = lazyCVR_gen(selectedBatches['batchesToAudit'])
-            if (flag == 1):
-                #Generate blank files to fill in
-                interpretation_files = ballotSelect(lazyCVR_files, selectedBatches['ballotsPerBatchAudit'], selectedBatches['ballotsPerBatchTotal'], seed2)
+            interpretation_files = engine.prepareRound()
+            if (flag == 1 and interpretations is not None):
+                interpretation_files = interpretations(engine.roundNumber + 1, interpretation_files)
+            elif (flag == 1):
                 pause = input('Blank CVR files have been generated. Please fill in your interpretations. \nThen press ENTER to continue. ')
-            if (flag == 0):
-                #Generate simulated files 
-                interpretation_files = ballotSelect_check(lazyCVR_files, selectedBatches['ballotsPerBatchAudit'], selectedBatches['ballotsPerBatchTotal'], seed2)
-
-    #if no batches were inconsistent, log in file 
-    if flag == 0: 
-        with open('forceConsistentChanges.txt', mode = 'a') as cvrChanges:
-          cvrChanges.write('No batches were forced consistent.')
+            observedrisk = engine.scoreRound(interpretation_files)
 
+    engine.stopSpeculation()
     return observedrisk
 
-def auditMath(interpretation_files, lazy_list, manifest_file, tabulation_file, dilutedMargin, observedrisk):
+def roundSeed(seed, roundNumber):
+    '''
+    Seed used to select batches/ballots in a given round. Round 1 uses the seed as given, so a one-round audit
+    selects the same ballots as before; later rounds get new selections instead of repeating round 1's
+    '''
+    return seed + roundNumber - 1
+
+def drawBallots(ballotsPerBatchAudit, ballotsPerBatchTotal, seed):
+    '''
+    Select ballots for audit per batch using recordID (with replacement), the same way as ballotSelect
+    Returns: dict of batch name: list of recordIDs drawn (repeats kept)
+    '''
+    draws = {}
+    for batch in ballotsPerBatchAudit:
+        draws[batch] = random.Random(seed).choices(range(1, int(ballotsPerBatchTotal[batch])+1), k=int(ballotsPerBatchAudit[batch]))
+    return draws
+
+def writeCVRHeaders(CVRwriter):
+    #write the 4 header lines used by every CVR file
+    CVRwriter.writerow(['Test'])
+    CVRwriter.writerow(['','','','','','','','','Contest 1 (vote for = 1)','Contest 1 (vote for = 1)'])
+    CVRwriter.writerow(['','','','','','','','','Winner','Runner-Up'])
+    CVRwriter.writerow(['CVRNumber','TabulatorNumber', 'BatchID','RecordID', 'ImprintedID','CountingGroup','PrecinctPortion','BallotType','',''])
+
+countNames = {1: 'o1', 2: 'o2', -1: 'u1', -2: 'u2'} #cumulative count each discrepancy adds to
+#new discrepancies in the round being entered that the following round is prepared for; the first (none) is the most likely
+speculationOutcomes = [{}, {'o1': 1}, {'u1': 1}, {'o1': 2}, {'o2': 1}, {'o1': 1, 'u1': 1}]
+
+class AdaptiveRounds(object):
+    '''
+    Summary: Round engine for a multi-round adaptive audit. Keeps the batches already extracted and validated, the ballots already
+    compared, and the cumulative discrepancy counts and log-risk, so a new round only extracts batches not seen before and only asks
+    for interpretations of ballots not compared before (a ballot drawn again reuses its earlier comparison). The tabulation is corrected
+    once, before the first round. State is saved to adaptive_rla_cvr/auditState.json after every step so an audit can be resumed.
+    Parameters: manifest, tabulation, risk limit, seeds for batch and ballot selection, flag (0 for simulated audit, 1 for own audit),
+    resume (True to continue from the saved state), binary (True to read the election CVRs from binary copies), numTeams (> 0 to write
+    a retrieval plan with that many team packets for the ballots each round needs), roundTarget (probability of stopping that later
+    rounds are sized for; None for the Kaplan-Markov estimate), speculate (True to select and extract the next round for the likely
+    outcomes of the pending round on a background thread, so the matching round is ready as soon as the pending one is scored)
+    '''
+    def __init__(self, manifest_file, tabulation_file, riskLimit, seed1, seed2, flag = 0, gamma = 1.1, resume = False, binary = False, numTeams = 0,
+                 roundTarget = None, speculate = False):
+        self.manifest_file = manifest_file
+        self.tabulation_file = tabulation_file
+        self.riskLimit = riskLimit
+        self.seed1 = seed1
+        self.seed2 = seed2
+        self.flag = flag
+        self.gamma = gamma
+        self.binary = binary #True to read electionCVR1/electionCVR2 through their binary copies
+        self.numTeams = numTeams #Retrieval teams to plan packets for, 0 for no retrieval plan
+        self.roundTarget = roundTarget #Stopping probability later rounds are sized for, None for the Kaplan-Markov estimate
+        self.speculate = speculate #True to prepare the likely next rounds while the pending round is entered
+        self._speculation = None #Future for the rounds being prepared, None if none are
+        self._executor = None
+        self._staged = {} #Batch name: CVR rows read ahead for the round being prepared
+        self.state_file = str(os.path.join(sys.path[0], 'adaptive_rla_cvr', 'auditState.json'))
+
+        self.roundNumber = 0 #Number of rounds scored so far
+        self.batchFiles = {} #Batch name: extracted batch CVR file
+        self.consistency = {} #Batch CVR file: True/False from validateBatches
+        self.compared = {} #'batch:recordID': discrepancy for every ballot already compared
+        self.counts = {'o1': 0, 'o2': 0, 'u1': 0, 'u2': 0} #Cumulative discrepancy counts
+        self.ballotsAudited = 0 #Cumulative ballots examined, counting repeat draws
+        self.logRisk = 0.0 #log of the observed risk
+        self.pending = None #Batch name: recordIDs drawn for the round waiting to be scored
+        self.validationReports = []
+
+        if resume and os.path.exists(self.state_file):
+            self.load()
+
+    def observedrisk(self):
+        return exp(self.logRisk)
+
+    def _state(self):
+        return {'roundNumber': self.roundNumber, 'batchFiles': self.batchFiles, 'consistency': self.consistency,
+                'compared': self.compared, 'counts': self.counts, 'ballotsAudited': self.ballotsAudited,
+                'logRisk': self.logRisk, 'pending': self.pending}
+
+    def save(self):
+        state = self._state()
+        os.makedirs(os.path.dirname(self.state_file), exist_ok = True)
+        with open(self.state_file + '.tmp', mode = 'w') as writeState:
+            json.dump(state, writeState)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def load(self):
+        with open(self.state_file, mode = 'r') as readState:
+            state = json.load(readState)
+        for key in state:
+            setattr(self, key, state[key])
+        if os.path.exists('forceConsistentReport.json'):
+            with open('forceConsistentReport.json', mode = 'r') as readReport:
+                self.validationReports = json.load(readReport)
+
+    def _manifestRows(self):
+        #manifest rows (Container, Tabulator, Batch Name, Number of Ballots) for the retrieval plan
+        return loadManifest(self.manifest_file).rows
+
+    def _totals(self):
+        return getElectionIndex(self.manifest_file, self.tabulation_file).tabulationTotals()
+
+    def _dilutedMargin(self):
+        numBallots, winnerBallots, runnerupBallots, margin = self._totals()
+        return (winnerBallots - runnerupBallots)/numBallots
+
+    def _validate(self, batch_files):
+        #validate newly extracted batches only; batches validated in an earlier round are not checked again
+        report = validateBatches(self.manifest_file, self.tabulation_file, sorted(batch_files))
+        self.consistency.update(report['consistent'])
+        self.validationReports.append(report)
+        writeValidationReport(self.validationReports)
+
+    def _record(self, discCounter):
+        #add one examined ballot to the cumulative counts and risk
+        if discCounter == 1:
+            self.counts['o1'] += 1
+        elif discCounter == 2:
+            self.counts['o2'] += 1
+        elif discCounter == -1:
+            self.counts['u1'] += 1
+        elif discCounter == -2:
+            self.counts['u2'] += 1
+        self.ballotsAudited += 1
+        self.logRisk += log(1-(self._margin/(2*self.gamma))) - log(1-(discCounter/(2*self.gamma)))
+
+    def scoreFiles(self, interpretation_files, lazyCVR_files, draws = None):
+        '''
+        Score a round given as files (interpretation files and the batch CVRs they were drawn from), as produced by
+        lazyCVR_gen and ballotSelect/ballotSelect_check, through the same per-draw comparison as scoreRound
+        draws: batch name: recordIDs drawn (repeats kept), as drawBallots returns them; if not given, every ballot in the
+        interpretation files counts as drawn once
+        Returns: observed risk
+        '''
+        lazy_list = sorted(lazyCVR_files)
+        for batch_file in lazy_list:
+            self.batchFiles[cvrBatchName(batch_file)] = batch_file
+        self._validate([batch_file for batch_file in lazy_list if batch_file not in self.consistency])
+
+        if draws is None:
+            draws = {}
+            for key in self._manualVotes(interpretation_files):
+                batch, recordID = key.split(':', 1)
+                draws.setdefault(batch, []).append(recordID)
+        self.pending = draws
+        return self.scoreRound(interpretation_files)
+
+    def sampleSize(self):
+        '''
+        Kaplan-Markov sample size for the next round, from the cumulative discrepancy rates and the risk already observed.
+        With a roundTarget, the smallest round with that probability of meeting the risk limit at those rates instead
+        '''
+        return self._sampleSize(self.counts, self.ballotsAudited, self.logRisk)
+
+    def _sampleSize(self, counts, ballotsAudited, logRisk, totals = None):
+        #sampleSize for the given cumulative counts, ballots audited and log risk (and tabulation totals, if read beforehand)
+        numBallots, winnerBallots, runnerupBallots, margin = self._totals() if totals is None else totals
+        if self.roundTarget is not None:
+            audited = max(ballotsAudited, 1)
+            return comparisonRoundSize(margin/100, counts['o1']/audited, counts['o2']/audited, self.riskLimit, self.gamma, logRisk,
+                                       self.roundTarget, numBallots)
+        #only the remaining factor between the observed risk and the risk limit has to be made up by the new round
+        E1 = Election(numBallots, margin, counts['o1'], counts['u1'], counts['o2'], counts['u2'], self.riskLimit/exp(logRisk), self.gamma)
+        numToAudit = E1._comparisonSample(counts['o1'], counts['u1'], counts['o2'], counts['u2'], ballotsAudited)
+        if numToAudit > numBallots: 
+            raise ValueError('Sample is larger than population or is negative. Go to full hand recount.')
+        return numToAudit
+
+    def prepareRound(self, overvotes1 = 1, undervotes1 = 1, overvotes2 = 1, undervotes2 = 1):
+        '''
+        Select the next round's ballots, extract CVRs for batches not extracted yet, and write interpretation files
+        (blank if flag = 1, simulated from electionCVR1.csv if flag = 0) for ballots not compared yet
+        Over/undervotes are the initial estimates, only used if no round was scored yet
+        Returns: list of interpretation files for the round
+        '''
+        nextRound = self.roundNumber + 1
+        selectedBatches = self._selectBatches(nextRound, overvotes1, undervotes1, overvotes2, undervotes2)
+
+        #only extract and validate batches that were not extracted in an earlier round 
+        newBatches = set(selectedBatches['batchesToAudit']) - set(self.batchFiles)
+        newFiles = self._extractBatches(newBatches)
+        if newFiles:
+            self._validate(newFiles)
+
+        self.pending = drawBallots(selectedBatches['ballotsPerBatchAudit'], selectedBatches['ballotsPerBatchTotal'], roundSeed(self.seed2, nextRound))
+        newBallots = {} #batch name: set of recordIDs that still need an interpretation
+        for batch in self.pending:
+            recordIDs = set(str(recordID) for recordID in self.pending[batch] if batch + ':' + str(recordID) not in self.compared)
+            if recordIDs:
+                newBallots[batch] = recordIDs
+        print(str(sum(len(self.pending[batch]) for batch in self.pending)) + ' ballots drawn this round, ' + str(sum(len(newBallots[batch]) for batch in newBallots)) + ' not compared before')
+        if self.numTeams > 0:
+            #only ballots without an earlier comparison have to be pulled; repeat draws show as "position × k"
+            retrievalPlan({batch: [recordID for recordID in self.pending[batch] if str(recordID) in newBallots[batch]] for batch in newBallots},
+                          self._manifestRows(), self.numTeams, os.path.join(sys.path[0], 'adaptive_rla_cvr', 'retrieval_plan_r' + str(nextRound)))
+
+        if self.flag == 1:
+            interpretation_files = self._writeBlankFiles(newBallots, nextRound)
+        else:
+            interpretation_files = self._writeCheckFiles(newBallots, nextRound)
+        self.save()
+        if self.speculate:
+            self._startSpeculation(nextRound + 1)
+        return interpretation_files
+
+    def _outcomeStates(self):
+        '''
+        Cumulative counts, ballots audited and log risk the pending round leaves for each of speculationOutcomes. Ballots compared
+        before (and ballots in batches that are not consistent) keep their known discrepancy, the outcome's discrepancies go to
+        ballots not compared yet and the other new ballots are taken to match
+        Returns: list of (counts, ballotsAudited, logRisk) for the outcomes that leave the risk limit unmet
+        '''
+        marginWeight = log(1-(self._dilutedMargin()/(2*self.gamma)))
+        counts = dict(self.counts)
+        ballotsAudited = self.ballotsAudited
+        logRisk = self.logRisk
+        newBallots = set()
+        for batch in self.pending:
+            consistent = self.consistency.get(self.batchFiles.get(batch), True)
+            for recordID in self.pending[batch]:
+                key = batch + ':' + str(recordID)
+                ballotsAudited += 1
+                logRisk += marginWeight
+                if key in self.compared or not consistent:
+                    discCounter = self.compared.get(key, 2)
+                    if discCounter != 0:
+                        counts[countNames[discCounter]] += 1
+                        logRisk -= log(1-(discCounter/(2*self.gamma)))
+                else:
+                    newBallots.add(key)
+
+        states = []
+        for outcome in speculationOutcomes:
+            if sum(outcome.values()) > len(newBallots):
+                continue
+            outcomeCounts = dict(counts)
+            outcomeRisk = logRisk
+            for discCounter, name in countNames.items():
+                outcomeCounts[name] += outcome.get(name, 0)
+                outcomeRisk -= outcome.get(name, 0)*log(1-(discCounter/(2*self.gamma)))
+            if outcomeRisk >= log(self.riskLimit):
+                states.append((outcomeCounts, ballotsAudited, outcomeRisk))
+        return states
+
+    def _startSpeculation(self, nextRound):
+        #select and read ahead the round after the pending one, for each likely outcome, on a background thread
+        states = self._outcomeStates()
+        if not states:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers = 1)
+        #the tabulation totals, manifest and binary CVR come from the shared (unlocked) file caches, so they are read here on the
+        #main thread; the speculation thread only gets the values
+        CVR2 = str(os.path.join(sys.path[0], csvName('electionCVR2.csv')))
+        self._speculation = self._executor.submit(self._prepareRounds, nextRound, states, set(self.batchFiles), CVR2, self._totals(),
+                                                  getElectionIndex(self.manifest_file, self.tabulation_file).manifestTotals(),
+                                                  binaryCVR(CVR2) if self.binary else None, fileStamp(CVR2))
+
+    def _prepareRounds(self, nextRound, states, extracted, CVR2, totals, manifest, cvr, stamp):
+        '''
+        Runs on the speculation thread: the batch selection for each outcome's sample size, and the CVR rows of every selected batch
+        not extracted yet. Works only from the values it is given (tabulation totals, manifestTotals(), BinaryCVR or None) and
+        electionCVR2 itself, so it neither reads nor changes the file caches the main thread uses while the pending round is entered
+        Returns: dict with the round, sample size: selection, batch name: rows, and the electionCVR2 stamp the rows were read at
+        '''
+        selections = {}
+        for counts, ballotsAudited, logRisk in states:
+            try:
+                numToAudit = self._sampleSize(counts, ballotsAudited, logRisk, totals)
+            except ValueError:
+                #that outcome goes to a full hand recount
+                continue
+            if numToAudit not in selections:
+                selections[numToAudit] = selectBatches(self.manifest_file, numToAudit, roundSeed(self.seed1, nextRound), verbose = False,
+                                                       manifest = manifest)
+        newBatches = set()
+        for selectedBatches in selections.values():
+            newBatches |= selectedBatches['batchesToAudit'] - extracted
+        return {'round': nextRound, 'selections': selections, 'rows': lazyCVR_rows(newBatches, self.binary, CVR2, cvr) if newBatches else {},
+                'stamp': stamp, 'CVR2': CVR2}
+
+    def _awaitSpeculation(self):
+        #rounds prepared by the speculation thread, waiting for it if it is still running; None if nothing was prepared
+        speculation, self._speculation = self._speculation, None
+        if speculation is None:
+            return None
+        try:
+            return speculation.result()
+        except Exception as error:
+            print('Preparing the next round ahead failed (' + str(error) + '), selecting it now.')
+            return None
+
+    def stopSpeculation(self):
+        '''
+        Wait for any round being prepared in the background and drop it (call when the audit is over)
+        '''
+        self._awaitSpeculation()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _selectBatches(self, nextRound, overvotes1, undervotes1, overvotes2, undervotes2):
+        #batchSelect (which corrects the tabulation first) for the first round, a new sample size for later rounds
+        if self.roundNumber == 0:
+            return batchSelect(self.manifest_file, self.tabulation_file, self.seed1, overvotes1, undervotes1, overvotes2, undervotes2)
+        index = getElectionIndex(self.manifest_file, self.tabulation_file)
+        numToAudit = self.sampleSize()
+        prepared = self._awaitSpeculation()
+        if prepared is not None and prepared['round'] == nextRound and numToAudit in prepared['selections']:
+            #the selection only depends on the sample size and the round's seed, so the prepared one is the same selection
+            print('Round ' + str(nextRound) + ' was prepared while the last round was entered.')
+            if fileStamp(prepared['CVR2']) == prepared['stamp']:
+                self._staged = prepared['rows']
+            describeSelection(prepared['selections'][numToAudit])
+            return prepared['selections'][numToAudit]
+        return selectBatches(self.manifest_file, numToAudit, roundSeed(self.seed1, nextRound), index)
+
+    def _extractBatches(self, newBatches):
+        #batch CVRs from electionCVR2.csv (rows read ahead by the speculation thread are written directly); returns the keys of the
+        #new batches in self.consistency
+        staged = {batch: self._staged[batch] for batch in newBatches if batch in self._staged}
+        self._staged = {}
+        newFiles = lazyCVR_write(staged)
+        if set(newBatches) - set(staged):
+            newFiles |= lazyCVR_gen(set(newBatches) - set(staged), self.binary)
+        for batch_file in newFiles:
+            self.batchFiles[cvrBatchName(batch_file)] = batch_file
+        return newFiles
+
+    def _writeBlankFiles(self, newBallots, roundNumber):
+        #blank CVRs (no vote columns) for the auditors to fill in, from the extracted batch CVRs
+        blank_files = []
+        for batch in sorted(newBallots):
+            new_filename_blank = str(os.path.join(sys.path[0], 'adaptive_rla_cvr', csvName(batch + 'CVR_blank_r' + str(roundNumber) + '.csv')))
+            blank_files.append(new_filename_blank)
+            with openFile(self.batchFiles[batch], mode = 'r', newline = '') as readCVR, openFile(new_filename_blank, mode = 'w', newline = '') as writeCVR:
+                CVRreader = csv.reader(readCVR)
+                for i in range(4):
+                    next(CVRreader)
+                CVRwriter = csv.writer(writeCVR)
+                writeCVRHeaders(CVRwriter)
+                for ballot in CVRreader:
+                    if ballot[3] in newBallots[batch]:
+                        CVRwriter.writerow(ballot[:8])
+        return blank_files
+
+    def _writeCheckFiles(self, newBallots, roundNumber):
+        #simulated manual interpretations, taken from electionCVR1.csv in a single pass for every batch in the round
+        check_files = {}
+        writers = {}
+        openFiles = []
+        try:
+            for batch in sorted(newBallots):
+                check_files[batch] = str(os.path.join(sys.path[0], 'adaptive_rla_cvr', csvName(batch + 'CVR_check_r' + str(roundNumber) + '.csv')))
+                writeCVR = openFile(check_files[batch], mode = 'w', newline = '')
+                openFiles.append(writeCVR)
+                writers[batch] = csv.writer(writeCVR)
+                writeCVRHeaders(writers[batch])
+            if self.binary:
+                cvr = binaryCVR(str(os.path.join(sys.path[0], csvName('electionCVR1.csv'))))
+                for batch in writers:
+                    writers[batch].writerows(ballot for ballot in cvr.batchRows(batch) if ballot[3] in newBallots[batch])
+                return [check_files[batch] for batch in sorted(check_files)]
+            with openFile(str(os.path.join(sys.path[0], csvName('electionCVR1.csv'))), mode = 'r', newline = '') as readCVR:
+                CVRreader = csv.reader(readCVR)
+                for i in range(4):
+                    next(CVRreader)
+                for ballot in CVRreader:
+                    if ballot[2] in writers and ballot[3] in newBallots[ballot[2]]:
+                        writers[ballot[2]].writerow(ballot)
+        finally:
+            for writeCVR in openFiles:
+                writeCVR.close()
+        return [check_files[batch] for batch in sorted(check_files)]
+
+    @timed('auditMath: scoreRound')
+    def scoreRound(self, interpretation_files):
+        '''
+        Compare the interpretations for the pending round against the batch CVRs and update the cumulative risk
+        Returns: observed risk
+        '''
+        self._margin = self._dilutedMargin()
+        manualVotes = self._manualVotes(interpretation_files)
+
+        for batch in sorted(self.pending):
+            batch_file = self.batchFiles[batch]
+            consistent = self.consistency[batch_file]
+            tabulationVotes = None
+            for recordID in self.pending[batch]:
+                key = batch + ':' + str(recordID)
+                if key not in self.compared:
+                    if tabulationVotes is None:
+                        tabulationVotes = self._batchVotes(batch)
+                    if str(recordID) not in tabulationVotes:
+                        #recordID replaced when the batch was forced consistent, nothing to compare
+                        continue
+                    if not consistent:
+                        #if files not consistent, every ballot in batch has dicsrepancy 2 
+                        self.compared[key] = 2
+                    elif key not in manualVotes:
+                        raise ValueError('No manual interpretation was given for ballot ' + str(recordID) + ' in batch ' + batch + '.')
+                    else:
+                        self.compared[key] = discrepancyValues[ballotDiscrepancy(manualVotes[key], tabulationVotes[str(recordID)])]
+                self._record(self.compared[key])
+
+        self.pending = None
+        self.roundNumber += 1
+        self.save()
+        return self.observedrisk()
+
+    def _manualVotes(self, interpretation_files):
+        #'batch:recordID': manual interpretation row
+        manualVotes = {}
+        for interpretation_file in interpretation_files:
+            with openFile(interpretation_file, mode = 'r', newline = '') as readManualVotes:
+                manualVotesReader = csv.reader(readManualVotes)
+                for i in range(4):
+                    next(manualVotesReader)
+                for ballot in manualVotesReader:
+                    manualVotes[ballot[2] + ':' + ballot[3]] = ballot
+        return manualVotes
+
+    def _batchVotes(self, batch):
+        #recordID: tabulated row from the extracted batch CVR
+        with openFile(self.batchFiles[batch], mode = 'r', newline = '') as readTabulationVotes:
+            tabulationVotesReader = csv.reader(readTabulationVotes)
+            for i in range(4):
+                next(tabulationVotesReader)
+            return {ballot[3]: ballot for ballot in tabulationVotesReader}
+
+discrepancyValues = {"none": 0, "overvote": 1, "overvote2": 2, "undervote": -1, "undervote2": -2} #discrepancy added to the risk per error type
+
+def ballotDiscrepancy(ballot1, ballot2):
+    '''
+    Compare the manual interpretation (ballot1) of one ballot with its tabulated CVR row (ballot2)
+    Returns: "none", "overvote", "overvote2", "undervote", or "undervote2"
+    '''
+    randomBallotError = "none"
+    if ballot2[8] == '0' and ballot2[9] == '0': #tabulation shows undervote/no vote
+        if ballot1[8] == '0' and ballot1[9] == '1': #manual interpretation shows loser vote
+            randomBallotError = "overvote"  
+        elif ballot1[8] == '1' and ballot1[9] == '0': #manual interpretation shows winner vote
+            randomBallotError = "undervote"
+
+    elif ballot2[8] == '1' and ballot2[9] == '1': #tabulation shows over vote
+        if ballot1[8] == '0' and ballot1[9] == '1': #manual interpretation shows loser vote
+            randomBallotError = "overvote"
+        elif ballot1[8] == '1' and ballot1[9] == '0': #manual interpretation shows winner vote
+            randomBallotError = "undervote"
+
+    elif ballot2[8] == '1' and ballot2[9] == '0': #tabulation shows winner vote
+        if ballot1[8] == '0' and ballot1[9] == '1': #manual interpretation shows loser vote
+            randomBallotError = "overvote2"
+        elif ballot1[8] == '1' and ballot1[9] == '1': #manual interpretation shows overvote
+            randomBallotError = "overvote"
+
+    elif ballot2[8] == '0' and ballot2[9] == '1': #tabulation shows loser vote
+        if ballot1[8] == '1' and ballot1[9] == '0': #manual interpretation shows winner vote
+            randomBallotError = "undervote2"
+
+    return randomBallotError
+
+@timed('auditMath')
+def auditMath(interpretation_files, lazy_list, manifest_file, tabulation_file, dilutedMargin, observedrisk, consistency = None, compared = None):
+    '''
+    Compare manual interpretations against the batch CVRs and update the risk
+    consistency: dict of batch file: True/False from validateBatches; if not given, the batches are validated here first
+    compared: optional dict filled with 'batch:recordID': discrepancy for every ballot compared
+    '''
     gamma = 1.1
     o1 = u1 = o2 = u2 = 0 
-    forced = False
     prvRound = 0
+    forced = False
+    if consistency is None:
+        report = validateBatches(manifest_file, tabulation_file, lazy_list)
+        writeValidationReport([report])
+        consistency = report['consistent']
+        forced = len(report['forced']) > 0
     #go through each batch
     for batch1, batch2 in zip(interpretation_files, lazy_list):
-        with open(batch1, mode = 'r', newline = '') as readManualVotes, open(batch2, mode ='r', newline = '') as readTabulationVotes:
+        with openFile(batch1, mode = 'r', newline = '') as readManualVotes, openFile(batch2, mode ='r', newline = '') as readTabulationVotes:
             manualVotesReader = csv.reader(readManualVotes)
             tabulationVotesReader = csv.reader(readTabulationVotes)  
             #skip headers 
@@ -386,55 +899,26 @@ def auditMath(interpretation_files, lazy_list, manifest_file, tabulation_file, d
                 next(manualVotesReader)
                 next(tabulationVotesReader)
 
-            #returns True if consistent, False if not consistent 
-            batch_name = os.path.basename(batch2)
-            batch_name = batch_name.replace('CVR.csv', '')
-            #batch_name = batch2.replace('lazy_rla_cvr/', '').replace('CVR.csv', '') #get batch name from filename string
-            consistent = checkConsistent(manifest_file, tabulation_file, batch_name, batch2)
-            #since batches forced consistent, it doesn't matter that this is where checkConisistent is called
-            #because audit will always be able to run 
-            if not consistent: 
-                print(batch_name + ' forced consistent.')
-                forceConsistent(manifest_file, tabulation_file, batch_name, batch2)
-                consistent = checkConsistent(manifest_file, tabulation_file, batch_name, batch2)
-                forced = True 
+            #batches were already checked (and forced consistent if needed) by validateBatches
+            batch_name = cvrBatchName(batch2)
+            consistent = consistency[batch2]
 
             #go through each ballot in each batch 
             for ballot1 in manualVotesReader: 
                 for ballot2 in tabulationVotesReader:
                     #find correct ballot to compare based on CVR number 
                     if ballot1[0] == ballot2[0]:
-                        randomBallotError = "none"
                         #if files consistent, proceed as normal 
                         if consistent:
-                            if ballot2[8] == '0' and ballot2[9] == '0': #tabulation shows undervote/no vote
-                                if ballot1[8] == '0' and ballot1[9] == '1': #manual interpretation shows loser vote
-                                    randomBallotError = "overvote"  
-                                    o1 += 1              
-                                elif ballot1[8] == '1' and ballot1[9] == '0': #manual interpretation shows winner vote
-                                    randomBallotError = "undervote"
-                                    u1 += 1
-                    
-                            elif ballot2[8] == '1' and ballot2[9] == '1': #tabulation shows over vote
-                                if ballot1[8] == '0' and ballot1[9] == '1': #manual interpretation shows loser vote
-                                    randomBallotError = "overvote"
-                                    o1 += 1
-                                elif ballot1[8] == '1' and ballot1[9] == '0': #manual interpretation shows winner vote
-                                    randomBallotError = "undervote"
-                                    u1 += 1
-
-                            elif ballot2[8] == '1' and ballot2[9] == '0': #tabulation shows winner vote
-                                if ballot1[8] == '0' and ballot1[9] == '1': #manual interpretation shows loser vote
-                                    randomBallotError = "overvote2"
-                                    o2 += 1
-                                elif ballot1[8] == '1' and ballot1[9] == '1': #manual interpretation shows overvote
-                                    randomBallotError = "overvote"
-                                    o1 += 1
-                            
-                            elif ballot2[8] == '0' and ballot2[9] == '1': #tabulation shows loser vote
-                                if ballot1[8] == '1' and ballot1[9] == '0': #manual interpretation shows winner vote
-                                    randomBallotError = "undervote2"
-                                    u2 += 1
+                            randomBallotError = ballotDiscrepancy(ballot1, ballot2)
+                            if (randomBallotError == "overvote"):
+                                o1 += 1
+                            elif (randomBallotError == "overvote2"):
+                                o2 += 1
+                            elif (randomBallotError == "undervote"):
+                                u1 += 1
+                            elif (randomBallotError == "undervote2"):
+                                u2 += 1
 
                         #if files not consistent, every ballot in batch has dicsrepancy 2 
                         elif not consistent:
@@ -442,107 +926,219 @@ def auditMath(interpretation_files, lazy_list, manifest_file, tabulation_file, d
                             randomBallotError = "overvote2"
 
                         #calculate risk 
-                        discCounter=0
-                        if (randomBallotError == "overvote"):
-                            discCounter=discCounter+1
-                        elif (randomBallotError == "overvote2"):
-                            discCounter=discCounter+2
-                        elif (randomBallotError == "undervote"):
-                            discCounter=discCounter-1
-                        elif (randomBallotError == "undervote2"):
-                            discCounter=discCounter-2
+                        discCounter = discrepancyValues[randomBallotError]
+                        if compared is not None:
+                            compared[batch_name + ':' + ballot2[3]] = discCounter
                         prvRound += 1 #number of ballots examined
                         observedrisk = observedrisk * (1-(dilutedMargin/(2*gamma)))/(1-(discCounter/(2*gamma)))
+                        #both files are in CVR order, so the next manual ballot is further down the batch CVR
+                        break
                     
+    count('ballots compared', prvRound)
     return observedrisk, forced, o1, o2, u1, u2, prvRound
 
 
-def checkConsistent(manifest_file, tabulation_file, batch_name, batch_file):
+def batchMismatches(manifest_file, tabulation_file, batch_name, batch_file):
     '''
-    Check that manifest, tabulation, and cvr are all consistent in size,
-    check that cvr has unique identifiers
+    List every way the manifest, tabulation, and cvr disagree for a batch
+    Returns: list of mismatch dicts, empty if the batch is consistent
     '''
-  
-    #check that manifest, tabulation, cvr all have same batch size 
-    manBatchSize = getManInfo(manifest_file, batch_name)
-    tabBatchSize = getTabInfo(tabulation_file, batch_name, 'batch size')
-    cvrBatchSize, cvrWinnerBallots, cvrRunnerupBallots, margin = readCVR(batch_file)
+    index = getElectionIndex(manifest_file, tabulation_file)
+    cvrBatchSize, cvrWinnerBallots, cvrRunnerupBallots, unique = index.cvrInfo(batch_file)
+    return compareTotals(index.manInfo(batch_name), index.tabInfo(batch_name, 'batch size'), index.tabInfo(batch_name, 'winner size'),
+                         index.tabInfo(batch_name, 'runnerup size'), cvrBatchSize, cvrWinnerBallots, cvrRunnerupBallots, unique)
+
+def compareTotals(manBatchSize, tabBatchSize, tabWinnerBallots, tabRunnerupBallots, cvrBatchSize, cvrWinnerBallots, cvrRunnerupBallots, unique):
+    '''
+    Mismatch dicts for one batch from its manifest, tabulation and cvr totals
+    '''
+    mismatches = []
 
+    #check that manifest, tabulation, cvr all have same batch size 
     if manBatchSize != cvrBatchSize or manBatchSize != tabBatchSize:
-        print("Size mismatch "+str(manBatchSize)+", "+str(cvrBatchSize)+", "+str(tabBatchSize))
-        return False 
+        mismatches.append({'type': 'size', 'manifest': manBatchSize, 'cvr': cvrBatchSize, 'tabulation': tabBatchSize})
 
     #check that CVR winner == tab winner, CVR loser == tab loser
-    tabWinnerBallots = getTabInfo(tabulation_file, batch_name, 'winner size')
-    tabRunnerupBallots = getTabInfo(tabulation_file, batch_name, 'runnerup size')
-    
     if tabWinnerBallots != int(cvrWinnerBallots) or tabRunnerupBallots != int(cvrRunnerupBallots): 
-        print("Tabulation mismatch "+str(tabWinnerBallots)+", "+str(cvrWinnerBallots)+", "+str(tabRunnerupBallots)+", "+str(cvrRunnerupBallots))
-        return False 
+        mismatches.append({'type': 'tabulation', 'tabulationWinner': tabWinnerBallots, 'cvrWinner': cvrWinnerBallots,
+                           'tabulationRunnerup': tabRunnerupBallots, 'cvrRunnerup': cvrRunnerupBallots})
 
     #check to make sure all identifiers unique in CVR 
-    unique = uniqueCVR(batch_file)
     if not unique: 
-        print("Identifiers are not unique")
-        return False 
+        mismatches.append({'type': 'identifiers'})
+
+    return mismatches
+
+def checkConsistent(manifest_file, tabulation_file, batch_name, batch_file):
+    '''
+    Check that manifest, tabulation, and cvr are all consistent in size,
+    check that cvr has unique identifiers
+    '''
+    mismatches = batchMismatches(manifest_file, tabulation_file, batch_name, batch_file)
+    for mismatch in mismatches:
+        if mismatch['type'] == 'size':
+            print("Size mismatch "+str(mismatch['manifest'])+", "+str(mismatch['cvr'])+", "+str(mismatch['tabulation']))
+        elif mismatch['type'] == 'tabulation':
+            print("Tabulation mismatch "+str(mismatch['tabulationWinner'])+", "+str(mismatch['cvrWinner'])+", "+str(mismatch['tabulationRunnerup'])+", "+str(mismatch['cvrRunnerup']))
+        else:
+            print("Identifiers are not unique")
+
+    return len(mismatches) == 0 
+
+@timed('consistency checks: validateBatch')
+def validateBatch(manifest_file, tabulation_file, batch_file):
+    '''
+    Check one batch CVR, force it consistent if needed, and check it again
+    Runs in a worker process for validateBatches
+    Returns: dict with the batch name, mismatches found, changes forced, and whether the batch is consistent afterwards
+    '''
+    batch_name = cvrBatchName(batch_file)
+    result = {'batch': batch_name, 'file': batch_file, 'mismatches': batchMismatches(manifest_file, tabulation_file, batch_name, batch_file),
+              'forced': False, 'changes': [], 'consistent': True}
+    if result['mismatches']:
+        result['changes'] = forceConsistent(manifest_file, tabulation_file, batch_name, batch_file)
+        result['forced'] = True
+        result['consistent'] = len(batchMismatches(manifest_file, tabulation_file, batch_name, batch_file)) == 0
+    return result
+
+parallelBatches = 128 #fewest batches validateBatches starts a process pool for by default; a batch takes well under a millisecond
+
+@timed('consistency checks')
+def validateBatches(manifest_file, tabulation_file, batch_files, workers = None):
+    '''
+    Summary: Validation/repair stage run before the risk math. Every requested batch CVR is checked against the manifest and
+    tabulation, inconsistent batches are forced consistent, then checked again. Rounds with at least parallelBatches batches
+    are checked concurrently on a process pool; smaller rounds are checked serially against the ElectionIndex already cached
+    here, since starting the pool (and rebuilding the index in every worker) costs more than the checks.
+    Parameters: manifest, tabulation, batch CVR files, number of worker processes (default: one per CPU from parallelBatches
+    batches on, else 1; 1 runs serially)
+    Returns: report dict - 'batches': per-batch results from validateBatch in the order given, 'forced': names of batches forced
+             consistent, 'consistent': dict of batch file: True/False to hand to auditMath
+    '''
+    batch_files = list(batch_files)
+    if workers is None:
+        workers = (os.cpu_count() or 1) if len(batch_files) >= parallelBatches else 1
+    workers = min(workers, len(batch_files))
+
+    if workers <= 1:
+        results = [validateBatch(manifest_file, tabulation_file, batch_file) for batch_file in batch_files]
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            results = list(pool.map(validateBatch, [manifest_file]*len(batch_files), [tabulation_file]*len(batch_files), batch_files,
+                                    chunksize = max(1, len(batch_files)//(4*workers))))
+
+    for result in results:
+        if result['forced']:
+            print(result['batch'] + ' forced consistent.')
+        if not result['consistent']:
+            print(result['batch'] + ' ' + 'not consistent')
+
+    count('batches validated', len(results))
+    count('batches forced consistent', sum(1 for result in results if result['forced']))
+    report = {'batches': results,
+              'forced': [result['batch'] for result in results if result['forced']],
+              'consistent': {result['file']: result['consistent'] for result in results}}
+    return report
+
+def writeValidationReport(reports):
+    '''
+    Write the validation reports for every round so far to forceConsistentReport.json,
+    with a readable summary in forceConsistentChanges.txt
+    '''
+    with open('forceConsistentReport.json', mode = 'w') as writeReport:
+        json.dump([{'round': i + 1, 'batches': report['batches']} for i, report in enumerate(reports)], writeReport, indent = 1)
 
-    return True 
+    with open('forceConsistentChanges.txt', mode = 'w') as cvrChanges:
+        cvrChanges.write('Batches that were forcedConsistent will be logged here. \n')
+        anyForced = False
+        for report in reports:
+            for result in report['batches']:
+                if not result['forced']:
+                    continue
+                anyForced = True
+                cvrChanges.write(result['batch'] + 'CVR.csv was forced consistent. \nCheck ' + result['batch'] + 'CVR_original.csv to see CVR before forced consistent. \n')
+                for change in result['changes']:
+                    cvrChanges.write('  ' + change + '\n')
+                cvrChanges.write('\n')
+        if not anyForced:
+            cvrChanges.write('No batches were forced consistent.')
 
 def forceConsistent(manifest_file, tabulation_file, batch_name, batch_file):
     '''
     Fix any failures found in CVR in checkConisistent so that audit can run
+    Returns: list of descriptions of the changes made
     '''
-    #log forceConsistent changes
-    with open('forceConsistentChanges.txt', mode = 'a') as cvrChanges:
-        cvrChanges.write(batch_name + 'CVR.csv was forced consistent. \nCheck ' + batch_name + 'CVR_original.csv to see CVR before forced consistent. \n\n')
     #copy inconsistent CVR to new file
     batch_name = os.path.basename(batch_name)
     #batch_name = batch_name[13:]
-    copy2(batch_file,os.path.join('adaptive_rla_cvr', batch_name+'CVR_original.csv'))
+    copy2(batch_file,os.path.join('adaptive_rla_cvr', batch_name+'CVR_original.csv'+batch_file[len(stripCompression(batch_file)):]))
     
     #read contents of cvr into list to make changes
     cvrList = []
-    addedBallots = 0
-    with open(batch_file, mode= 'r', newline = '') as read_cvr:
+    with openFile(batch_file, mode= 'r', newline = '') as read_cvr:
         cvrReader = csv.reader(read_cvr)
         for i in range(4):
             next(cvrReader) #skip headers
         for row in cvrReader:
             cvrList.append(row)
 
+    index = getElectionIndex(manifest_file, tabulation_file)
+    unique = index.cvrInfo(batch_file)[3]
+    changes = forceRows(cvrList, index.manInfo(batch_name), index.tabInfo(batch_name, 'batch size'), index.tabInfo(batch_name, 'winner size'),
+                        index.tabInfo(batch_name, 'runnerup size'), unique)
+
+    #write corrected information back to cvr file 
+    with openFile(batch_file, mode='w', newline = '') as writeCVR:
+        cvrWriter = csv.writer(writeCVR)
+        writeCVRHeaders(cvrWriter)
+        cvrWriter.writerows(cvrList)
+    dropColumns(batch_file)
+
+    return changes
+
+def forceRows(cvrList, manBatchSize, tabBatchSize, tabWinnerBallots, tabRunnerupBallots, unique):
+    '''
+    Force a batch CVR, given as a list of rows, consistent with its manifest and tabulation totals
+    Returns: list of descriptions of the changes made
+    '''
+    changes = []
+    addedBallots = 0
+    cvrBatchSize = len(cvrList)
+    cvrWinnerBallots, cvrRunnerupBallots = rowMarks(cvrList)
+
     #if manifest, tabulation, cvr don't have same batch size, make equal 
-    manBatchSize = getManInfo(manifest_file, batch_name)
-    tabBatchSize = getTabInfo(tabulation_file, batch_name, 'batch size')
-    cvrBatchSize, cvrWinnerBallots, cvrRunnerupBallots, margin = readCVR(batch_file)
-    
     if manBatchSize != cvrBatchSize or manBatchSize != tabBatchSize:
         addedBallots = forceTotal(cvrList, manBatchSize, cvrBatchSize)
+        changes.append('total ballots changed from ' + str(cvrBatchSize) + ' to ' + str(len(cvrList)))
+        #recount votes, since ballots were removed or added
+        cvrWinnerBallots, cvrRunnerupBallots = rowMarks(cvrList)
 
     #if CVR winner != tab winner, change to make equal
-    tabWinnerBallots = getTabInfo(tabulation_file, batch_name, 'winner size')
-    tabRunnerupBallots = getTabInfo(tabulation_file, batch_name, 'runnerup size')
-    
     if tabWinnerBallots != int(cvrWinnerBallots):
         forceWinner(cvrList, tabWinnerBallots, int(cvrWinnerBallots))
+        changes.append('winner ballots changed from ' + str(cvrWinnerBallots) + ' to ' + str(tabWinnerBallots))
     
     # if CVR loser != tab loser, change to make equal 
     if tabRunnerupBallots != int(cvrRunnerupBallots): 
         forceRunnerup(cvrList, tabRunnerupBallots, cvrRunnerupBallots)
+        changes.append('runnerup ballots changed from ' + str(cvrRunnerupBallots) + ' to ' + str(tabRunnerupBallots))
 
     #if all identifiers not unique in CVR, change to make unique 
-    unique = uniqueCVR(batch_file)
     if not unique: 
-        addedBallots = forceUnique(cvrList, addedBallots)
+        renamed = forceUnique(cvrList, addedBallots) - addedBallots
+        addedBallots += renamed
+        if renamed > 0:
+            changes.append(str(renamed) + ' ballots with repeated identifiers given null identifiers')
 
-    #write corrected information back to cvr file 
-    with open(batch_file, mode='w', newline = '') as writeCVR:
-        cvrWriter = csv.writer(writeCVR)
-        cvrWriter.writerow(['Test'])
-        cvrWriter.writerow(['','','','','','','','','Contest 1 (vote for = 1)','Contest 1 (vote for = 1)'])
-        cvrWriter.writerow(['','','','','','','','','Winner','Runner-Up'])
-        cvrWriter.writerow(['CVRNumber','TabulatorNumber', 'BatchID','RecordID', 'ImprintedID','CountingGroup','PrecinctPortion','BallotType','',''])
-        for i in range(len(cvrList)):
-            cvrWriter.writerow(cvrList[i])
+    return changes
+
+def rowMarks(cvrList):
+    '''
+    Ballots for winner and for runnerup in a list of CVR rows, counted like readCVR and CVRColumns.totals: only rows with
+    both marks '0' or '1' count (1-1 counts for both)
+    '''
+    valid = [ballot for ballot in cvrList if ballot[8] in ('0', '1') and ballot[9] in ('0', '1')]
+    return sum(1 for ballot in valid if ballot[8] == '1'), sum(1 for ballot in valid if ballot[9] == '1')
 
 def forceTotal(cvrList, manBatchSize, cvrBatchSize):
     '''
@@ -632,70 +1228,25 @@ def uniqueCVR(cvr_file):
     '''
     Check that each ballot in batch has unique recordID, imprintedID 
     '''
-    with open(cvr_file, mode = 'r', newline = '') as readCVR:
-        cvrReader = csv.reader(readCVR)
-        #skip headers
-        for i in range(4):
-            next(cvrReader)
-
-        recordID_list = []
-        recordID_set = set()
-        imprintedID_list = []
-        imprintedID_set = set()
-
-        #add each ballot's recordID and imprintedID to respective list, set 
-        for ballot in cvrReader:
-            recordID_list.append(ballot[3])
-            recordID_set.add(ballot[3])
-            imprintedID_list.append(ballot[4])
-            imprintedID_set.add(ballot[4])
-
-        #list containing repeats would be longer than set 
-        if len(recordID_list) != len(recordID_set) or len(imprintedID_list) != len(imprintedID_set):
-            return False 
-
-    return True     
+    return loadCVR(cvr_file).unique()
 
 def getManInfo(manifest_file, batch_name):
     '''
     Returns number of ballots in specified batch from manifest  
     '''
-    #open file, skip header
-    with open(manifest_file, mode = 'r', newline = '') as readManifest:
-        manifest_reader = csv.reader(readManifest)
-        next(manifest_reader)
-
-        for ballot in manifest_reader: 
-            if ballot[2] == batch_name:
-                numBallots = int(ballot[3])
-                return numBallots
+    manifest = loadManifest(manifest_file)
+    if batch_name in manifest.batchNames:
+        return int(manifest.sizes[manifest.batchNames.index(batch_name)])
         
 def getTabInfo(tabulation_file, batch_name, info_needed):
     '''
     Returns number of ballots total, winner, or loser in specified batch from tabulation  
     '''
-    #open file, skip header
-    with open(tabulation_file, mode = 'r', newline = '') as readTabulation:
-        tabulation_reader = csv.reader(readTabulation)
-        next(tabulation_reader)
-
-        if info_needed == 'batch size':
-            for ballot in tabulation_reader: 
-                if ballot[1] == batch_name:
-                    numBallotsTotal = int(ballot[2])
-                    return numBallotsTotal
-
-        if info_needed == 'winner size':
-            for ballot in tabulation_reader: 
-                if ballot[1] == batch_name:
-                    numBallotsWinner = int(ballot[3])
-                    return numBallotsWinner
-
-        if info_needed == 'runnerup size':
-            for ballot in tabulation_reader: 
-                if ballot[1] == batch_name:
-                    numBallotsRunnerup = int(ballot[4])
-                    return numBallotsRunnerup
+    tabulation = loadTabulation(tabulation_file)
+    column = {'batch size': 0, 'winner size': 1, 'runnerup size': 2}.get(info_needed)
+    if column is not None and batch_name in tabulation.batchNames:
+        return int(tabulation.counts[tabulation.batchNames.index(batch_name)][column])
+
 def tests(jsonFile):
     '''
     Control setup/audit/simulation from terminal 
@@ -745,13 +1296,17 @@ def tests(jsonFile):
         else: 
             print('Invalid input: please enter either 1, 2, 3, or 4.')
 
-def electionSetup(E1):
+def electionSetup(E1, binary = False):
     '''
     Set up files for audit 
+    binary = True also writes electionCVR1.cvrb/electionCVR2.cvrb
     '''
     print('Election setup:')
     #call _createCVR1, _createCVR2 to write cvr1, cvr2, manifest, tabulation files 
     lazyFiles(E1)
+    if binary:
+        for cvr_file in [csvName('electionCVR1.csv'), csvName('electionCVR2.csv')]:
+            csvToBinary(cvr_file, binaryName(cvr_file))
 
 def removeWorkingDir():
     #remove files from previous run if dir exists 
@@ -760,17 +1315,22 @@ def removeWorkingDir():
     if isdir:
         rmtree(path)
 
-def electionAudit(riskLimit, o1, u1, o2, u2):
+def electionAudit(riskLimit, o1, u1, o2, u2, numTeams = 0, roundTarget = None, pause = True, speculate = False):
     '''
     Audit election
+    pause = False skips the stop for editing the files before scoring (for unattended runs)
+    Returns: risk level
+    numTeams > 0 also writes a retrieval plan (pull order by container, tabulator and batch, split into team packets) for each round
+    roundTarget (e.g. 0.9) sizes the rounds after the first for that probability of meeting the risk limit
+    speculate = True prepares the likely next rounds in the background while a round is entered
     '''
     print('Election audit:')
     removeWorkingDir()
 
     #manifest, tabulation and seed will be given by user on Michael's end
     seed1 = 2368607141
-    tabulation_file = str(os.path.join(sys.path[0], 'electionTabulation.csv'))
-    manifest_file = str(os.path.join(sys.path[0], 'electionManifest.csv'))
+    tabulation_file = str(os.path.join(sys.path[0], csvName('electionTabulation.csv')))
+    manifest_file = str(os.path.join(sys.path[0], csvName('electionManifest.csv')))
     selectedBatches = batchSelect(manifest_file, tabulation_file, seed1, o1, u1, o2, u2)
     #returns a dictionary: 
     #'batchesToAudit': set of batches that need CVR, 'ballotsPerBatch': dict w num ballots per batch to audit, 
@@ -793,6 +1353,11 @@ def electionAudit(riskLimit, o1, u1, o2, u2):
     #seed should actually be generated by user in a real invocation, this is just test code
     auditCVR_blank = ballotSelect(lazyCVR_files, selectedBatches['ballotsPerBatchAudit'], selectedBatches['ballotsPerBatchTotal'], seed2)
     #auditCVR_blank is list of files for user to enter manual vote interpretations into 
+    #drawBallots repeats the draws ballotSelect made, with repeats kept (the files list each ballot once)
+    draws = drawBallots(selectedBatches['ballotsPerBatchAudit'], selectedBatches['ballotsPerBatchTotal'], seed2)
+    if numTeams > 0:
+        retrievalPlan(draws, loadManifest(manifest_file).rows,
+                      numTeams, os.path.join(sys.path[0], 'adaptive_rla_cvr', 'retrieval_plan_r1'))
 
     auditCVR_check = ballotSelect_check(lazyCVR_files, selectedBatches['ballotsPerBatchAudit'], selectedBatches['ballotsPerBatchTotal'], seed2)
     #auditCVR_check is list of files with correct 'manual interpretations' filled out 
@@ -801,13 +1366,16 @@ def electionAudit(riskLimit, o1, u1, o2, u2):
     #this is needed to pause audit halfway to alter files if desired 
     #for example, to test forceConsistent
     #if files are coming from user (not generated by program), comment this out
-    pause = input('If desired, make changes to files now. \nThen press ENTER to continue. ')
+    if pause:
+        pause = input('If desired, make changes to files now. \nThen press ENTER to continue. ')
 
     #give manual interpretations, set of CVR files, tabulation and manifest 
-    riskLevel = calculateRisk(auditCVR_check, lazyCVR_files, tabulation_file, manifest_file, riskLimit, seed1, seed2)
+    riskLevel = calculateRisk(auditCVR_check, lazyCVR_files, tabulation_file, manifest_file, riskLimit, seed1, seed2, numTeams = numTeams, roundTarget = roundTarget,
+                              speculate = speculate, draws = draws)
     #get back risk level 
 
     print('risk level: ' + str(riskLevel))
+    return riskLevel
 
 def checkInputFiles(filesRequested, filesReceived):
     '''
@@ -818,7 +1386,7 @@ def checkInputFiles(filesRequested, filesReceived):
 
     for cvr in filesRequested: 
         #filename = expected name of CVR file 
-        filename = str(os.path.join(sys.path[0], 'adaptive_rla_cvr', cvr + 'CVR.csv'))
+        filename = str(os.path.join(sys.path[0], 'adaptive_rla_cvr', csvName(cvr + 'CVR.csv')))
         if filename not in filesReceived:
             missingFiles.append(cvr)
             fileMissing = True 
@@ -0,0 +1,277 @@
+import numpy as np
+from math import log
+from adaptive_backend import *
+from phase_timers import *
+from sweep_progress import *
+from shared_arrays import *
+from rng_streams import *
+
+#Ballot marks are stored as one code per ballot: 2*(winner mark) + (runnerup mark)
+#0 = 0-0 (undervote/no vote), 1 = 0-1 (runnerup), 2 = 1-0 (winner), 3 = 1-1 (overvote)
+markRows = [['', '', '', '', '', '', '', '', str(code >> 1), str(code & 1)] for code in range(4)]
+
+#discrepancyTable[tabulated code, manual code] = discrepancy ballotDiscrepancy gives for that pair
+discrepancyTable = np.array([[discrepancyValues[ballotDiscrepancy(markRows[manual], markRows[tabulated])] for manual in range(4)]
+                             for tabulated in range(4)], dtype = np.int64)
+
+
+class AdaptiveGeometry(object):
+    '''
+    Summary: Town and batch layout from the JSON file, in array form. Batches are numbered town by town in the same order as
+    Election.batchMaxSize, so batch b of town t is named town + str(b) like the manifest.
+    Parameters: JSON file information
+    '''
+    arrayNames = ('townPopulation', 'batchesPerTown', 'batchOffset', 'batchCapacity', 'batchTown')
+
+    def __init__(self, jsonFile):
+        E1 = Election(1, 0, 0, 0, 0, 0, jsonFile = jsonFile)
+        self.townList = list(E1.townList)
+        self.townPopulation = np.array(E1.townPopulation, dtype = np.int64)
+        self.batchesPerTown = np.array([E1.batchMaxSize[town][0] for town in self.townList], dtype = np.int64)
+        self.batchOffset = np.concatenate(([0], np.cumsum(self.batchesPerTown)[:-1]))
+        #a batch accepts ballots while its remaining size is above 0, so a fractional size rounds up
+        self.batchCapacity = np.concatenate([np.ceil(np.array(E1.batchMaxSize[town][1:], dtype = float)) for town in self.townList]).astype(np.int64)
+        self.batchTown = np.repeat(np.arange(len(self.townList)), self.batchesPerTown)
+        self.numBatches = len(self.batchCapacity)
+        self.shared = None
+
+    def share(self):
+        '''
+        Summary: Copy of the geometry with its arrays in shared memory. Sending it to a worker process pickles only the town names
+        and the block's handle, and the worker reads the publishing process's arrays in place. Call release() on it when the
+        workers are done.
+        Returns: AdaptiveGeometry (this one if shared memory is not available)
+        '''
+        if not sharedMemoryAvailable():
+            return self
+        geometry = AdaptiveGeometry.__new__(AdaptiveGeometry)
+        geometry.__setstate__({'townList': self.townList, 'numBatches': self.numBatches,
+                               'shared': SharedArrays({name: getattr(self, name) for name in self.arrayNames})})
+        return geometry
+
+    def release(self):
+        if self.shared is not None:
+            self.shared.release()
+
+    def __getstate__(self):
+        if self.shared is None:
+            return self.__dict__
+        return {'townList': self.townList, 'numBatches': self.numBatches, 'shared': self.shared}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state.get('shared') is not None:
+            for name in self.arrayNames:
+                setattr(self, name, state['shared'][name])
+
+    def batchName(self, batch):
+        town = self.batchTown[batch]
+        return self.townList[town] + str(batch - self.batchOffset[town])
+
+    def assignBatches(self, numBallots, rng):
+        '''
+        Summary: Array version of _setTownAndBatch for every ballot. Towns are drawn without replacement from the voter population,
+        then each ballot goes to a random batch in its town; ballots landing in a full batch are moved to other batches in the town.
+        Returns: batch number for every ballot
+        '''
+        townCounts = rng.multivariate_hypergeometric(self.townPopulation, numBallots)
+        ballotTown = np.repeat(np.arange(len(self.townList)), townCounts)
+        batch = self.batchOffset[ballotTown] + np.floor(rng.random(numBallots) * self.batchesPerTown[ballotTown]).astype(np.int64)
+
+        batchCounts = np.bincount(batch, minlength = self.numBatches)
+        for full in np.flatnonzero(batchCounts > self.batchCapacity):
+            town = self.batchTown[full]
+            extra = batchCounts[full] - self.batchCapacity[full]
+            moved = np.flatnonzero(batch == full)[:extra]
+            townBatches = np.arange(self.batchOffset[town], self.batchOffset[town] + self.batchesPerTown[town])
+            for ballot in moved:
+                open_ = townBatches[batchCounts[townBatches] < self.batchCapacity[townBatches]]
+                batch[ballot] = open_[rng.integers(0, len(open_))]
+                batchCounts[batch[ballot]] += 1
+                batchCounts[full] -= 1
+        return batch
+
+
+@timed('election build')
+def electionArrays(E1, geometry, rng):
+    '''
+    Summary: In-memory version of lazyFiles. Builds the true marks (what electionCVR1.csv holds), the tabulated marks after the
+    over/understatements are applied the same way createCVR2 applies them, and the batch of every ballot.
+    Parameters: Election object (after _marginOfVictory), AdaptiveGeometry, numpy Generator
+    Returns: true mark codes, tabulated mark codes, batch number per ballot
+    '''
+    truth = np.zeros(E1.numBallots, dtype = np.int8)
+    #same order as _distributeBallots: winner, runnerup, overvotes (1-1), undervotes (0-0)
+    truth[:E1.winnerBallots] = 2
+    truth[E1.winnerBallots:E1.winnerBallots + E1.runnerupBallots] = 1
+    overvotes = E1.winnerBallots + E1.runnerupBallots
+    truth[overvotes:overvotes + E1.overvotes1] = 3
+    overvotes2 = overvotes + E1.overvotes1 + E1.undervotes1
+    truth[overvotes2:overvotes2 + E1.overvotes2] = 3
+    rng.shuffle(truth)
+
+    #createCVR2: the first u1 winner ballots become 0-0, the next u2 become 0-1,
+    #the first o1 runnerup ballots become 1-1, the next o2 become 1-0
+    tabulated = truth.copy()
+    winnerPos = np.flatnonzero(truth == 2)
+    tabulated[winnerPos[:E1.undervotes1]] = 0
+    tabulated[winnerPos[E1.undervotes1:E1.undervotes1 + E1.undervotes2]] = 1
+    runnerupPos = np.flatnonzero(truth == 1)
+    tabulated[runnerupPos[:E1.overvotes1]] = 3
+    tabulated[runnerupPos[E1.overvotes1:E1.overvotes1 + E1.overvotes2]] = 2
+
+    batch = geometry.assignBatches(E1.numBallots, rng)
+    return truth, tabulated, batch
+
+
+def forceMarks(uploaded, tabWinner, tabRunnerup):
+    '''
+    Array version of forceWinner/forceRunnerup: change the first ballots in the batch until the batch CVR totals match the tabulation
+    '''
+    for bit, target in ((2, tabWinner), (1, tabRunnerup)):
+        marked = (uploaded & bit) != 0
+        count = int(marked.sum())
+        if count > target:
+            uploaded[np.flatnonzero(marked)[:count - target]] &= ~bit
+        elif count < target:
+            uploaded[np.flatnonzero(~marked)[:target - count]] |= bit
+    return uploaded
+
+
+@timed('sampling: adaptiveTrial')
+def adaptiveTrial(E1, geometry, rng, rescanErrorRate = 0, maxRounds = 10, initialEstimates = (1, 1, 1, 1)):
+    '''
+    Summary: One in-memory run of the adaptive audit: set up the election, then repeat batchSelect -> lazyCVR_gen ->
+    validate/force consistent -> ballotSelect -> compare the way AdaptiveRounds does, until the risk limit is met, the sample
+    size reaches the whole election (full hand count), or maxRounds is exceeded.
+    Rescanned batch CVRs can differ from the tabulation: each ballot in a rescanned batch is read as a different mark with
+    probability rescanErrorRate. Batches whose rescanned totals do not match the tabulation are forced consistent.
+    Parameters: Election object, AdaptiveGeometry, numpy Generator, rescan error rate, maximum rounds, initial o1, u1, o2, u2 estimates
+    Returns: dict with rounds, batches rescanned, ballots rescanned, ballots compared, draws, forced batches, full hand count
+    '''
+    E1._marginOfVictory()
+    truth, tabulated, ballotBatch = electionArrays(E1, geometry, rng)
+    numBallots = E1.numBallots
+
+    #tabulation totals per batch
+    batchSize = np.bincount(ballotBatch, minlength = geometry.numBatches)
+    tabWinner = np.bincount(ballotBatch, weights = (tabulated & 2) != 0, minlength = geometry.numBatches).astype(np.int64)
+    tabRunnerup = np.bincount(ballotBatch, weights = (tabulated & 1) != 0, minlength = geometry.numBatches).astype(np.int64)
+    winnerBallots, runnerupBallots = int(tabWinner.sum()), int(tabRunnerup.sum())
+    margin = ((winnerBallots / numBallots) - (runnerupBallots / numBallots))*100
+    dilutedMargin = margin/100
+    gamma = E1.gamma
+
+    uploaded = np.full(numBallots, -1, dtype = np.int8) #rescanned marks, filled as batches are extracted
+    extracted = np.zeros(geometry.numBatches, dtype = bool)
+    compared = np.zeros(numBallots, dtype = bool)
+    counts = np.zeros(5, dtype = np.int64) #number of ballots with discrepancy -2, -1, 0, 1, 2
+    logRisk = 0.0
+    draws = rounds = forcedBatches = 0
+    fullHandCount = False
+
+    while 1:
+        #sample size: batchSelect for the first round, AdaptiveRounds.sampleSize afterwards
+        if rounds == 0:
+            o1, u1, o2, u2 = initialEstimates
+            numToAudit = Election(numBallots, margin, o1, u1, o2, u2, E1.riskLimit, gamma)._comparisonSample(o1, u1, o2, u2, numBallots)
+        else:
+            o1, u1, o2, u2 = int(counts[3]), int(counts[1]), int(counts[4]), int(counts[0])
+            try:
+                numToAudit = Election(numBallots, margin, o1, u1, o2, u2, E1.riskLimit/np.exp(logRisk), gamma)._comparisonSample(o1, u1, o2, u2, draws)
+            except ValueError:
+                numToAudit = numBallots + 1
+        if numToAudit > numBallots:
+            fullHandCount = True
+            break
+
+        #uniform ballots with replacement = batches weighted by size, then ballots within the batch
+        sample = rng.integers(0, numBallots, numToAudit)
+        newBatches = np.unique(ballotBatch[sample])
+        newBatches = newBatches[~extracted[newBatches]]
+        for batch in newBatches:
+            members = np.flatnonzero(ballotBatch == batch)
+            rescanned = tabulated[members].copy()
+            misread = rng.random(len(members)) < rescanErrorRate
+            rescanned[misread] = (rescanned[misread] + rng.integers(1, 4, int(misread.sum()))) % 4
+            if int(((rescanned & 2) != 0).sum()) != tabWinner[batch] or int(((rescanned & 1) != 0).sum()) != tabRunnerup[batch]:
+                forceMarks(rescanned, tabWinner[batch], tabRunnerup[batch])
+                forcedBatches += 1
+            uploaded[members] = rescanned
+        extracted[newBatches] = True
+
+        disc = discrepancyTable[uploaded[sample], truth[sample]]
+        counts += np.bincount(disc + 2, minlength = 5)
+        logRisk += numToAudit*log(1-(dilutedMargin/(2*gamma))) - np.log(1-(disc/(2*gamma))).sum()
+        compared[sample] = True
+        draws += numToAudit
+        rounds += 1
+
+        if logRisk < log(E1.riskLimit) or rounds >= maxRounds:
+            break
+
+    return {'rounds': rounds, 'batchesRescanned': int(extracted.sum()), 'ballotsRescanned': int(batchSize[extracted].sum()),
+            'ballotsCompared': int(compared.sum()), 'draws': draws, 'forcedBatches': forcedBatches,
+            'fullHandCount': fullHandCount, 'riskMet': bool(logRisk < log(E1.riskLimit))}
+
+
+def adaptiveTrials(E1, geometry, seed, first, num, rescanErrorRate = 0, maxRounds = 10):
+    '''
+    Summary: Trials first, first + 1, ... of simulateAdaptive (a worker's share), trial t drawing from childGenerator(seed, t);
+    adaptiveTrials(E1, geometry, seed, t, 1) replays trial t
+    Returns: list of adaptiveTrial results
+    '''
+    trials = []
+    for trial in range(first, first + num):
+        trials.append(adaptiveTrial(E1, geometry, childGenerator(seed, trial), rescanErrorRate, maxRounds))
+        progressTrial(trials[-1]['ballotsCompared'])
+    return trials
+
+def simulateAdaptive(jsonFile, numBallots, margin, overvotes1, undervotes1, overvotes2, undervotes2, riskLimit = 0.05, gamma = 1.1,
+                     num = 1000, rescanErrorRate = 0, maxRounds = 10, seed = None, workers = 1):
+    '''
+    Summary: Runs the whole Lazy CVR pipeline (lazyFiles -> batchSelect -> lazyCVR_gen -> ballotSelect -> calculateRisk) num times
+    in memory with no files and no pauses, to estimate rescanning workload before an audit. With more than one worker the trials
+    are split between worker processes, which read the town and batch geometry from shared memory. Every trial draws from its
+    own stream of the seed, so the results do not depend on the number of workers.
+    Parameters: JSON file information, election parameters as in collectData, number of trials, rescan error rate, maximum rounds,
+    seed, number of worker processes
+    Returns: dict of numpy arrays with one entry per trial for each value adaptiveTrial returns
+    '''
+    seed = seedEntropy(seed) #fixed here so every worker derives its trials from the same seed
+    geometry = AdaptiveGeometry(jsonFile)
+    E1 = Election(numBallots, margin, overvotes1, undervotes1, overvotes2, undervotes2, riskLimit, gamma)
+    workers = max(1, min(int(workers), num))
+    if workers == 1:
+        trials = adaptiveTrials(E1, geometry, seed, 0, num, rescanErrorRate, maxRounds)
+    else:
+        sharedGeometry = geometry.share()
+        try:
+            with ProcessPoolExecutor(max_workers = workers) as pool:
+                shares = [num//workers + (worker < num % workers) for worker in range(workers)]
+                firsts = np.concatenate(([0], np.cumsum(shares)[:-1])).tolist()
+                futures = [pool.submit(adaptiveTrials, E1, sharedGeometry, seed, first, share, rescanErrorRate, maxRounds)
+                           for first, share in zip(firsts, shares)]
+                trials = [trial for future in futures for trial in future.result()]
+        finally:
+            sharedGeometry.release()
+    progressCellDone()
+    return {key: np.array([trial[key] for trial in trials]) for key in trials[0]}
+
+
+def workloadSummary(results, csv_file = None):
+    '''
+    Summary: Prints mean, stdev, median and 95th percentile of every workload value from simulateAdaptive, optionally writing
+    the same table to a CSV file
+    '''
+    rows = [['', 'Mean', 'Stdev', 'Median', '95%', 'Max']]
+    for key in ['batchesRescanned', 'ballotsRescanned', 'ballotsCompared', 'draws', 'rounds', 'forcedBatches']:
+        mean, stdev, variance = statisticsData(results[key])
+        rows.append([key, mean, stdev, np.median(results[key]), round(np.percentile(results[key], 95), 2), np.max(results[key])])
+    rows.append(['fullHandCount', round(np.mean(results['fullHandCount'])*100, 2), '', '', '', ''])
+    for row in rows:
+        print(', '.join(str(value) for value in row))
+    if csv_file is not None:
+        with open(csv_file, mode = 'w', newline = '') as writeSummary:
+            csv.writer(writeSummary).writerows(rows)
+    return rows
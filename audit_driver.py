@@ -0,0 +1,246 @@
+import adaptive_backend
+import polling_backend
+import audit_workspace
+import election_files
+import phase_timers
+from Election_Simulation import Election
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+#Headless driver: runs polling and adaptive audits from a JSON script without input() prompts and writes JSON results.
+#A script is {"workers": N, "audits": [audit, ...]} (or just the list of audits), or a folder whose subfolders each hold an
+#audit.json. Each audit runs in its own folder, which holds its election files (or gets them from "setup"):
+#  {"name": "...", "type": "polling" | "adaptive" | "rounds" | "workspace", "directory": "folder with the election files",
+#   "riskLimit": 0.05, "o1": 1, "u1": 1, "o2": 1, "u2": 1, "gamma": 1.1,
+#   "setup": {"numBallots": ..., "margin": ..., "o1": ..., "u1": ..., "o2": ..., "u2": ..., "jsonFile": "2020_CT_Election_Data.json",
+#             "seed": null}
+#            (creates the election files first, the same files every time for a given seed; jsonFile and the audit folders
+#            are relative to the script)
+#   "observations": [[winner ballots, runnerup ballots], ...]      (polling: the tally of each round)
+#   "flag": 1, "interpretations": "folder"                          (rounds/workspace own audit: folder/round<N>/ in the audit
+#                                                                    folder holds the filled-in copies of that round's blank files)
+#   "numTeams": 0, "roundTarget": null, "vectorized": false, "binary": false, "compression": "", "maxRounds": 20,
+#   "speculate": false}                                             (prepare the likely next rounds while a round is entered)
+#"adaptive" is electionAudit (simulated first round from electionCVR1, no pause), "rounds" runs the AdaptiveRounds engine from
+#the first round, "workspace" is workspaceAudit.
+
+
+def recordedObservations(rows):
+    '''
+    Summary: Observation provider for pollingAudit from recorded tallies
+    Parameters: list of [winner ballots, runnerup ballots], one per round
+    Returns: function (round number, sample size) -> (winner ballots, runnerup ballots)
+    '''
+    def observations(roundNumber, sampleSize):
+        if roundNumber > len(rows):
+            raise RuntimeError('No recorded observations for round ' + str(roundNumber) + '.')
+        return int(rows[roundNumber - 1][0]), int(rows[roundNumber - 1][1])
+    return observations
+
+def recordedInterpretations(folder):
+    '''
+    Summary: Interpretation provider for own audits (flag = 1) from recorded files: the filled-in copy of a round's blank file
+    has the same name in folder/round<N>/
+    Parameters: folder with a round<N> subfolder per round
+    Returns: function (round number, blank files) -> interpretation files
+    '''
+    def interpretations(roundNumber, blank_files):
+        recorded = []
+        for blank_file in blank_files:
+            recorded_file = os.path.join(folder, 'round' + str(roundNumber), os.path.basename(blank_file))
+            if not os.path.exists(recorded_file):
+                raise FileNotFoundError('No recorded interpretations ' + recorded_file + ' for round ' + str(roundNumber) + '.')
+            recorded.append(recorded_file)
+        return recorded
+    return interpretations
+
+@contextlib.contextmanager
+def auditDirectory(directory):
+    #the backends read and write their files in the current folder and in sys.path[0]; point both at the audit's folder
+    directory = os.path.abspath(directory)
+    cwd = os.getcwd()
+    os.makedirs(directory, exist_ok = True)
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    try:
+        yield directory
+    finally:
+        sys.path.remove(directory)
+        os.chdir(cwd)
+
+def setupElection(spec):
+    #Election object for an audit's "setup" entry
+    setup = spec['setup']
+    with open(setup.get('jsonFile', '2020_CT_Election_Data.json'), mode = 'r') as readJSON:
+        jsonFile = json.load(readJSON)
+    return Election(setup['numBallots'], setup['margin'], setup.get('o1', 0), setup.get('u1', 0), setup.get('o2', 0), setup.get('u2', 0),
+                    spec.get('riskLimit', 0.05), spec.get('gamma', 1.1), 1, jsonFile, rng = setup.get('seed'))
+
+def runRounds(spec, riskLimit, o1, u1, o2, u2):
+    '''
+    Summary: Adaptive audit on the AdaptiveRounds engine from the first round, with recorded interpretations for flag = 1
+    Returns: risk level, number of rounds
+    '''
+    adaptive_backend.removeWorkingDir()
+    flag = spec.get('flag', 0)
+    interpretations = recordedInterpretations(spec['interpretations']) if flag == 1 else None
+    engine = adaptive_backend.AdaptiveRounds(str(os.path.join(sys.path[0], election_files.csvName('electionManifest.csv'))),
+                                             str(os.path.join(sys.path[0], election_files.csvName('electionTabulation.csv'))),
+                                             riskLimit, 2368607141, 9113645654, flag, spec.get('gamma', 1.1), binary = spec.get('binary', False),
+                                             numTeams = spec.get('numTeams', 0), roundTarget = spec.get('roundTarget'),
+                                             speculate = spec.get('speculate', False))
+    observedrisk = 1
+    try:
+        while engine.roundNumber == 0 or observedrisk >= riskLimit:
+            if engine.roundNumber >= spec.get('maxRounds', 20):
+                raise RuntimeError('Risk limit not met after ' + str(engine.roundNumber) + ' rounds.')
+            interpretation_files = engine.prepareRound(o1, u1, o2, u2)
+            if interpretations is not None:
+                interpretation_files = interpretations(engine.roundNumber + 1, interpretation_files)
+            observedrisk = engine.scoreRound(interpretation_files)
+            print("In that round, risk limit =", observedrisk)
+    finally:
+        engine.stopSpeculation()
+    return observedrisk, engine.roundNumber
+
+def runAudit(spec, base_directory = '.'):
+    '''
+    Summary: Runs one audit from its script entry in its own folder, with the printed output going to audit_log.txt there
+    Parameters: audit entry, folder the entry's relative paths are relative to
+    Returns: result dict: name, type, directory, status ('complete', 'recount' or 'error'), risk, rounds, seconds, error, log
+    '''
+    directory = os.path.join(base_directory, spec.get('directory', spec.get('name', '.')))
+    result = {'name': spec.get('name', os.path.basename(os.path.abspath(directory))), 'type': spec.get('type', 'adaptive'),
+              'directory': os.path.abspath(directory), 'status': 'error', 'risk': None, 'rounds': None, 'seconds': None, 'error': None}
+    riskLimit = spec.get('riskLimit', 0.05)
+    o1, u1, o2, u2 = (spec.get(key, 1) for key in ('o1', 'u1', 'o2', 'u2'))
+    if 'setup' in spec:
+        #the election data file is relative to the script, like the audit folders
+        spec = dict(spec, setup = dict(spec['setup'], jsonFile = os.path.abspath(os.path.join(base_directory, spec['setup'].get('jsonFile', '2020_CT_Election_Data.json')))))
+    start = time.time()
+    with auditDirectory(directory) as folder, phase_timers.phase('audit: ' + str(result['type'])):
+        result['log'] = os.path.join(folder, 'audit_log.txt')
+        if 'interpretations' in spec:
+            spec = dict(spec, interpretations = os.path.join(folder, spec['interpretations']))
+        election_files.setCompression(spec.get('compression', ''))
+        with open(result['log'], mode = 'w') as log, contextlib.redirect_stdout(log):
+            try:
+                if result['type'] == 'polling':
+                    observations = recordedObservations(spec.get('observations', []))
+                    if 'setup' in spec:
+                        risk = polling_backend.pollingAudit(setupElection(spec), 1, spec.get('vectorized', False), spec.get('numTeams', 0),
+                                                            spec.get('roundTarget'), observations, spec.get('speculate', False))
+                    else:
+                        risk = polling_backend.pollingAudit(Election(1, 0, 0, 0, 0, 0, riskLimit), 0, spec.get('vectorized', False),
+                                                            spec.get('numTeams', 0), spec.get('roundTarget'), observations, spec.get('speculate', False))
+                    rounds = None
+                else:
+                    if 'setup' in spec:
+                        adaptive_backend.electionSetup(setupElection(spec), spec.get('binary', False))
+                    if result['type'] == 'adaptive':
+                        risk = adaptive_backend.electionAudit(riskLimit, o1, u1, o2, u2, spec.get('numTeams', 0), spec.get('roundTarget'), pause = False,
+                                                              speculate = spec.get('speculate', False))
+                        if risk is None:
+                            raise FileNotFoundError('Batch CVR files are missing.')
+                        rounds = None
+                    elif result['type'] == 'rounds':
+                        risk, rounds = runRounds(spec, riskLimit, o1, u1, o2, u2)
+                    elif result['type'] == 'workspace':
+                        flag = spec.get('flag', 0)
+                        risk = audit_workspace.workspaceAudit(riskLimit, o1, u1, o2, u2, spec.get('db_file', 'auditWorkspace.db'), flag,
+                                                              numTeams = spec.get('numTeams', 0), roundTarget = spec.get('roundTarget'),
+                                                              interpretations = recordedInterpretations(spec['interpretations']) if flag == 1 else None)
+                        rounds = None
+                    else:
+                        raise ValueError('Unknown audit type ' + str(result['type']) + '.')
+                result['status'] = 'complete'
+                result['risk'] = risk
+                result['rounds'] = rounds
+            except ValueError as error:
+                #the backends raise ValueError when the audit has to go to a full hand count
+                result['status'] = 'recount' if 'recount' in str(error) or 'hand' in str(error) else 'error'
+                result['error'] = str(error)
+                traceback.print_exc(file = log)
+            except Exception as error:
+                result['error'] = type(error).__name__ + ': ' + str(error)
+                traceback.print_exc(file = log)
+            finally:
+                election_files.setCompression('')
+                #the audit's files are not read again; later audits would otherwise keep them in the file caches
+                election_files.clearCaches()
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+def readScript(script):
+    '''
+    Summary: Reads a driver script: a JSON file, or a folder whose subfolders each hold an audit.json
+    Returns: list of audit entries, number of workers from the script (None if not given), folder relative paths start from
+    '''
+    if os.path.isdir(script):
+        audits = []
+        for name in sorted(os.listdir(script)):
+            audit_file = os.path.join(script, name, 'audit.json')
+            if os.path.exists(audit_file):
+                with open(audit_file, mode = 'r') as readAudit:
+                    audit = json.load(readAudit)
+                audit.setdefault('name', name)
+                audit.setdefault('directory', name)
+                audits.append(audit)
+        return audits, None, script
+    with open(script, mode = 'r') as readScript:
+        content = json.load(readScript)
+    if isinstance(content, list):
+        return content, None, os.path.dirname(os.path.abspath(script))
+    return content['audits'], content.get('workers'), os.path.dirname(os.path.abspath(script))
+
+def runScript(script, results_file = None, workers = None):
+    '''
+    Summary: Runs every audit in a script back to back, or concurrently on a pool of worker processes (each audit has its own
+    folder, so audits in different processes do not share files), and writes the results as JSON
+    Parameters: script file or folder, results file (default audit_results.json next to the script), number of worker processes
+    (default: the script's "workers", else 1)
+    Returns: results dict
+    '''
+    audits, scriptWorkers, base_directory = readScript(script)
+    workers = workers or scriptWorkers or 1
+    start = time.time()
+    if workers > 1 and len(audits) > 1:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = list(executor.map(runAudit, audits, [base_directory]*len(audits)))
+    else:
+        results = [runAudit(audit, base_directory) for audit in audits]
+
+    summary = {'script': os.path.abspath(script), 'workers': workers, 'seconds': round(time.time() - start, 3), 'audits': results,
+               'complete': sum(result['status'] == 'complete' for result in results),
+               'recount': sum(result['status'] == 'recount' for result in results),
+               'error': sum(result['status'] == 'error' for result in results)}
+    if results_file is None:
+        results_file = os.path.join(base_directory, 'audit_results.json')
+    with open(results_file, mode = 'w') as writeResults:
+        json.dump(summary, writeResults, indent = 1)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run polling and adaptive audits from a JSON script without prompts.')
+    parser.add_argument('script', help = 'JSON script, or a folder of audit folders each holding an audit.json')
+    parser.add_argument('--results', help = 'results file (default audit_results.json next to the script)')
+    parser.add_argument('--workers', type = int, help = 'number of worker processes')
+    parser.add_argument('--profile', help = 'write per-phase times and counters of all processes to this JSON file')
+    args = parser.parse_args()
+    if args.profile:
+        phase_timers.enableProfiling(args.profile)
+    summary = runScript(args.script, args.results, args.workers)
+    print(str(summary['complete']) + ' complete, ' + str(summary['recount']) + ' recount, ' + str(summary['error']) + ' error in ' +
+          str(summary['seconds']) + ' seconds')
+    if phase_timers.profilingEnabled():
+        phase_timers.writeProfile()
+        print('Check ' + phase_timers.profiling['file'] + ' for the time spent in each phase.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+import sqlite3
+from adaptive_backend import *
+
+#CVR columns in file order; vote marks are kept as the same '0'/'1' strings the CSV files use
+cvrColumns = ['cvr_number', 'tabulator', 'batch', 'record_id', 'imprinted_id', 'counting_group', 'precinct', 'ballot_type', 'winner', 'runnerup']
+
+workspaceSchema = '''
+CREATE TABLE IF NOT EXISTS cvr (source TEXT, cvr_number TEXT, tabulator TEXT, batch TEXT, record_id TEXT, imprinted_id TEXT,
+                                counting_group TEXT, precinct TEXT, ballot_type TEXT, winner TEXT, runnerup TEXT);
+CREATE INDEX IF NOT EXISTS cvr_batch ON cvr (source, batch, record_id);
+CREATE TABLE IF NOT EXISTS manifest (container TEXT, tabulator TEXT, batch TEXT PRIMARY KEY, ballots INTEGER);
+CREATE TABLE IF NOT EXISTS tabulation (town TEXT, batch TEXT PRIMARY KEY, size INTEGER, winner INTEGER, runnerup INTEGER);
+CREATE TABLE IF NOT EXISTS selections (round INTEGER, batch TEXT, record_id TEXT, draws INTEGER, PRIMARY KEY (round, batch, record_id));
+CREATE TABLE IF NOT EXISTS interpretations (batch TEXT, record_id TEXT, cvr_number TEXT, winner TEXT, runnerup TEXT, PRIMARY KEY (batch, record_id));
+CREATE TABLE IF NOT EXISTS batches (batch TEXT PRIMARY KEY, round INTEGER, consistent INTEGER);
+CREATE TABLE IF NOT EXISTS force_log (round INTEGER, batch TEXT, change TEXT);
+CREATE INDEX IF NOT EXISTS force_log_batch ON force_log (batch);
+CREATE TABLE IF NOT EXISTS tabulation_log (batch TEXT, change TEXT);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+class AuditWorkspace(object):
+    '''
+    Summary: Single SQLite database holding everything an adaptive audit otherwise keeps in adaptive_rla_cvr/ and the election csv files.
+    CVR rows are stored in one table with a source column: 'cvr2' (the election CVR), 'cvr1' (simulated manual interpretations),
+    'batch' (extracted/uploaded batch CVRs) and 'original' (batch CVRs before they were forced consistent).
+    Has the manifestTotals/tabulationTotals/manInfo/tabInfo methods of ElectionIndex, so it can be passed to selectBatches.
+    Parameters: database file path
+    '''
+    def __init__(self, db_file = 'auditWorkspace.db'):
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file)
+        self.db.executescript(workspaceSchema)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def reset(self):
+        #start a new audit: clear every table
+        with self.db:
+            for table in ['cvr', 'manifest', 'tabulation', 'selections', 'interpretations', 'batches', 'force_log', 'tabulation_log', 'state']:
+                self.db.execute('DELETE FROM ' + table)
+
+    #Import/export in the existing CSV layouts
+    def importCVR(self, cvr_file, source, batches = None):
+        '''
+        Load a CVR file (4 header lines) under the given source, optionally only the rows for the given batches
+        Returns: number of rows loaded
+        '''
+        with openFile(cvr_file, mode = 'r', newline = '') as readCVR:
+            CVRreader = csv.reader(readCVR)
+            for i in range(4):
+                next(CVRreader)
+            rows = ([source] + ballot[:10] for ballot in CVRreader if batches is None or ballot[2] in batches)
+            with self.db:
+                count = self.db.executemany('INSERT INTO cvr VALUES (?,?,?,?,?,?,?,?,?,?,?)', rows).rowcount
+        return count
+
+    def exportCVR(self, cvr_file, source, batch = None, recordIDs = None, blank = False):
+        '''
+        Write rows of a source (optionally one batch, and only the given recordIDs) as a CVR file; blank leaves out the vote columns
+        '''
+        with openFile(cvr_file, mode = 'w', newline = '') as writeCVR:
+            CVRwriter = csv.writer(writeCVR)
+            writeCVRHeaders(CVRwriter)
+            for ballot in self.cvrRows(source, batch):
+                if recordIDs is None or ballot[3] in recordIDs:
+                    CVRwriter.writerow(ballot[:8] if blank else ballot)
+
+    def cvrRows(self, source, batch = None):
+        #rows in the order they were loaded, as lists in the CSV column order
+        if batch is None:
+            cursor = self.db.execute('SELECT ' + ', '.join(cvrColumns) + ' FROM cvr WHERE source = ? ORDER BY rowid', (source,))
+        else:
+            cursor = self.db.execute('SELECT ' + ', '.join(cvrColumns) + ' FROM cvr WHERE source = ? AND batch = ? ORDER BY rowid', (source, batch))
+        return [list(ballot) for ballot in cursor]
+
+    def importManifest(self, manifest_file):
+        with openFile(manifest_file, mode = 'r', newline = '') as readManifest:
+            manifest_reader = csv.reader(readManifest)
+            next(manifest_reader)
+            with self.db:
+                self.db.execute('DELETE FROM manifest')
+                self.db.executemany('INSERT INTO manifest VALUES (?,?,?,?)', (row[:4] for row in manifest_reader))
+
+    def exportManifest(self, manifest_file):
+        with openFile(manifest_file, mode = 'w', newline = '') as writeManifest:
+            manifestWriter = csv.writer(writeManifest)
+            manifestWriter.writerow(['Container', 'Tabulator', 'Batch Name', 'Number of Ballots'])
+            manifestWriter.writerows(self.db.execute('SELECT container, tabulator, batch, ballots FROM manifest ORDER BY rowid'))
+
+    def importTabulation(self, tabulation_file):
+        with openFile(tabulation_file, mode = 'r', newline = '') as readTabulation:
+            tabulation_reader = csv.reader(readTabulation)
+            next(tabulation_reader)
+            with self.db:
+                self.db.execute('DELETE FROM tabulation')
+                self.db.executemany('INSERT INTO tabulation VALUES (?,?,?,?,?)', (row[:5] for row in tabulation_reader))
+
+    def exportTabulation(self, tabulation_file):
+        with openFile(tabulation_file, mode = 'w', newline = '') as writeTabulation:
+            tabulationWriter = csv.writer(writeTabulation)
+            tabulationWriter.writerow(['Town', 'BatchNum', 'Size', 'Winner', 'Loser'])
+            tabulationWriter.writerows(self.db.execute('SELECT town, batch, size, winner, runnerup FROM tabulation ORDER BY rowid'))
+
+    def importInterpretations(self, interpretation_files):
+        '''
+        Load filled-in manual interpretation files (blank CVRs with the vote columns added)
+        '''
+        with self.db:
+            for interpretation_file in interpretation_files:
+                with openFile(interpretation_file, mode = 'r', newline = '') as readManualVotes:
+                    manualVotesReader = csv.reader(readManualVotes)
+                    for i in range(4):
+                        next(manualVotesReader)
+                    self.db.executemany('INSERT OR REPLACE INTO interpretations VALUES (?,?,?,?,?)',
+                                        ((ballot[2], ballot[3], ballot[0], ballot[8], ballot[9]) for ballot in manualVotesReader))
+
+    def importElection(self, manifest_file, tabulation_file, cvr2_file, cvr1_file = None):
+        '''
+        Load the manifest, tabulation and election CVR (and, for a simulated audit, electionCVR1.csv as manual interpretations)
+        '''
+        self.importManifest(manifest_file)
+        self.importTabulation(tabulation_file)
+        self.importCVR(cvr2_file, 'cvr2')
+        if cvr1_file is not None:
+            self.importCVR(cvr1_file, 'cvr1')
+
+    def manifestRows(self):
+        #manifest rows in file order, as text like ManifestColumns.rows
+        return [[container, tabulator, batch, str(ballots)] for container, tabulator, batch, ballots in
+                self.db.execute('SELECT container, tabulator, batch, ballots FROM manifest ORDER BY rowid')]
+
+    #Same interface as ElectionIndex
+    def manifestTotals(self):
+        rows = self.db.execute('SELECT batch, ballots FROM manifest ORDER BY rowid').fetchall()
+        batchNames = [row[0] for row in rows]
+        batchSizes = [int(row[1]) for row in rows]
+        ballotsPerBatchTotal = {row[0]: str(row[1]) for row in rows}
+        return sum(batchSizes), batchNames, batchSizes, ballotsPerBatchTotal
+
+    def tabulationTotals(self):
+        numBallots, winnerBallots, runnerupBallots = self.db.execute('SELECT SUM(size), SUM(winner), SUM(runnerup) FROM tabulation').fetchone()
+        margin = ((winnerBallots / numBallots) - (runnerupBallots / numBallots))*100
+        return numBallots, winnerBallots, runnerupBallots, margin
+
+    def manInfo(self, batch_name):
+        row = self.db.execute('SELECT ballots FROM manifest WHERE batch = ?', (batch_name,)).fetchone()
+        return None if row is None else int(row[0])
+
+    def tabInfo(self, batch_name, info_needed):
+        column = {'batch size': 'size', 'winner size': 'winner', 'runnerup size': 'runnerup'}[info_needed]
+        row = self.db.execute('SELECT ' + column + ' FROM tabulation WHERE batch = ?', (batch_name,)).fetchone()
+        return None if row is None else int(row[0])
+
+    #Audit steps
+    def correctTabulation(self):
+        '''
+        Same corrections as correctTabulation, logged to the tabulation_log table
+        Returns: list of changes made
+        '''
+        changes = []
+        with self.db:
+            for batch, size, ballots in self.db.execute('SELECT t.batch, t.size, m.ballots FROM tabulation t JOIN manifest m ON t.batch = m.batch '
+                                                        'WHERE t.size != m.ballots ORDER BY t.rowid').fetchall():
+                changes.append((batch, batch + ' had total ballots changed from ' + str(size) + ' to ' + str(ballots)))
+                self.db.execute('UPDATE tabulation SET size = ? WHERE batch = ?', (ballots, batch))
+            for column, name in (('winner', 'winner'), ('runnerup', 'runnerup')):
+                for batch, votes, size in self.db.execute('SELECT batch, ' + column + ', size FROM tabulation WHERE ' + column + ' > size ORDER BY rowid').fetchall():
+                    changes.append((batch, batch + ' had ' + name + ' ballots changed from ' + str(votes) + ' to ' + str(size)))
+                    self.db.execute('UPDATE tabulation SET ' + column + ' = size WHERE batch = ?', (batch,))
+            self.db.executemany('INSERT INTO tabulation_log VALUES (?,?)', changes)
+        return [change[1] for change in changes]
+
+    def extractBatches(self, batches, roundNumber):
+        '''
+        Copy the election CVR rows of the given batches into the 'batch' source (what lazyCVR_gen writes as <batch>CVR.csv)
+        In a real audit the uploaded batch CVRs are loaded with importCVR(file, 'batch') instead
+        '''
+        batches = sorted(batches)
+        with self.db:
+            for batch in batches:
+                self.db.execute('INSERT INTO cvr SELECT \'batch\', ' + ', '.join(cvrColumns) + ' FROM cvr WHERE source = \'cvr2\' AND batch = ? ORDER BY rowid', (batch,))
+            self.db.executemany('INSERT OR IGNORE INTO batches VALUES (?,?,NULL)', ((batch, roundNumber) for batch in batches))
+        return batches
+
+    def batchTotals(self, batches):
+        #batch: [ballots, winner, runnerup, unique identifiers] for the 'batch' source
+        totals = {}
+        for batch in batches:
+            count, winner, runnerup, records, imprinted = self.db.execute(
+                'SELECT COUNT(*), TOTAL(winner = \'1\' AND runnerup IN (\'0\', \'1\')), TOTAL(runnerup = \'1\' AND winner IN (\'0\', \'1\')), '
+                'COUNT(DISTINCT record_id), COUNT(DISTINCT imprinted_id) '
+                'FROM cvr WHERE source = \'batch\' AND batch = ?', (batch,)).fetchone()
+            totals[batch] = [count, int(winner), int(runnerup), count == records and count == imprinted]
+        return totals
+
+    def _mismatches(self, batch, totals):
+        count, winner, runnerup, unique = totals.get(batch, [0, 0, 0, True])
+        return compareTotals(self.manInfo(batch), self.tabInfo(batch, 'batch size'), self.tabInfo(batch, 'winner size'),
+                             self.tabInfo(batch, 'runnerup size'), count, winner, runnerup, unique)
+
+    def validateBatches(self, batches, roundNumber):
+        '''
+        validateBatches for the 'batch' source: check every batch against the manifest and tabulation, force inconsistent batches
+        consistent (keeping the rows before the change under 'original'), and check them again
+        Returns: report dict in the same form as validateBatches, keyed by batch name
+        '''
+        batches = sorted(batches)
+        totals = self.batchTotals(set(batches))
+        results = []
+        with self.db:
+            for batch in batches:
+                result = {'batch': batch, 'file': batch, 'mismatches': self._mismatches(batch, totals), 'forced': False, 'changes': [], 'consistent': True}
+                if result['mismatches']:
+                    cvrList = self.cvrRows('batch', batch)
+                    self.db.executemany('INSERT INTO cvr VALUES (?,?,?,?,?,?,?,?,?,?,?)', (['original'] + ballot for ballot in cvrList))
+                    result['changes'] = forceRows(cvrList, self.manInfo(batch), self.tabInfo(batch, 'batch size'), self.tabInfo(batch, 'winner size'),
+                                                  self.tabInfo(batch, 'runnerup size'), totals.get(batch, [0, 0, 0, True])[3])
+                    self.db.execute('DELETE FROM cvr WHERE source = ? AND batch = ?', ('batch', batch))
+                    self.db.executemany('INSERT INTO cvr VALUES (?,?,?,?,?,?,?,?,?,?,?)', (['batch'] + ballot for ballot in cvrList))
+                    self.db.executemany('INSERT INTO force_log VALUES (?,?,?)', ((roundNumber, batch, change) for change in result['changes']))
+                    result['forced'] = True
+                    result['consistent'] = len(self._mismatches(batch, self.batchTotals({batch}))) == 0
+                self.db.execute('UPDATE batches SET consistent = ? WHERE batch = ?', (int(result['consistent']), batch))
+                results.append(result)
+
+        for result in results:
+            if result['forced']:
+                print(result['batch'] + ' forced consistent.')
+            if not result['consistent']:
+                print(result['batch'] + ' ' + 'not consistent')
+        return {'batches': results,
+                'forced': [result['batch'] for result in results if result['forced']],
+                'consistent': {result['batch']: result['consistent'] for result in results}}
+
+    def recordSelections(self, roundNumber, draws):
+        #draws: batch name: list of recordIDs drawn, repeats kept
+        rows = {}
+        for batch in draws:
+            for recordID in draws[batch]:
+                rows[(batch, str(recordID))] = rows.get((batch, str(recordID)), 0) + 1
+        self.db.executemany('INSERT OR REPLACE INTO selections VALUES (?,?,?,?)', ((roundNumber, key[0], key[1], rows[key]) for key in rows))
+
+    def copyInterpretations(self, newBallots):
+        #simulated manual interpretations from the 'cvr1' source, for the ballots that still need one
+        for batch in newBallots:
+            self.db.executemany('INSERT OR REPLACE INTO interpretations SELECT batch, record_id, cvr_number, winner, runnerup FROM cvr '
+                                'WHERE source = \'cvr1\' AND batch = ? AND record_id = ?', ((batch, recordID) for recordID in newBallots[batch]))
+
+    def interpretationRows(self, batches = None):
+        #'batch:recordID': manual interpretation row in CVR column order (only batch, recordID and the vote columns are filled)
+        manualVotes = {}
+        for batch, recordID, cvrNumber, winner, runnerup in self.db.execute('SELECT batch, record_id, cvr_number, winner, runnerup FROM interpretations'):
+            if batches is None or batch in batches:
+                manualVotes[batch + ':' + recordID] = [cvrNumber, '', batch, recordID, '', '', '', '', winner, runnerup]
+        return manualVotes
+
+    def forceLog(self):
+        #batch: list of changes forced, in the order they were made
+        log = {}
+        for batch, change in self.db.execute('SELECT batch, change FROM force_log ORDER BY rowid'):
+            log.setdefault(batch, []).append(change)
+        return log
+
+    def saveState(self, state):
+        #written in the same transaction as anything else done since the last save
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO state VALUES (?,?)', ('rounds', json.dumps(state)))
+
+    def loadState(self):
+        row = self.db.execute('SELECT value FROM state WHERE key = ?', ('rounds',)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+
+class WorkspaceRounds(AdaptiveRounds):
+    '''
+    Summary: AdaptiveRounds backed by an AuditWorkspace instead of files. Batches are extracted, validated and forced consistent
+    with indexed inserts/updates, selections and interpretations are rows instead of per-batch files, and the round state is
+    committed with them so an interrupted audit resumes from the last completed step.
+    Parameters: AuditWorkspace, risk limit, seeds for batch and ballot selection, flag (0 for simulated audit, 1 for own audit),
+    gamma, resume (True to continue from the state saved in the workspace), numTeams (> 0 to write a retrieval plan each round),
+    roundTarget (stopping probability later rounds are sized for)
+    '''
+    def __init__(self, workspace, riskLimit, seed1, seed2, flag = 0, gamma = 1.1, resume = False, numTeams = 0, roundTarget = None):
+        AdaptiveRounds.__init__(self, workspace.db_file, workspace.db_file, riskLimit, seed1, seed2, flag, gamma, numTeams = numTeams, roundTarget = roundTarget)
+        self.workspace = workspace
+        if resume and workspace.loadState() is not None:
+            self.load()
+
+    def save(self):
+        self.workspace.saveState(self._state())
+
+    def load(self):
+        state = self.workspace.loadState()
+        for key in state:
+            setattr(self, key, state[key])
+
+    def _manifestRows(self):
+        return self.workspace.manifestRows()
+
+    def _totals(self):
+        return self.workspace.tabulationTotals()
+
+    def _selectBatches(self, nextRound, overvotes1, undervotes1, overvotes2, undervotes2):
+        if self.roundNumber == 0:
+            #same steps as batchSelect
+            for change in self.workspace.correctTabulation():
+                print(change)
+            numBallots, winnerBallots, runnerupBallots, margin = self._totals()
+            E1 = Election(numBallots, margin, overvotes1, undervotes1, overvotes2, undervotes2)
+            numToAudit = E1._comparisonSample(overvotes1, undervotes1, overvotes2, undervotes2, numBallots)
+            if numToAudit > numBallots:
+                raise ValueError('Sample is larger than population or is negative. Go to full hand recount.')
+            return selectBatches(None, numToAudit, self.seed1, self.workspace)
+        return selectBatches(None, self.sampleSize(), roundSeed(self.seed1, nextRound), self.workspace)
+
+    def _extractBatches(self, newBatches):
+        batches = self.workspace.extractBatches(newBatches, self.roundNumber + 1)
+        for batch in batches:
+            self.batchFiles[batch] = batch
+        return batches
+
+    def _validate(self, batches):
+        report = self.workspace.validateBatches(batches, self.roundNumber + 1)
+        self.consistency.update(report['consistent'])
+        self.validationReports.append(report)
+
+    def _writeBlankFiles(self, newBallots, roundNumber):
+        self.workspace.recordSelections(roundNumber, self.pending)
+        blank_files = []
+        os.makedirs(os.path.join(sys.path[0], 'adaptive_rla_cvr'), exist_ok = True)
+        for batch in sorted(newBallots):
+            new_filename_blank = str(os.path.join(sys.path[0], 'adaptive_rla_cvr', csvName(batch + 'CVR_blank_r' + str(roundNumber) + '.csv')))
+            self.workspace.exportCVR(new_filename_blank, 'batch', batch, newBallots[batch], blank = True)
+            blank_files.append(new_filename_blank)
+        return blank_files
+
+    def _writeCheckFiles(self, newBallots, roundNumber):
+        #a simulated audit copies the manual interpretations inside the workspace, no files are written
+        self.workspace.recordSelections(roundNumber, self.pending)
+        self.workspace.copyInterpretations(newBallots)
+        return []
+
+    def scoreRound(self, interpretation_files = None):
+        '''
+        Load any filled-in interpretation files, then score the pending round from the workspace
+        Returns: observed risk
+        '''
+        if interpretation_files:
+            self.workspace.importInterpretations(interpretation_files)
+        return AdaptiveRounds.scoreRound(self, interpretation_files)
+
+    def _manualVotes(self, interpretation_files):
+        return self.workspace.interpretationRows(set(self.pending))
+
+    def _batchVotes(self, batch):
+        return {ballot[3]: ballot for ballot in self.workspace.cvrRows('batch', batch)}
+
+
+def workspaceAudit(riskLimit, o1, u1, o2, u2, db_file = 'auditWorkspace.db', flag = 0, resume = False, numTeams = 0, roundTarget = None,
+                   interpretations = None):
+    '''
+    Summary: electionAudit run against an AuditWorkspace. Loads electionManifest.csv, electionTabulation.csv and electionCVR2.csv
+    (and electionCVR1.csv as the manual interpretations when flag = 0), then runs rounds until the risk limit is met.
+    With resume = True the audit continues from the state stored in db_file. numTeams > 0 writes a retrieval plan every round.
+    roundTarget (e.g. 0.9) sizes later rounds for that probability of meeting the risk limit.
+    interpretations: for flag = 1, a function (round number, blank files) -> filled-in interpretation files, used instead of
+    pausing for the user.
+    Returns: risk level
+    '''
+    print('Election audit:')
+    seed1 = 2368607141
+    seed2 = 9113645654
+    workspace = AuditWorkspace(db_file)
+    if not resume or workspace.loadState() is None:
+        workspace.reset()
+        workspace.importElection(str(os.path.join(sys.path[0], csvName('electionManifest.csv'))), str(os.path.join(sys.path[0], csvName('electionTabulation.csv'))),
+                                 str(os.path.join(sys.path[0], csvName('electionCVR2.csv'))),
+                                 str(os.path.join(sys.path[0], csvName('electionCVR1.csv'))) if flag == 0 else None)
+
+    engine = WorkspaceRounds(workspace, riskLimit, seed1, seed2, flag, resume = resume, numTeams = numTeams, roundTarget = roundTarget)
+    observedrisk = engine.observedrisk() if engine.roundNumber > 0 else 1
+    while engine.roundNumber == 0 or observedrisk >= riskLimit:
+        if engine.pending is None:
+            interpretation_files = engine.prepareRound(o1, u1, o2, u2)
+        else:
+            #interrupted after the ballots were drawn; the interpretations are already in the workspace or in the blank files
+            interpretation_files = [blank_file for blank_file in sorted(str(os.path.join(sys.path[0], 'adaptive_rla_cvr', csvName(batch + 'CVR_blank_r' + str(engine.roundNumber + 1) + '.csv')))
+                                    for batch in engine.pending) if os.path.exists(blank_file)] if flag == 1 else []
+        if (flag == 1 and interpretations is not None):
+            interpretation_files = interpretations(engine.roundNumber + 1, interpretation_files)
+        elif (flag == 1):
+            pause = input('Blank CVR files have been generated. Please fill in your interpretations. \nThen press ENTER to continue. ')
+        observedrisk = engine.scoreRound(interpretation_files)
+        print("In that round, risk limit =", observedrisk)
+        if observedrisk >= riskLimit:
+            print("Risk limit not met in current round, starting next round.")
+            print("")
+
+    workspace.close()
+    print('risk level: ' + str(observedrisk))
+    return observedrisk
@@ -0,0 +1,170 @@
+import struct
+import numpy as np
+from election_files import *
+
+#Binary CVR layout (little-endian):
+#  header (32 bytes): magic b'CVRB', version, record size, number of records, offset of the string table
+#  records: one fixed-width binaryRecord per ballot, in CSV order, so ballot i is at 32 + i*record size
+#  string table: JSON {'headers': the 4 CSV header lines, 'strings': every distinct text value}
+#Text columns are stored as codes into the string table. CVRNumber and RecordID are stored as their integer value when the
+#text is a plain integer, otherwise as -(string code + 1) (e.g. the null identifiers added by forceConsistent).
+binaryMagic = b'CVRB'
+binaryVersion = 1
+binaryHeader = struct.Struct('<4sHHQQQ')
+binaryHeaderSize = 32
+binaryRecord = np.dtype([('cvrNumber', '<i8'), ('recordID', '<i8'), ('batch', '<u4'), ('imprintedID', '<u4'), ('tabulator', '<u4'),
+                         ('countingGroup', '<u4'), ('precinct', '<u4'), ('ballotType', '<u4'), ('winner', 'u1'), ('runnerup', 'u1')])
+codedColumns = {2: 'batch', 4: 'imprintedID', 1: 'tabulator', 5: 'countingGroup', 6: 'precinct', 7: 'ballotType'}
+numberColumns = {0: 'cvrNumber', 3: 'recordID'}
+
+
+def csvToBinary(csv_file, binary_file):
+    '''
+    Summary: Converts a CVR in the 4-header-line CSV layout to the binary layout
+    Parameters: CSV file path, binary file path
+    Returns: number of ballots written
+    '''
+    with openFile(csv_file, mode = 'r', newline = '') as readCVR:
+        CVRreader = csv.reader(readCVR)
+        headers = [next(CVRreader, []) for i in range(4)]
+    numBallots, columns = readColumns(csv_file, 4, 10)
+
+    strings = {} #text: code in the string table
+    records = np.zeros(numBallots, dtype = binaryRecord)
+    for column, field in codedColumns.items():
+        records[field] = [strings.setdefault(value, len(strings)) for value in columns[column]]
+    for column, field in numberColumns.items():
+        records[field] = [int(value) if value.isdecimal() and str(int(value)) == value else -(strings.setdefault(value, len(strings)) + 1)
+                          for value in columns[column]]
+    for column, field in ((8, 'winner'), (9, 'runnerup')):
+        marks = np.asarray(columns[column])
+        if numBallots and not np.isin(marks, ['0', '1']).all():
+            raise ValueError(csv_file + ' has vote marks other than 0/1, which the binary CVR layout cannot hold.')
+        records[field] = marks == '1'
+
+    stringTable = json.dumps({'headers': headers, 'strings': list(strings)}).encode()
+    with open(binary_file, mode = 'wb') as writeCVR:
+        writeCVR.write(binaryHeader.pack(binaryMagic, binaryVersion, binaryRecord.itemsize, numBallots,
+                                         binaryHeaderSize + records.nbytes, 0).ljust(binaryHeaderSize, b'\0'))
+        writeCVR.write(records.tobytes())
+        writeCVR.write(stringTable)
+    return numBallots
+
+def binaryToCSV(binary_file, csv_file):
+    '''
+    Summary: Converts a binary CVR back to the 4-header-line CSV layout
+    Parameters: binary file path, CSV file path
+    '''
+    cvr = BinaryCVR(binary_file)
+    with openFile(csv_file, mode = 'w', newline = '') as writeCVR:
+        CVRwriter = csv.writer(writeCVR)
+        CVRwriter.writerows(cvr.headers)
+        for start in range(0, len(cvr), 65536):
+            CVRwriter.writerows(cvr.rows(np.arange(start, min(start + 65536, len(cvr)))))
+    cvr.close()
+
+
+class BinaryCVR(object):
+    '''
+    Summary: Memory-mapped reader for a binary CVR. Ballot i is read in O(1) without parsing the rest of the file; the mark,
+    batch and identifier columns are numpy views of the mapped records.
+    Parameters: binary file path
+    '''
+    def __init__(self, binary_file):
+        self.binary_file = binary_file
+        with open(binary_file, mode = 'rb') as readCVR:
+            magic, version, recordSize, numBallots, tableOffset, reserved = binaryHeader.unpack(readCVR.read(binaryHeader.size))
+            if magic != binaryMagic or version != binaryVersion or recordSize != binaryRecord.itemsize:
+                raise ValueError(binary_file + ' is not a binary CVR this version can read.')
+            readCVR.seek(tableOffset)
+            table = json.loads(readCVR.read().decode())
+        self.headers = table['headers']
+        self.strings = table['strings']
+        self.numBallots = numBallots
+        self.records = np.memmap(binary_file, dtype = binaryRecord, mode = 'r', offset = binaryHeaderSize, shape = (numBallots,)) if numBallots else np.zeros(0, dtype = binaryRecord)
+        self.winner = self.records['winner']
+        self.runnerup = self.records['runnerup']
+        self.batch = self.records['batch']
+        self._batchIndex = None
+        self._codes = None
+
+    def __len__(self):
+        return self.numBallots
+
+    def close(self):
+        #release the mapping
+        self.records = self.winner = self.runnerup = self.batch = None
+
+    def _text(self, field, values):
+        if field in numberColumns.values():
+            return [str(value) if value >= 0 else self.strings[-value - 1] for value in values.tolist()]
+        return [self.strings[value] for value in values.tolist()]
+
+    def rows(self, positions):
+        '''
+        Returns: CSV rows (lists of 10 strings) for the ballots at the given positions, in that order
+        '''
+        records = self.records[np.asarray(positions, dtype = np.int64)]
+        columns = [None]*10
+        for column, field in list(codedColumns.items()) + list(numberColumns.items()):
+            columns[column] = self._text(field, records[field])
+        columns[8] = [str(mark) for mark in records['winner'].tolist()]
+        columns[9] = [str(mark) for mark in records['runnerup'].tolist()]
+        return [list(row) for row in zip(*columns)]
+
+    def ballot(self, i):
+        '''
+        Returns: CSV row of ballot i
+        '''
+        return self.rows([i])[0]
+
+    def batchCode(self, batch_name):
+        #code of a batch name in the string table, None if no ballot has it
+        if self._codes is None:
+            self._codes = {name: code for code, name in enumerate(self.strings)}
+        return self._codes.get(batch_name)
+
+    def batchPositions(self, batch_name):
+        '''
+        Returns: positions of the ballots in a batch, in CSV order. The first call sorts the batch column once
+        '''
+        if self._batchIndex is None:
+            order = np.argsort(self.batch, kind = 'stable')
+            codes = self.batch[order]
+            bounds = np.flatnonzero(np.diff(codes)) + 1
+            starts = np.concatenate(([0], bounds))
+            ends = np.concatenate((bounds, [len(order)]))
+            self._batchIndex = {int(codes[start]): order[start:end] for start, end in zip(starts, ends)}
+        code = self.batchCode(batch_name)
+        return self._batchIndex.get(code, np.zeros(0, dtype = np.int64))
+
+    def batchRows(self, batch_name):
+        return self.rows(self.batchPositions(batch_name))
+
+
+binaryCache = FileCache() #binary file: [file stamp, BinaryCVR], least recently used dropped first; emptied by clearCaches
+
+def openBinaryCVR(binary_file):
+    '''
+    Shared BinaryCVR for a file, mapped again only when the file changes on disk
+    '''
+    key = os.path.abspath(binary_file)
+    stamp = fileStamp(binary_file)
+    cached = binaryCache.get(key)
+    if cached is None or cached[0] != stamp:
+        cached = [stamp, BinaryCVR(binary_file)]
+        binaryCache[key] = cached
+    return cached[1]
+
+def binaryName(csv_file):
+    #electionCVR2.csv (or electionCVR2.csv.gz) -> electionCVR2.cvrb
+    return os.path.splitext(stripCompression(csv_file))[0] + '.cvrb'
+
+def binaryCVR(csv_file):
+    '''
+    BinaryCVR for a CSV CVR, converting it first if the binary copy is missing or older than the CSV
+    '''
+    binary_file = binaryName(csv_file)
+    if not os.path.exists(binary_file) or os.path.getmtime(binary_file) < os.path.getmtime(csv_file):
+        csvToBinary(csv_file, binary_file)
+    return openBinaryCVR(binary_file)
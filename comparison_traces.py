@@ -0,0 +1,198 @@
+import argparse
+import heapq
+import json
+import struct
+import numpy as np
+from math import ceil
+
+#Compact traces of ballot comparison audits, for looking into outlier trials after a run. A trace holds the trial's key and
+#seed (so it can also be rerun, see trialElection and comparisonTrial), the audit parameters, the sampled ballot IDs as
+#zigzag varints of the difference from the previous ID, and the non-zero discrepancies as varint gaps plus one code byte each.
+#Traces are appended to a binary file, one record after another:
+#header (magic, version, meta bytes, draws, ID bytes, non-zero discrepancies, gap bytes, discrepancies stored as doubles),
+#meta JSON, IDs, gaps, codes, doubles
+#Nothing is recorded while the audit runs: the trace is built afterwards from the election's ballotComparison list, and only
+#for the trials that are kept (the tail above trace_quantile of the sample sizes, and any trial that raised).
+traceMagic = b'RLAT'
+traceVersion = 1
+traceHeader = struct.Struct('<4sBIIIIII')
+errorDiscrepancies = {'overvote': 1, 'overvote2': 2, 'undervote': -1, 'undervote2': -2}
+codeDouble = 255 #discrepancy that is not a whole number of votes (questionableMath 1); stored as a double
+
+
+def encodeVarints(values):
+    '''
+    Summary: LEB128 encoding of non-negative ints, 7 bits a byte, low bits first
+    Returns: bytes
+    '''
+    values = np.asarray(values, dtype = np.uint64)
+    if len(values) == 0:
+        return b''
+    width = np.ones(len(values), dtype = np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        width += rest > 0
+        rest >>= np.uint64(7)
+    groups = np.arange(width.max())
+    table = ((values[:, None] >> (np.uint64(7)*groups.astype(np.uint64))) & np.uint64(0x7F)).astype(np.uint8)
+    table[groups < width[:, None] - 1] |= 0x80
+    return table[groups < width[:, None]].tobytes()
+
+def decodeVarints(data):
+    '''
+    Summary: Inverse of encodeVarints
+    Returns: numpy uint64 array
+    '''
+    data = np.frombuffer(data, dtype = np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype = np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    parts = (data & 0x7F).astype(np.uint64) << (np.uint64(7)*position.astype(np.uint64))
+    return np.bitwise_or.reduceat(parts, starts)
+
+def comparisonDiscrepancies(E1):
+    '''
+    Summary: The discrepancy of every ballot drawn by E1._ballotComparison, in draw order
+    Returns: list of numbers
+    '''
+    questionable = iter(getattr(E1, 'questionableDiscrepancies', ()))
+    return [next(questionable) if ballot.error == "questionable" else errorDiscrepancies.get(ballot.error, 0) for ballot in E1.ballotComparison]
+
+def comparisonTrace(E1, meta):
+    '''
+    Summary: Encodes the ballot comparison audit an election ran as one trace record
+    Parameters: Election after _ballotComparison, dict with the trial key, seed, result and any other parameters to keep
+    Returns: bytes
+    '''
+    meta = dict(meta, numBallots = E1.numBallots, dilutedMargin = E1.dilutedMargin, gamma = E1.gamma, riskLimit = E1.riskLimit,
+                simulationType = E1.simulationType, rounds = list(getattr(E1, 'comparisonRounds', [])))
+    ids = np.fromiter((ballot.number for ballot in E1.ballotComparison), dtype = np.int64, count = len(E1.ballotComparison))
+    steps = np.diff(ids, prepend = 0)
+    idBytes = encodeVarints((steps << 1) ^ (steps >> 63))
+    discrepancies = comparisonDiscrepancies(E1)
+    nonZero = [draw for draw, discrepancy in enumerate(discrepancies) if discrepancy != 0]
+    codes = bytearray()
+    doubles = []
+    for draw in nonZero:
+        discrepancy = discrepancies[draw]
+        if discrepancy in (-2, -1, 1, 2):
+            codes.append(int(discrepancy) + 2)
+        else:
+            codes.append(codeDouble)
+            doubles.append(discrepancy)
+    gapBytes = encodeVarints(np.diff(np.array(nonZero, dtype = np.int64), prepend = 0))
+    metaBytes = json.dumps(meta, separators = (',', ':')).encode('utf-8')
+    return b''.join([traceHeader.pack(traceMagic, traceVersion, len(metaBytes), len(ids), len(idBytes), len(nonZero), len(gapBytes), len(doubles)),
+                     metaBytes, idBytes, gapBytes, bytes(codes), np.array(doubles, dtype = '<f8').tobytes()])
+
+def readTraces(trace_file):
+    '''
+    Summary: Reads every trace in a trace file
+    Returns: list of dicts: the meta fields plus 'ids' (ballot IDs drawn, in order) and 'discrepancies' (one per draw)
+    '''
+    with open(trace_file, mode = 'rb') as readTrace:
+        data = readTrace.read()
+    traces = []
+    offset = 0
+    while offset < len(data):
+        magic, version, metaLength, draws, idLength, nonZero, gapLength, doubles = traceHeader.unpack_from(data, offset)
+        if magic != traceMagic or version != traceVersion:
+            raise ValueError('Not a version ' + str(traceVersion) + ' trace record at byte ' + str(offset) + ' of ' + trace_file)
+        offset += traceHeader.size
+        trace = json.loads(data[offset:offset + metaLength].decode('utf-8'))
+        offset += metaLength
+        steps = decodeVarints(data[offset:offset + idLength]).astype(np.int64)
+        offset += idLength
+        trace['ids'] = np.cumsum((steps >> 1) ^ -(steps & 1))
+        gaps = decodeVarints(data[offset:offset + gapLength]).astype(np.int64)
+        offset += gapLength
+        codes = np.frombuffer(data, dtype = np.uint8, count = nonZero, offset = offset).astype(np.float64)
+        offset += nonZero
+        codes[codes != codeDouble] -= 2
+        codes[codes == codeDouble] = np.frombuffer(data, dtype = '<f8', count = doubles, offset = offset)
+        offset += 8*doubles
+        trace['discrepancies'] = np.zeros(draws)
+        trace['discrepancies'][np.cumsum(gaps)] = codes
+        traces.append(trace)
+    return traces
+
+def replayTrace(trace):
+    '''
+    Summary: Reconstructs the observedrisk trajectory of a traced audit, with the same arithmetic _ballotComparison uses
+    Returns: dict: 'risk' (observedrisk after each draw), 'roundEnds' (draws at the end of each round), 'stoppedAt' (draws when
+    the risk limit was met at a point the audit could stop, None if it was not)
+    '''
+    dilutedMargin, gamma, alpha = trace['dilutedMargin'], trace['gamma'], trace['riskLimit']
+    risk = np.zeros(len(trace['discrepancies']))
+    observedrisk = 1
+    for draw, discCounter in enumerate(trace['discrepancies'].tolist()):
+        observedrisk = observedrisk * (1-(dilutedMargin/(2*gamma)))/(1-(discCounter/(2*gamma)))
+        risk[draw] = observedrisk
+    roundEnds = [int(end) for end in np.cumsum(trace['rounds'])] + [len(risk)]
+    if trace['simulationType'] == 1:
+        met = np.flatnonzero(risk < alpha)
+        stoppedAt = int(met[0]) + 1 if len(met) else None
+    else:
+        stoppedAt = next((end for end in roundEnds if end > 0 and risk[end - 1] < alpha), None)
+    return {'risk': risk, 'roundEnds': roundEnds, 'stoppedAt': stoppedAt}
+
+
+class TailTraces(object):
+    '''
+    Summary: Keeps the traces of the trials of one cell whose sample sizes are above the quantile (the largest
+    ceil(num*(1 - quantile)) of them) and appends them to the trace file with flush(). A trial that raised is written at once.
+    Parameters: trace file, trials in the cell, quantile (0 keeps every trial), dict of cell parameters written with every trace
+    '''
+    def __init__(self, trace_file, num, quantile = 0.99, parameters = None):
+        self.trace_file = trace_file
+        self.keep = max(1, int(ceil(num*(1 - quantile) - 1e-9)))
+        self.parameters = parameters or {}
+        self.kept = [] #heap of (ballots, trial, record)
+
+    def offer(self, E1, key, ballots, success):
+        '''
+        Summary: Keeps the trial's trace if its sample size is in the tail so far (a trace is only encoded when it is kept)
+        Parameters: Election after its comparison audit, trial key (its childGenerator key in a seeded run), ballots, success
+        '''
+        if len(self.kept) == self.keep and ballots <= self.kept[0][0]:
+            return
+        record = comparisonTrace(E1, dict(self.parameters, key = list(key), ballots = ballots, success = success, error = None))
+        if len(self.kept) < self.keep:
+            heapq.heappush(self.kept, (ballots, list(key), record))
+        else:
+            heapq.heapreplace(self.kept, (ballots, list(key), record))
+
+    def failed(self, E1, key, error):
+        '''
+        Summary: Writes the trace of a trial whose audit raised, and the tail kept so far
+        '''
+        record = comparisonTrace(E1, dict(self.parameters, key = list(key), ballots = len(E1.ballotComparison), success = 0, error = str(error)))
+        self.flush([record])
+
+    def flush(self, extra = ()):
+        '''
+        Summary: Appends the kept traces, in trial order, to the trace file and starts over
+        '''
+        records = [record for ballots, key, record in sorted(self.kept, key = lambda kept: kept[1])] + list(extra)
+        self.kept = []
+        with open(self.trace_file, mode = 'ab') as writeTrace:
+            writeTrace.write(b''.join(records))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'List the audits in a ballot comparison trace file.')
+    parser.add_argument('trace_file')
+    parser.add_argument('--risk', action = 'store_true', help = 'also print the observedrisk trajectory of every trace')
+    args = parser.parse_args()
+    for trace in readTraces(args.trace_file):
+        replay = replayTrace(trace)
+        print('key ' + str(trace['key']) + ': ' + str(trace['ballots']) + ' ballots, rounds ' + str(replay['roundEnds']) + ', ' +
+              str(int(np.count_nonzero(trace['discrepancies']))) + ' discrepancies, final risk ' + str(replay['risk'][-1] if len(replay['risk']) else 1) +
+              ', stopped at ' + str(replay['stoppedAt']) + (', error: ' + trace['error'] if trace['error'] else ''))
+        if args.risk:
+            print(' '.join(str(risk) for risk in replay['risk']))
+
+if __name__ == '__main__':
+    main()
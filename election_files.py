@@ -18,6 +18,63 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SO
 '''
 
 from Election_Simulation import *
+from phase_timers import *
+import gzip
+import lzma
+import io
+from collections import OrderedDict
+
+ioBufferSize = 1 << 20 #buffer size for every CVR, manifest, tabulation and pull sheet stream
+compressionOpeners = {'.gz': gzip.open, '.xz': lzma.open, '.lzma': lzma.open}
+compression = '' #extension added to the data files this program names itself: '', '.gz', '.xz' or '.lzma'
+
+def setCompression(extension):
+    '''
+    Summary: Choose the compression for the files the setup and audit write (electionCVR1/2, manifest, tabulation, batch CVRs,
+    pull sheets). Files given by the user are read according to their own extension.
+    Parameters: '', '.gz', '.xz' or '.lzma'
+    '''
+    global compression
+    if extension != '' and extension not in compressionOpeners:
+        raise ValueError('Compression must be one of: ' + ', '.join([''] + list(compressionOpeners)))
+    compression = extension
+
+def csvName(file_name):
+    #name of a data file with the chosen compression extension
+    return file_name + compression
+
+def stripCompression(file_name):
+    #file name without a .gz/.xz/.lzma extension
+    root, extension = os.path.splitext(file_name)
+    return root if extension.lower() in compressionOpeners else file_name
+
+def cvrBatchName(batch_file):
+    #batch name from a batch CVR file name: <batch>CVR.csv, optionally compressed
+    return os.path.basename(stripCompression(batch_file)).replace('CVR.csv', '')
+
+def openFile(file_name, mode = 'r', newline = ''):
+    '''
+    Summary: open() for data files. Files ending in .gz or .xz/.lzma are compressed or decompressed while streaming,
+    anything else is a plain file; either way the stream gets an ioBufferSize buffer
+    Parameters: file path, mode ('r', 'w' or 'a', with 'b' for bytes), newline as for open() in text mode
+    '''
+    opener = compressionOpeners.get(os.path.splitext(file_name)[1].lower())
+    if opener is None:
+        if 'b' in mode:
+            return open(file_name, mode, buffering = ioBufferSize)
+        return open(file_name, mode, buffering = ioBufferSize, newline = newline)
+
+    binaryMode = mode.replace('t', '').replace('b', '') + 'b'
+    if 'r' in mode:
+        stream = io.BufferedReader(opener(file_name, binaryMode), buffer_size = ioBufferSize)
+    elif opener is gzip.open:
+        #level 6 and lzma preset 1 keep writing the batch CVRs close to the speed of plain files
+        stream = io.BufferedWriter(gzip.open(file_name, binaryMode, compresslevel = 6), buffer_size = ioBufferSize)
+    else:
+        stream = io.BufferedWriter(lzma.open(file_name, binaryMode, preset = 1), buffer_size = ioBufferSize)
+    if 'b' in mode:
+        return stream
+    return io.TextIOWrapper(stream, newline = newline)
 
 def fileSetup(E1):
     #run _marginOfVictory, _distributeBallots to create simulated ballots
@@ -28,10 +85,12 @@ def createEmptyDict(E1):
     #generate list of random numbers to later assign to imprintedID for each ballot, create empty dict for recordID
     recordID_dict = {}
         
-    #set values for .town, .batch for each ballot
+    #set values for .town, .batch for each ballot (only once: lazyFiles builds a dict for CVR1 and another for CVR2, and
+    #assigning again would overfill the batches)
     for i in E1.ballotList:
         b = E1.ballotList[i]
-        b.town, b.batch = E1._setTownAndBatch("Comparison")
+        if b.town is None:
+            b.town, b.batch = E1._setTownAndBatch("Comparison")
         #create dictionary for recordID number
         recordID_dict[b.town+str(b.batch)] = [0,0,0]  #key: b.town+b.batch, value: [total votes, winner votes, loser votes]
 
@@ -42,53 +101,385 @@ def readManifest(manifest_file):
     Function to read manifest file
     Returns: total number of ballots
     '''
-    #open file, skip header
-    readManifest = open(manifest_file, mode = 'r', newline = '')
-    manifest_reader = csv.reader(readManifest)
-    next(manifest_reader)
+    manifest = loadManifest(manifest_file)
+    #ballots per batch keep the text from the file, as before
+    ballotsPerBatchTotal = dict(zip(manifest.batchNames, manifest.sizeText))
+    return int(manifest.sizes.sum()), list(manifest.batchNames), manifest.sizes.tolist(), ballotsPerBatchTotal
 
-    numBallots = 0
-    batchNames = [] #list of batch names
-    batchSizes = [] #list of batch sizes 
-    ballotsPerBatchTotal = {} #dict of batch names: ballots per batch
+def readTabulation(tab_file):
+    '''
+    Function to read tabulation file
+    Returns: total number of ballots, ballots for winner, ballots for runnerup, margin
+    '''
+    numBallots, winnerBallots, runnerupBallots = (int(x) for x in loadTabulation(tab_file).counts.sum(axis = 0))
 
-    #count number ballots
-    for ballot in manifest_reader: 
-        numBallots += int(ballot[3])
-        batchNames.append(ballot[2])
-        batchSizes.append(int(ballot[3]))
-        ballotsPerBatchTotal[ballot[2]] = ballot[3]
+    #calculate margin
+    margin = ((winnerBallots / numBallots) - (runnerupBallots / numBallots))*100
 
-    readManifest.close()
+    return numBallots, winnerBallots, runnerupBallots, margin
 
-    return numBallots, batchNames, batchSizes, ballotsPerBatchTotal
+def scanCVR(cvr_file):
+    '''
+    Summary: Counts the ballot totals of a CVR file the way readCVR does (only rows with both marks '0' or '1') and checks that
+    RecordIDs and ImprintedIDs are unique
+    Parameters: CVR file path
+    Returns: total number of ballots, ballots for winner, ballots for runnerup, True if all identifiers unique
+    '''
+    cvr = loadCVR(cvr_file)
+    numBallots, winnerBallots, runnerupBallots, margin = cvr.totals()
+    return numBallots, winnerBallots, runnerupBallots, cvr.unique()
 
-def readTabulation(tab_file):
+def splitFields(file_name, headerLines, width):
     '''
-    Function to read tabulation file
-    Returns: total number of ballots, ballots for winner, ballots for runnerup, margin
+    Locate every field of a CSV file without making Python objects per field, skipping the header lines
+    Only applies to files with no quoted fields and exactly width fields on every row
+    Returns: file contents as a uint8 array and the start/end offsets of every field as (rows, width) arrays, or None
+    '''
+    with openFile(file_name, mode = 'rb') as readFile:
+        data = readFile.read()
+    start = 0
+    for i in range(headerLines):
+        start = data.find(b'\n', start) + 1
+        if start == 0:
+            start = len(data)
+    body = data[start:]
+    if body and not body.endswith(b'\n'):
+        body += b'\n'
+    if b'"' in body:
+        return None
+
+    text = np.frombuffer(body, dtype = np.uint8)
+    delimiters = np.flatnonzero((text == 44) | (text == 10)) #commas and newlines
+    numRows = len(delimiters)//width
+    newline = text[delimiters] == 10
+    #delimiters must repeat as width - 1 commas then a newline
+    if len(delimiters) != numRows*width or newline.sum() != numRows or not newline[width-1::width].all():
+        return None
+    starts = np.concatenate(([0], delimiters + 1))[:-1].reshape(numRows, width)
+    ends = delimiters.reshape(numRows, width)
+    #csv.writer ends rows with \r\n; the \r is not part of the last field
+    if numRows:
+        ends[:, -1] -= text[ends[:, -1] - 1] == 13
+    return text, starts, ends
+
+def fieldStrings(text, starts, ends):
+    #one column as a list of str
+    body = text.tobytes()
+    return [body[start:end].decode() for start, end in zip(starts.tolist(), ends.tolist())]
+
+def fieldBytes(text, starts, ends):
+    #one column as a fixed-width bytes array, built without a Python loop
+    lengths = ends - starts
+    size = max(int(lengths.max()) if len(lengths) else 0, 1)
+    offsets = np.arange(size)
+    positions = np.minimum(starts[:, None] + offsets, len(text) - 1)
+    values = np.where(offsets < lengths[:, None], text[positions], 0).astype(np.uint8)
+    return np.ascontiguousarray(values).view('S' + str(size)).reshape(-1)
+
+def readColumns(file_name, headerLines, width):
+    '''
+    Parse a CSV file once into columns (lists of str), skipping the header lines
+    Returns: number of rows, list of width columns
+    '''
+    split = splitFields(file_name, headerLines, width)
+    if split is not None:
+        text, starts, ends = split
+        return len(starts), [fieldStrings(text, starts[:, i], ends[:, i]) for i in range(width)]
+
+    with openFile(file_name, mode = 'r', newline = '') as readFile:
+        fileReader = csv.reader(readFile)
+        for i in range(headerLines):
+            next(fileReader, None)
+        rows = [row + ['']*(width - len(row)) for row in fileReader if row]
+    return len(rows), [[row[i] for row in rows] for i in range(width)]
+
+def markCodes(column):
+    #'0' -> 0, '1' -> 1, anything else -> 2, so comparisons match the string tests they replace
+    marks = np.asarray(column)
+    return np.where(marks == '1', 1, np.where(marks == '0', 0, 2)).astype(np.uint8)
+
+def internCodes(column):
+    #distinct values in order of first appearance and an int32 code per row
+    values = column.tolist() if isinstance(column, np.ndarray) else column
+    names = {}
+    codes = np.fromiter((names.setdefault(value, len(names)) for value in values), dtype = np.int32, count = len(values))
+    return list(names), codes
+
+class CVRColumns(object):
+    '''
+    Summary: CVR file as typed columns: batch as interned codes, winner/runnerup marks as uint8 (0, 1, or 2 for anything else),
+    RecordID and ImprintedID interned on first use
+    Parameters: CVR file path
+    '''
+    def __init__(self, cvr_file):
+        split = splitFields(cvr_file, 4, 10)
+        if split is not None:
+            text, starts, ends = split
+            self.numBallots = len(starts)
+            batchNames, self.batch = internCodes(fieldBytes(text, starts[:, 2], ends[:, 2]))
+            self.batchNames = [name.decode() for name in batchNames]
+            #a mark is a single '0' or '1' character
+            for column, name in ((8, 'winner'), (9, 'runnerup')):
+                mark = text[starts[:, column]].astype(np.int16) - 48
+                single = (ends[:, column] - starts[:, column]) == 1
+                setattr(self, name, np.where(single & (mark >= 0) & (mark <= 1), mark, 2).astype(np.uint8))
+            #the ID columns are cut out now (without a Python loop) so the file text is not kept alive until ids() is called
+            idColumns = [fieldBytes(text, starts[:, i], ends[:, i]) for i in (3, 4)]
+            self._idColumns = lambda: idColumns
+        else:
+            self.numBallots, columns = readColumns(cvr_file, 4, 10)
+            self.batchNames, self.batch = internCodes(columns[2])
+            self.winner = markCodes(columns[8])
+            self.runnerup = markCodes(columns[9])
+            self._idColumns = lambda: [columns[3], columns[4]]
+        self._ids = None
+
+    def ids(self):
+        '''
+        Returns: (distinct RecordIDs, RecordID code per row), (distinct ImprintedIDs, ImprintedID code per row)
+        '''
+        if self._ids is None:
+            self._ids = tuple(internCodes(column) for column in self._idColumns())
+            self._idColumns = None
+        return self._ids
+
+    def totals(self):
+        '''
+        Same values as readCVR: total number of ballots, ballots for winner (1-0 and 1-1), ballots for runnerup (0-1 and 1-1), margin
+        '''
+        valid = (self.winner < 2) & (self.runnerup < 2)
+        winnerBallots = int(((self.winner == 1) & valid).sum())
+        runnerupBallots = int(((self.runnerup == 1) & valid).sum())
+        margin = ((winnerBallots / self.numBallots) - (runnerupBallots / self.numBallots))*100
+        return self.numBallots, winnerBallots, runnerupBallots, margin
+
+    def unique(self):
+        #every RecordID and ImprintedID appears once
+        (recordIDs, recordCodes), (imprintedIDs, imprintedCodes) = self.ids()
+        return len(recordIDs) == self.numBallots and len(imprintedIDs) == self.numBallots
+
+    def batchTotals(self):
+        '''
+        Returns: batch names, and ballots, winner marks and runnerup marks per batch
+        '''
+        numBatches = len(self.batchNames)
+        valid = (self.winner < 2) & (self.runnerup < 2)
+        return (self.batchNames, np.bincount(self.batch, minlength = numBatches),
+                np.bincount(self.batch, weights = (self.winner == 1) & valid, minlength = numBatches).astype(np.int64),
+                np.bincount(self.batch, weights = (self.runnerup == 1) & valid, minlength = numBatches).astype(np.int64))
+
+class ManifestColumns(object):
+    '''
+    Summary: Manifest file as columns: rows as read, batch names in file order, sizes as int64 and as the text in the file
+    Parameters: Manifest file path
+    '''
+    def __init__(self, manifest_file):
+        numBatches, columns = readColumns(manifest_file, 1, 4)
+        self.rows = [list(row) for row in zip(*columns)]
+        self.batchNames = list(columns[2])
+        self.sizeText = list(columns[3])
+        self.sizes = np.array(self.sizeText, dtype = np.int64).reshape(-1)
+
+class TabulationColumns(object):
     '''
-    #open file, skip header
-    with open(tab_file, mode = 'r', newline = '') as readTab:
-        tabReader = csv.reader(readTab)
-        next(tabReader)
+    Summary: Tabulation file as columns: rows as read, batch names in file order, and Size, Winner, Loser per batch as an int64 array
+    Parameters: Tabulation file path
+    '''
+    def __init__(self, tabulation_file):
+        numBatches, columns = readColumns(tabulation_file, 1, 5)
+        self.rows = [list(row) for row in zip(*columns)]
+        self.batchNames = list(columns[1])
+        self.counts = np.array([columns[2], columns[3], columns[4]], dtype = np.int64).T.reshape(-1, 3)
 
-        numBallots = winnerBallots = runnerupBallots = 0
-    
-        #count number ballots total, winner, runnerup 
-        for batch in tabReader: 
-            numBallots += int(batch[2])
-            winnerBallots += int(batch[3])
-            runnerupBallots += int(batch[4])
+fileCacheSize = 4096 #entries kept by each file cache; the least recently used entry is dropped first
+fileCaches = [] #every FileCache, for clearCaches
 
-        #calculate margin
-        margin = ((winnerBallots / numBallots) - (runnerupBallots / numBallots))*100
+class FileCache(OrderedDict):
+    '''
+    Summary: Least recently used cache of parsed files: get() marks an entry as used, and storing an entry past size entries
+    drops the least recently used one, so a long sweep or a driver opening many elections does not keep every file it read
+    Parameters: largest number of entries
+    '''
+    def __init__(self, size = fileCacheSize):
+        OrderedDict.__init__(self)
+        self.size = size
+        fileCaches.append(self)
+
+    def get(self, key, default = None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        self.move_to_end(key)
+        while len(self) > self.size:
+            self.popitem(last = False)
+
+def clearCaches():
+    '''
+    Forget every cached file (columns, election indexes, binary CVRs), e.g. after an audit whose files are not read again
+    '''
+    for cache in fileCaches:
+        cache.clear()
+
+columnarCache = FileCache() #(file, kind): [file stamp, columns]
+
+def loadColumns(file_name, kind):
+    '''
+    Summary: Shared columnar loader. Parses the file into CVRColumns, ManifestColumns or TabulationColumns and keeps the result
+    until the file changes on disk
+    Parameters: file path, kind ('cvr', 'manifest' or 'tabulation')
+    '''
+    key = (os.path.abspath(file_name), kind)
+    stamp = fileStamp(file_name)
+    cached = columnarCache.get(key)
+    if cached is None or cached[0] != stamp:
+        cached = [stamp, {'cvr': CVRColumns, 'manifest': ManifestColumns, 'tabulation': TabulationColumns}[kind](file_name)]
+        columnarCache[key] = cached
+    return cached[1]
+
+def loadCVR(cvr_file):
+    return loadColumns(cvr_file, 'cvr')
+
+def loadManifest(manifest_file):
+    return loadColumns(manifest_file, 'manifest')
+
+def loadTabulation(tabulation_file):
+    return loadColumns(tabulation_file, 'tabulation')
 
+def dropColumns(file_name):
+    '''
+    Forget cached columns for a file, for callers that just rewrote it (a rewrite can keep the same size and timestamp)
+    '''
+    for kind in ['cvr', 'manifest', 'tabulation']:
+        columnarCache.pop((os.path.abspath(file_name), kind), None)
+
+def fileStamp(file_name):
+    '''
+    Returns a value that changes whenever the file on disk is rewritten
+    '''
+    stat = os.stat(file_name)
+    return stat.st_mtime_ns, stat.st_size
+
+class ElectionIndex(object):
+    '''
+    Summary: In-memory lookups for the ballot manifest, tabulation and batch CVRs. The manifest and tabulation are read once into dicts
+    and arrays keyed by batch name and are only read again when the file on disk changes. Batch CVR totals and identifier uniqueness
+    come from the shared columnar loader and are cached the same way.
+    Parameters: Manifest file path, tabulation file path
+    '''
+    def __init__(self, manifest_file, tabulation_file):
+        self.manifest_file = manifest_file
+        self.tabulation_file = tabulation_file
+        self.manifestStamp = self.tabulationStamp = None
+        self.manifestBatches = [] #Batch names in manifest order
+        self.manifestIndex = {} #Batch name: row in manifest arrays
+        self.manifestRows = [] #Manifest rows as read: Container, Tabulator, Batch Name, Number of Ballots
+        self.manifestSizes = np.zeros(0, dtype = np.int64)
+        self.tabulationBatches = [] #Batch names in tabulation order
+        self.tabulationIndex = {} #Batch name: row in tabulation arrays
+        self.tabulationRows = [] #Tabulation rows as read: Town, BatchNum, Size, Winner, Loser
+        self.tabulationCounts = np.zeros((0, 3), dtype = np.int64) #Size, Winner, Loser per batch
+
+    def refresh(self):
+        '''
+        Reload the manifest or tabulation if either changed on disk since it was last read
+        '''
+        stamp = fileStamp(self.manifest_file)
+        if stamp != self.manifestStamp:
+            self._loadManifest()
+            self.manifestStamp = stamp
+        stamp = fileStamp(self.tabulation_file)
+        if stamp != self.tabulationStamp:
+            self._loadTabulation()
+            self.tabulationStamp = stamp
+
+    def invalidate(self):
+        '''
+        Force the manifest and tabulation to be read again on next use, for callers that just rewrote them
+        '''
+        self.manifestStamp = self.tabulationStamp = None
+        dropColumns(self.manifest_file)
+        dropColumns(self.tabulation_file)
+
+    def _loadManifest(self):
+        manifest = loadManifest(self.manifest_file)
+        self.manifestRows = manifest.rows
+        self.manifestBatches = manifest.batchNames
+        self.manifestIndex = {name: i for i, name in enumerate(self.manifestBatches)}
+        self.manifestSizes = manifest.sizes
+
+    def _loadTabulation(self):
+        tabulation = loadTabulation(self.tabulation_file)
+        self.tabulationRows = tabulation.rows
+        self.tabulationBatches = tabulation.batchNames
+        self.tabulationIndex = {name: i for i, name in enumerate(self.tabulationBatches)}
+        self.tabulationCounts = tabulation.counts
+
+    def manInfo(self, batch_name):
+        '''
+        Returns number of ballots in specified batch from manifest, None if the batch is not in the manifest
+        '''
+        self.refresh()
+        i = self.manifestIndex.get(batch_name)
+        if i is None:
+            return None
+        return int(self.manifestSizes[i])
+
+    def tabInfo(self, batch_name, info_needed):
+        '''
+        Returns number of ballots total ('batch size'), winner ('winner size'), or loser ('runnerup size') in specified batch from tabulation
+        '''
+        self.refresh()
+        i = self.tabulationIndex.get(batch_name)
+        if i is None:
+            return None
+        column = {'batch size': 0, 'winner size': 1, 'runnerup size': 2}[info_needed]
+        return int(self.tabulationCounts[i][column])
+
+    def manifestTotals(self):
+        '''
+        Same values as readManifest: total number of ballots, batch names, batch sizes, dict of batch names: ballots per batch
+        '''
+        self.refresh()
+        ballotsPerBatchTotal = {row[2]: row[3] for row in self.manifestRows}
+        return int(self.manifestSizes.sum()), list(self.manifestBatches), self.manifestSizes.tolist(), ballotsPerBatchTotal
+
+    def tabulationTotals(self):
+        '''
+        Same values as readTabulation: total number of ballots, ballots for winner, ballots for runnerup, margin
+        '''
+        self.refresh()
+        numBallots, winnerBallots, runnerupBallots = (int(x) for x in self.tabulationCounts.sum(axis = 0))
+        margin = ((winnerBallots / numBallots) - (runnerupBallots / numBallots))*100
         return numBallots, winnerBallots, runnerupBallots, margin
 
+    def cvrInfo(self, cvr_file):
+        '''
+        Returns total number of ballots, ballots for winner, ballots for runnerup and identifier uniqueness for a batch CVR,
+        parsing the file only if it changed since the last call
+        '''
+        return scanCVR(cvr_file)
+
+electionIndexes = FileCache() #(manifest file, tabulation file): ElectionIndex shared by every caller using that pair of files
+
+def getElectionIndex(manifest_file, tabulation_file):
+    '''
+    Returns the shared ElectionIndex for a manifest and tabulation, creating it on first use
+    '''
+    key = (os.path.abspath(manifest_file), os.path.abspath(tabulation_file))
+    index = electionIndexes.get(key)
+    if index is None:
+        index = ElectionIndex(manifest_file, tabulation_file)
+        electionIndexes[key] = index
+    return index
+
+@timed('CSV writing: manifest')
 def createManifest(recordID_dict):
     #write to manifest csv file 
-    electionManifest = open('electionManifest.csv', mode = 'w', newline = '')
+    electionManifest = openFile(csvName('electionManifest.csv'), mode = 'w', newline = '')
     man_writer = csv.writer(electionManifest)
     man_writer.writerow(['Container', 'Tabulator', 'Batch Name', 'Number of Ballots'])
     for i in sorted(recordID_dict.keys()):
@@ -98,9 +489,10 @@ def createManifest(recordID_dict):
         
     electionManifest.close()
 
+@timed('CSV writing: tabulation')
 def createTabulation(recordID_dict):
     #write tabulation file
-    with open('electionTabulation.csv', mode = 'w', newline = '') as electionTabulation:
+    with openFile(csvName('electionTabulation.csv'), mode = 'w', newline = '') as electionTabulation:
         tab_writer = csv.writer(electionTabulation)
         tab_writer.writerow(['Town', 'BatchNum', 'Size', 'Winner', 'Loser'])
         for i in sorted(recordID_dict.keys()):
@@ -109,19 +501,20 @@ def createTabulation(recordID_dict):
     print('Tabulation created')
 
 
+@timed('CSV writing: electionCVR1')
 def createCVR1(E1, recordID_dict):
     '''
     Summary: Creates CVR and Manifest csv files for given Election object 
     '''
     #open csv file, write headers
-    electionCVR = open('electionCVR1.csv', mode = 'w', newline = '')
+    electionCVR = openFile(csvName('electionCVR1.csv'), mode = 'w', newline = '')
     CVRwriter = csv.writer(electionCVR)
     CVRwriter.writerow(['Test'])
     CVRwriter.writerow(['','','','','','','','','Contest 1 (vote for = 1)','Contest 1 (vote for = 1)'])
     CVRwriter.writerow(['','','','','','','','','Winner','Runner-Up'])
     CVRwriter.writerow(['CVRNumber','TabulatorNumber', 'BatchID','RecordID', 'ImprintedID','CountingGroup','PrecinctPortion','BallotType','',''])
 
-    imprintedID_list = random.sample(range(1, len(E1.ballotList)+1), len(E1.ballotList)) 
+    imprintedID_list = E1.random.sample(range(1, len(E1.ballotList)+1), len(E1.ballotList)) 
 
     #write to csv file for each ballot in ballotList
     for i in E1.ballotList:
@@ -143,6 +536,7 @@ def createCVR1(E1, recordID_dict):
 
     electionCVR.close()
 
+@timed('CSV writing: electionCVR2')
 def createCVR2(E1, recordID_dict):
     '''
     Alterations made for over/undervotes based on CVR1
@@ -151,7 +545,7 @@ def createCVR2(E1, recordID_dict):
 
     #write contents of file to lists to make changes
     cvrList = []
-    with open('electionCVR1.csv', mode= 'r', newline = '') as readCVR:
+    with openFile(csvName('electionCVR1.csv'), mode= 'r', newline = '') as readCVR:
         cvrReader = csv.reader(readCVR)
         for i in range(4):
             next(cvrReader)
@@ -203,7 +597,7 @@ def createCVR2(E1, recordID_dict):
             recordID_dict[townBatch][2] += 1 #update loser count
 
     #write altered information to cvr2 file 
-    with open('electionCVR2.csv', mode='w', newline = '') as writeCVR:
+    with openFile(csvName('electionCVR2.csv'), mode='w', newline = '') as writeCVR:
         cvrWriter = csv.writer(writeCVR)
         #write headers 
         cvrWriter.writerow(['Test'])
@@ -0,0 +1,187 @@
+import numpy as np
+from math import log
+
+#Vectorized ballot comparison audits for Questionable_Simulation. With sampling with replacement, every draw of
+#Election._ballotComparison is independent and has the same distribution: the ballot's category (normal, one- or two-vote
+#over/understatement, questionable) with probability count/numBallots, and for a questionable ballot one of the discrepancies
+#its questionableMath treatment draws with random(). discrepancyDistribution merges both steps into one categorical
+#distribution over discrepancy values, AliasTable draws from it with one uniform per ballot, and comparisonAudits runs many
+#incremental (simulationType 1) audits at once on numpy arrays. The per-town and batch counts of collectData need the
+#individual ballots, so this engine only gives sample sizes and risk limit success; it draws from the same distribution as
+#the ballot-by-ballot loop, not the same stream, and compares log(observedrisk) with log(riskLimit).
+errorCategories = ((1, 'overvotes1'), (2, 'overvotes2'), (-1, 'undervotes1'), (-2, 'undervotes2'))
+
+
+def questionableOutcomes(questionableMath = 0, qAsMark = 1, qAuditorRate = 0):
+    '''
+    Summary: Discrepancies one questionable ballot can add and their probabilities, as the questionableMath branches of
+    _ballotComparison give them for choice = random()
+    Parameters: 0 baseline, 1 Bayesian or 2 conservative approach, rate questionable marks were counted as votes on the CVR,
+    rate the auditor counts them as votes
+    Returns: dict of discrepancy: probability
+    '''
+    def below(threshold):
+        #P(choice <= threshold) for choice uniform on [0, 1)
+        return min(max(threshold, 0.0), 1.0)
+    if questionableMath == 0: #Baseline Approach
+        over = below(qAsMark*(1 - qAuditorRate))
+        under = 1 - max(below(1 - qAuditorRate*(1 - qAsMark)), over)
+        outcomes = {1: over, -1: under, 0: 1 - over - under}
+    elif questionableMath == 1: #Bayesian Approach
+        outcomes = {1 - qAsMark: below(qAuditorRate)}
+        outcomes[-qAsMark] = outcomes.get(-qAsMark, 0.0) + 1 - below(qAuditorRate)
+    elif questionableMath == 2: #Conservative Approach
+        outcomes = {-1: below(qAsMark), 0: 1 - below(qAsMark)}
+    else:
+        outcomes = {0: 1.0}
+    return outcomes
+
+def discrepancyDistribution(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, questionableMath = 0, qAsMark = 1, qAuditorRate = 0):
+    '''
+    Summary: Distribution of the discrepancy of one ballot drawn for a comparison audit: the o1/o2/u1/u2 categories and the
+    questionable outcomes merged, equal values added together
+    Parameters: as in collectData
+    Returns: numpy arrays of discrepancy values (sorted) and their probabilities
+    '''
+    counts = {'overvotes1': overvotes1, 'overvotes2': overvotes2, 'undervotes1': undervotes1, 'undervotes2': undervotes2}
+    if sum(counts.values()) + questionable > numBallots:
+        raise ValueError("More discrepancies and questionable ballots than ballots.")
+    distribution = {0: (numBallots - sum(counts.values()) - questionable)/numBallots}
+    for value, name in errorCategories:
+        distribution[value] = distribution.get(value, 0.0) + counts[name]/numBallots
+    for value, probability in questionableOutcomes(questionableMath, qAsMark, qAuditorRate).items():
+        distribution[value] = distribution.get(value, 0.0) + probability*questionable/numBallots
+    values = np.array(sorted(value for value in distribution if distribution[value] > 0), dtype = np.float64)
+    probabilities = np.array([distribution[value] for value in values.tolist()])
+    return values, probabilities/probabilities.sum()
+
+
+class AliasTable(object):
+    '''
+    Summary: Walker/Vose alias table: draws from a categorical distribution in constant time per draw, with one uniform
+    Parameters: probabilities (normalized here)
+    '''
+    def __init__(self, probabilities):
+        probabilities = np.asarray(probabilities, dtype = np.float64)
+        size = len(probabilities)
+        scaled = probabilities*size/probabilities.sum()
+        self.keep = np.ones(size) #probability of keeping the column drawn instead of taking its alias
+        self.alias = np.arange(size)
+        small = [column for column in range(size) if scaled[column] < 1]
+        large = [column for column in range(size) if scaled[column] >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.keep[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+        #whatever is left is 1 up to rounding
+        self.size = size
+
+    def draw(self, rng, shape):
+        '''
+        Returns: array of category indices of the given shape
+        '''
+        spot = rng.random(shape)*self.size
+        column = np.minimum(spot.astype(np.intp), self.size - 1)
+        return np.where(spot - column < self.keep[column], column, self.alias[column])
+
+
+class ComparisonDistribution(object):
+    '''
+    Summary: Precomputed per-draw distribution of a comparison audit cell: discrepancy values, their probabilities, the alias
+    table to draw them and the log of the factor each one multiplies observedrisk by
+    Parameters: as in collectData (margin in percent; the diluted margin is margin/100, as in Questionable_Simulation)
+    '''
+    def __init__(self, numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, gamma, margin,
+                 questionableMath = 0, qAsMark = 1, qAuditor = 0):
+        self.numBallots = numBallots
+        self.riskLimit = riskLimit
+        self.gamma = gamma
+        self.dilutedMargin = margin/100
+        self.values, self.probabilities = discrepancyDistribution(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable,
+                                                                  questionableMath, qAsMark, qAuditor)
+        self.table = AliasTable(self.probabilities)
+        self.cumulative = np.cumsum(self.probabilities)
+        self.steps = self.logFactors(self.values)
+
+    def logFactors(self, values):
+        '''
+        Returns: log of the Kaplan-Markov factor (1 - dilutedMargin/(2 gamma))/(1 - discrepancy/(2 gamma)) for each value
+        '''
+        return np.log(1 - self.dilutedMargin/(2*self.gamma)) - np.log(1 - np.asarray(values)/(2*self.gamma))
+
+    def draw(self, rng, shape):
+        '''
+        Returns: category indices (into values, probabilities and steps) of shape draws
+        '''
+        return self.table.draw(rng, shape)
+
+    def inverse(self, uniforms):
+        '''
+        Summary: Inverse-CDF draws (slower than the alias table, but monotone: larger uniforms give larger discrepancies, which
+        antithetic pairs need)
+        Returns: category indices for the uniforms
+        '''
+        return np.minimum(np.searchsorted(self.cumulative, uniforms, side = 'right'), len(self.values) - 1)
+
+
+def comparisonAudits(distribution, num, rng, maxBallots = None, block = 256, batch = 8192, logRisks = False, antithetic = False,
+                     ceiling = None):
+    '''
+    Summary: Runs num incremental ballot comparison audits at once: each one draws until observedrisk < riskLimit, or until
+    maxBallots draws (numBallots by default, where _ballotComparison stops too). Audits are run batch at a time, block draws at a time.
+    With antithetic, audits 2j and 2j + 1 are a pair: draw k of the second uses 1 - u where the first used u (inverse-CDF
+    draws), so the pair's sample sizes are negatively correlated; num has to be even.
+    With a ceiling, an audit whose log(observedrisk) is above it at the end of a block is given up on and counted as reaching
+    maxBallots without meeting the risk limit (for audits of wrong outcomes, see risk_validation).
+    Parameters: ComparisonDistribution, number of audits, numpy Generator, maximum draws, draws per step, audits per batch,
+    whether to return log(observedrisk) at the end of every audit too, whether to run antithetic pairs, log risk ceiling
+    Returns: number of ballots compared and risk limit success (0 or 100) of every audit, as numpy int64 arrays (and the final
+    log risks as a float array if logRisks)
+    '''
+    maxBallots = distribution.numBallots if maxBallots is None else maxBallots
+    threshold = log(distribution.riskLimit)
+    ballots = np.zeros(num, dtype = np.int64)
+    success = np.zeros(num, dtype = np.int64)
+    finalRisk = np.zeros(num) if logRisks else None
+    if antithetic:
+        if num % 2:
+            raise ValueError("Antithetic audits come in pairs; num has to be even.")
+        batch += batch % 2
+    for start in range(0, num, batch):
+        rows = np.arange(start, min(start + batch, num))
+        logRisk = np.zeros(len(rows))
+        drawn = 0
+        while len(rows) and drawn < maxBallots:
+            width = min(block, maxBallots - drawn)
+            if antithetic:
+                #one row of uniforms per pair still running, mirrored for its second audit
+                uniforms = rng.random(((min(start + batch, num) - start)//2, width))[(rows - start)//2]
+                mirrored = (rows - start) % 2 == 1
+                uniforms[mirrored] = 1 - uniforms[mirrored]
+                categories = distribution.inverse(uniforms)
+            else:
+                categories = distribution.draw(rng, (len(rows), width))
+            path = logRisk[:, None] + np.cumsum(distribution.steps[categories], axis = 1)
+            below = path < threshold
+            met = below.any(axis = 1)
+            stop = below[met].argmax(axis = 1)
+            ballots[rows[met]] = drawn + stop + 1
+            success[rows[met]] = 100
+            if logRisks:
+                finalRisk[rows[met]] = path[met, stop]
+            drawn += width
+            going = ~met if ceiling is None else ~met & (path[:, -1] <= ceiling)
+            if ceiling is not None:
+                givenUp = ~met & ~going
+                ballots[rows[givenUp]] = maxBallots
+                if logRisks:
+                    finalRisk[rows[givenUp]] = path[givenUp, -1]
+            rows, logRisk = rows[going], path[going, -1]
+        ballots[rows] = maxBallots
+        if logRisks:
+            finalRisk[rows] = logRisk
+    if logRisks:
+        return ballots, success, finalRisk
+    return ballots, success
@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import threading
+import functools
+import tracemalloc
+import multiprocessing.util
+from shutil import rmtree
+
+#Per-phase timers and counters. Off unless the RLA_PROFILE environment variable names a profile file (or enableProfiling is
+#called); when off, a timed function or phase costs one dictionary lookup. Phases are inclusive: a phase timed inside another
+#phase counts towards both. Every process keeps its own totals; worker processes (which inherit RLA_PROFILE) write them to
+#<profile>.parts/<pid>.json when they exit, and writeProfile in the main process adds those parts to its own totals.
+#With RLA_TRACEMALLOC set (1, or a comma-separated list of phases to take tracemalloc snapshots around) or enableMemoryProfiling
+#called, phases timed on the main thread also record the traced memory they peak at and leave allocated.
+profileVariable = 'RLA_PROFILE'
+memoryVariable = 'RLA_TRACEMALLOC'
+profiling = {'enabled': False, 'file': None, 'pid': None, 'start': None}
+phaseStats = {} #phase name: [calls, seconds, longest call in seconds]
+counters = {} #counter name: total
+statsLock = threading.Lock()
+memory = {'enabled': False, 'snapshots': set(), 'top': 10}
+memoryStats = {} #phase name: [calls, highest peak above the memory at the start in bytes, bytes left allocated in total, top sites, bytes the call with the top sites left]
+memoryStack = [] #[memory at the start, highest peak seen so far, snapshot or None] for each phase open on the main thread
+
+
+def enableProfiling(profile_file = 'phase_profile.json'):
+    '''
+    Summary: Switches the timers and counters on, for this process and for the worker processes it starts, and writes the
+    profile when the process exits
+    Parameters: JSON file the profile is written to
+    '''
+    profile_file = os.path.abspath(profile_file)
+    os.environ[profileVariable] = profile_file
+    os.environ[profileVariable + '_OWNER'] = str(os.getpid())
+    if os.path.isdir(partsFolder(profile_file)):
+        rmtree(partsFolder(profile_file))
+    profiling['enabled'] = True
+    profiling['file'] = profile_file
+    profiling['pid'] = os.getpid()
+    profiling['start'] = time.time()
+    with statsLock:
+        phaseStats.clear()
+        counters.clear()
+        memoryStats.clear()
+    multiprocessing.util.Finalize(None, writeProfile, exitpriority = 10)
+
+def profilingEnabled():
+    return profiling['enabled']
+
+def enableMemoryProfiling(snapshotPhases = (), top = 10, frames = 1):
+    '''
+    Summary: Adds tracemalloc figures to the profile. For every phase timed on the main thread: the highest traced memory above
+    what was allocated when it started, and what it left allocated. For the phases in snapshotPhases, also the top allocation sites
+    by growth (compared with a snapshot taken when the phase started) in the call that left the most allocated. Tracing slows
+    allocation-heavy code several times over, so the times in a memory profile are not representative. Switches profiling on
+    (to phase_profile.json) if it is not on yet.
+    Parameters: phases to take snapshots around, number of allocation sites to keep, frames of traceback tracemalloc keeps
+    '''
+    if not profiling['enabled']:
+        enableProfiling(os.environ.get(profileVariable) or 'phase_profile.json')
+    snapshotPhases = [name for name in snapshotPhases if name]
+    os.environ[memoryVariable] = ','.join(snapshotPhases) or '1'
+    memory['enabled'] = True
+    memory['snapshots'] = set(snapshotPhases)
+    memory['top'] = top
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+def memoryEnter(name):
+    #start measuring a phase; returns the state memoryExit needs, None if the phase is not measured
+    if not memory['enabled'] or not tracemalloc.is_tracing() or threading.current_thread() is not threading.main_thread():
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    if memoryStack:
+        #the peak is reset below, so hand the one reached so far to the enclosing phase
+        memoryStack[-1][1] = max(memoryStack[-1][1], peak)
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+        peakKnown = True
+    else:
+        peakKnown = False
+    snapshot = tracemalloc.take_snapshot() if name in memory['snapshots'] else None
+    state = [current, current if peakKnown else None, snapshot]
+    memoryStack.append(state)
+    return state
+
+def memoryExit(name, state):
+    #finish measuring a phase started with memoryEnter
+    if memoryStack and memoryStack[-1] is state:
+        memoryStack.pop()
+    current, peak = tracemalloc.get_traced_memory()
+    if state[1] is not None:
+        peak = max(peak, state[1])
+        if memoryStack and memoryStack[-1][1] is not None:
+            memoryStack[-1][1] = max(memoryStack[-1][1], peak)
+        peakAbove = peak - state[0]
+    else:
+        #without tracemalloc.reset_peak (Python < 3.9) only the memory left allocated is known
+        peakAbove = None
+    top = None
+    if state[2] is not None:
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        growth = tracemalloc.take_snapshot().filter_traces(ignore).compare_to(state[2].filter_traces(ignore), 'lineno')
+        top = [str(stat) for stat in growth[:memory['top']]]
+    net = current - state[0]
+    with statsLock:
+        stats = memoryStats.get(name)
+        if stats is None:
+            memoryStats[name] = [1, peakAbove, net, top, net]
+        else:
+            stats[0] += 1
+            if peakAbove is not None:
+                stats[1] = peakAbove if stats[1] is None else max(stats[1], peakAbove)
+            stats[2] += net
+            if top is not None and (stats[3] is None or net > stats[4]):
+                stats[3] = top
+                stats[4] = net
+
+def _processStats():
+    #a forked worker starts with a copy of its parent's totals; drop them and write its own when it exits
+    if profiling['pid'] != os.getpid():
+        phaseStats.clear()
+        counters.clear()
+        memoryStats.clear()
+        del memoryStack[:]
+        profiling['pid'] = os.getpid()
+        profiling['start'] = time.time()
+        multiprocessing.util.Finalize(None, writePart, exitpriority = 10)
+
+def record(name, seconds):
+    #add one call of a phase
+    with statsLock:
+        _processStats()
+        stats = phaseStats.get(name)
+        if stats is None:
+            phaseStats[name] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+def count(name, amount = 1):
+    '''
+    Summary: Adds amount to a counter (when profiling is on)
+    '''
+    if not profiling['enabled']:
+        return
+    with statsLock:
+        _processStats()
+        counters[name] = counters.get(name, 0) + amount
+
+
+class Phase(object):
+    '''
+    Summary: Context manager timing one named phase: with phase('auditMath'): ...
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.memory = memoryEnter(self.name) if memory['enabled'] else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        record(self.name, time.perf_counter() - self.start)
+        if self.memory is not None:
+            memoryExit(self.name, self.memory)
+        return False
+
+
+class NoPhase(object):
+    #what phase returns when profiling is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+noPhase = NoPhase()
+
+def phase(name):
+    return Phase(name) if profiling['enabled'] else noPhase
+
+def timed(name):
+    '''
+    Summary: Decorator timing every call of a function as the named phase
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiling['enabled']:
+                return function(*args, **kwargs)
+            with Phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def profileSnapshot():
+    '''
+    Returns: this process's totals: {'processes', 'seconds', 'phases': {name: [calls, seconds, longest]}, 'counters',
+    'memory': {name: [calls, peak, net, top sites, net of the call the sites are from]}}
+    '''
+    with statsLock:
+        return {'processes': 1, 'seconds': time.time() - profiling['start'] if profiling['start'] else 0.0,
+                'phases': {name: list(stats) for name, stats in phaseStats.items()}, 'counters': dict(counters),
+                'memory': {name: list(stats) for name, stats in memoryStats.items()}}
+
+def mergeProfiles(profiles):
+    '''
+    Summary: Adds up snapshots from several processes; the seconds of the merged profile are the longest process's
+    Returns: merged snapshot
+    '''
+    merged = {'processes': 0, 'seconds': 0.0, 'phases': {}, 'counters': {}, 'memory': {}}
+    for profile in profiles:
+        merged['processes'] += profile['processes']
+        merged['seconds'] = max(merged['seconds'], profile['seconds'])
+        for name, (calls, seconds, longest) in profile['phases'].items():
+            stats = merged['phases'].setdefault(name, [0, 0.0, 0.0])
+            stats[0] += calls
+            stats[1] += seconds
+            stats[2] = max(stats[2], longest)
+        for name, amount in profile['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + amount
+        for name, (calls, peak, net, top, topNet) in profile.get('memory', {}).items():
+            stats = merged['memory'].setdefault(name, [0, None, 0, None, None])
+            stats[0] += calls
+            if peak is not None:
+                stats[1] = peak if stats[1] is None else max(stats[1], peak)
+            stats[2] += net
+            if top is not None and (stats[3] is None or topNet > stats[4]):
+                stats[3] = top
+                stats[4] = topNet
+    return merged
+
+def partsFolder(profile_file):
+    return profile_file + '.parts'
+
+def writePart():
+    #worker process: leave this process's totals for the main process to merge
+    if not profiling['enabled'] or not profiling['file']:
+        return
+    folder = partsFolder(profiling['file'])
+    os.makedirs(folder, exist_ok = True)
+    part_file = os.path.join(folder, str(os.getpid()) + '.json')
+    with open(part_file + '.tmp', mode = 'w') as writePart:
+        json.dump(profileSnapshot(), writePart)
+    os.replace(part_file + '.tmp', part_file)
+
+def writeProfile(profile_file = None):
+    '''
+    Summary: Writes this process's totals merged with the parts left by its worker processes, as JSON: wall seconds, number of
+    processes, per phase the calls, total, mean and longest seconds and share of the wall time (sorted by total), and the counters
+    Parameters: profile file (default the one profiling was enabled with)
+    Returns: the profile written, None if profiling is off
+    '''
+    if not profiling['enabled']:
+        return None
+    profile_file = profile_file or profiling['file']
+    profiles = [profileSnapshot()]
+    folder = partsFolder(profiling['file'])
+    if os.path.isdir(folder):
+        for name in sorted(os.listdir(folder)):
+            if name.endswith('.json'):
+                with open(os.path.join(folder, name), mode = 'r') as readPart:
+                    profiles.append(json.load(readPart))
+    merged = mergeProfiles(profiles)
+    wall = profiles[0]['seconds']
+    report = {'seconds': round(wall, 6), 'processes': merged['processes'], 'phases': {}, 'counters': merged['counters']}
+    for name, (calls, seconds, longest) in sorted(merged['phases'].items(), key = lambda item: item[1][1], reverse = True):
+        report['phases'][name] = {'calls': calls, 'seconds': round(seconds, 6), 'mean': round(seconds/calls, 9), 'longest': round(longest, 6),
+                                  'share': round(seconds/wall, 4) if wall > 0 else None}
+    if merged['memory']:
+        #bytes; peak is the most any one call reached above the memory allocated when it started
+        report['memory'] = {}
+        for name, (calls, peak, net, top, topNet) in sorted(merged['memory'].items(), key = lambda item: item[1][1] or 0, reverse = True):
+            report['memory'][name] = {'calls': calls, 'peak': peak, 'net': net, 'netPerCall': round(net/calls)}
+            if top is not None:
+                report['memory'][name]['top'] = top
+    with open(profile_file, mode = 'w') as writeReport:
+        json.dump(report, writeReport, indent = 1)
+    return report
+
+if os.environ.get(profileVariable):
+    if os.environ.get(profileVariable + '_OWNER', str(os.getpid())) == str(os.getpid()):
+        enableProfiling(os.environ[profileVariable])
+    else:
+        #a worker process started by a profiled one: count from here, write a part at exit
+        profiling['enabled'] = True
+        profiling['file'] = os.environ[profileVariable]
+        _processStats()
+if os.environ.get(memoryVariable):
+    enableMemoryProfiling([] if os.environ[memoryVariable] == '1' else os.environ[memoryVariable].split(','))
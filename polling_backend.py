@@ -20,6 +20,11 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SO
 from Election_Simulation import Election
 from election_files import *
 from shutil import rmtree
+from concurrent.futures import ThreadPoolExecutor
+from retrieval_planner import *
+from round_planner import *
+from phase_timers import *
+from math import log, exp, inf, sqrt
 
 def pollingSetup(E1):
     '''
@@ -37,23 +42,31 @@ def readFiles():
     Returns: Number of ballots in the election, number of votes for winner and runnerup, manifest/tabulation file paths
     '''
     #Read election data from the tabulation file
-    tabulation_file = str(os.path.join(sys.path[0], 'electionTabulation.csv'))
+    tabulation_file = str(os.path.join(sys.path[0], csvName('electionTabulation.csv')))
     numBallots, winnerBallots, runnerupBallots, margin = readTabulation(tabulation_file)
     #Read election data from the manifest file
-    manifest_file = str(os.path.join(sys.path[0], 'electionManifest.csv'))
+    manifest_file = str(os.path.join(sys.path[0], csvName('electionManifest.csv')))
     return numBallots, winnerBallots, runnerupBallots, tabulation_file, manifest_file
 
-def roundSample(numBallots, winnerBallots, runnerupBallots):
+def roundSample(numBallots, winnerBallots, runnerupBallots, roundTarget = None, riskLimit = 0.05, logT = 0.0):
     '''
-    Summary: Uses _pollingSample() function from Election_Simulation.py to return a sample size based on the ballot observations
-    Parameters: Number of ballots in the election, and number for the winner and runner-up
+    Summary: Uses _pollingSample() function from Election_Simulation.py to return a sample size based on the ballot observations,
+    or, with a roundTarget, the smallest round with at least that probability of meeting the risk limit (pollingRoundSize)
+    Parameters: Number of ballots in the election, and number for the winner and runner-up, target stopping probability,
+    risk limit and log test statistic so far (only used with a roundTarget)
     Returns: An audit sample size
     '''
-    E1 = Election(numBallots, 0, 0, 0, 0, 0)
-    size = E1._pollingSample(numBallots, winnerBallots, runnerupBallots)
+    size = roundSize(numBallots, winnerBallots, runnerupBallots, roundTarget, riskLimit, logT)
     print("Ballots to audit this round:", size)
     return size
 
+def roundSize(numBallots, winnerBallots, runnerupBallots, roundTarget = None, riskLimit = 0.05, logT = 0.0):
+    #roundSample without printing
+    if roundTarget is not None:
+        return pollingRoundSize(winnerBallots/numBallots, runnerupBallots/numBallots, riskLimit, logT, roundTarget, numBallots)
+    E1 = Election(numBallots, 0, 0, 0, 0, 0)
+    return E1._pollingSample(numBallots, winnerBallots, runnerupBallots)
+
 def removeWorkingDir():
     #remove files from previous run if dir exists 
     path =  'ballot_polling_pull_list'
@@ -65,10 +78,12 @@ def ballotSelect(size, seed, manifest_file):
     '''
     Summary: Uses batch sizes as weights to determine which batches to pull from, and then which ballots from the batches to pull
     Parameters: Sample size (to know how many ballots to pull), seed for randomness, and manifest file path
-    Returns: A CSV file with a list of ballots to pull to audit
+    Returns: A CSV file with a list of ballots to pull to audit, and a dict of batch name: ballot positions drawn (repeats kept)
     '''
-    random.seed(seed)
+    draw = random.Random(seed) #same draws as random.seed(seed), without resetting the global stream
+    drawn = {} #batch name: every ballot position drawn, for the retrieval plan
     pullList = {} #batch name: list of ballot positions
+    pulled = {} #batch name: set of ballot positions, for the duplicate check
     #Read data from the manifest file
     numBallots, batchNames, batchSizes, ballotsPerBatchTotal = readManifest(manifest_file)
     batchWeight = []
@@ -78,16 +93,19 @@ def ballotSelect(size, seed, manifest_file):
         batchWeight.append(batchSizes[i]/numBallots) 
 
     #Select ballot batches based on weights, then select random ballot from the batch
-    ballotBatches = random.choices(batchNames, weights = batchWeight, k = size)
+    ballotBatches = draw.choices(batchNames, weights = batchWeight, k = size)
     ballotBatches.sort()
     for batch in ballotBatches:
         #Checks if the batch is already in the dict
         if batch not in pullList:
             pullList[batch] = []
+            pulled[batch] = set()
         #Pulls ballot
-        ballotID = random.randint(1, int(ballotsPerBatchTotal[batch]))
+        ballotID = draw.randint(1, int(ballotsPerBatchTotal[batch]))
+        drawn.setdefault(batch, []).append(ballotID)
         #Ensure no duplicate ballots are added to list since sampling with replacement
-        if ballotID not in pullList[batch]:
+        if ballotID not in pulled[batch]:
+            pulled[batch].add(ballotID)
             pullList[batch].append(ballotID)
 
     #Removes current directory and makes new one
@@ -101,9 +119,9 @@ def ballotSelect(size, seed, manifest_file):
     numToAudit = 0
     print("Making ballot pull sheets now.")
     for batch in pullList:
-        fileName = batch + "_Pull_Sheet.csv"
+        fileName = csvName(batch + "_Pull_Sheet.csv")
         completeName = os.path.join(sys.path[0], save_path, fileName)
-        pullsheet = open(completeName, mode = 'w', newline = '')
+        pullsheet = openFile(completeName, mode = 'w', newline = '')
         pullsheet_writer = csv.writer(pullsheet)
         pullsheet_writer.writerow(["Batch Name", "Ballot Position in Batch"])
         pullList[batch].sort()
@@ -113,6 +131,127 @@ def ballotSelect(size, seed, manifest_file):
         pullsheet.close()
 
     print("After sampling, there are", numToAudit, "ballots to pull. Check ballot_polling_pull_list folder for the list of ballots.")
+    return drawn
+
+@timed('drawPullList')
+def drawPullList(size, seed, manifest_file, manifest = None):
+    '''
+    Summary: Draws the whole sample at once with numpy. Picking a batch with probability proportional to its size and then a
+    position uniformly in it is the same as picking one of the numBallots ballots uniformly, so each draw is a single integer
+    mapped back to (batch, position) through the cumulative batch sizes. Duplicates are dropped with np.unique.
+    Parameters: Sample size, seed for randomness, and manifest file path (and its ManifestColumns, if already loaded)
+    Returns: batch names in manifest order, and arrays of batch index, ballot position (1-based) and times drawn for each ballot
+    to pull, sorted by batch name and then position
+    '''
+    if manifest is None:
+        manifest = loadManifest(manifest_file)
+    batchNames = manifest.batchNames
+    batchEnds = np.cumsum(manifest.sizes)
+    numBallots = int(batchEnds[-1]) if len(batchEnds) else 0
+    if numBallots == 0 or size <= 0:
+        return batchNames, np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+
+    rng = np.random.default_rng(seed)
+    ballots, times = np.unique(rng.integers(0, numBallots, size = size), return_counts = True)
+    batch = np.searchsorted(batchEnds, ballots, side = 'right')
+    position = ballots - (batchEnds[batch] - manifest.sizes[batch]) + 1
+
+    #pull sheets are sorted by batch name, like ballotSelect
+    nameRank = np.empty(len(batchNames), dtype = np.int64)
+    nameRank[sorted(range(len(batchNames)), key = batchNames.__getitem__)] = np.arange(len(batchNames))
+    order = np.lexsort((position, nameRank[batch]))
+    return batchNames, batch[order], position[order], times[order]
+
+@timed('CSV writing: pull sheets')
+def writePullSheets(batchNames, batch, position, save_path = 'ballot_polling_pull_list', consolidated = True, maxWriters = 8):
+    '''
+    Summary: Writes the pull list from drawPullList, either as one Pull_Sheet.csv sorted by batch and position, or as one
+    <batch>_Pull_Sheet.csv per batch like ballotSelect. Per-batch sheets are written by a pool of at most maxWriters threads,
+    which also bounds the number of files open at once.
+    Parameters: batch names, batch index and position arrays, output folder, consolidated or per-batch sheets, writer pool size
+    Returns: list of pull sheet file paths
+    '''
+    removeWorkingDir()
+    os.makedirs(save_path, exist_ok = True)
+    names = np.array(batchNames, dtype = object)[batch] if len(batch) else np.zeros(0, dtype = object)
+
+    if consolidated:
+        completeName = os.path.join(sys.path[0], save_path, csvName('Pull_Sheet.csv'))
+        with openFile(completeName, mode = 'w', newline = '') as pullsheet:
+            pullsheet_writer = csv.writer(pullsheet)
+            pullsheet_writer.writerow(["Batch Name", "Ballot Position in Batch"])
+            pullsheet_writer.writerows(zip(names.tolist(), position.tolist()))
+        return [completeName]
+
+    #rows are grouped by batch, so each sheet is one slice of the arrays
+    bounds = np.flatnonzero(batch[1:] != batch[:-1]) + 1
+    starts = np.concatenate(([0], bounds)).tolist() if len(batch) else []
+    ends = np.concatenate((bounds, [len(batch)])).tolist() if len(batch) else []
+
+    def writeSheet(bound):
+        start, end = bound
+        completeName = os.path.join(sys.path[0], save_path, csvName(names[start] + "_Pull_Sheet.csv"))
+        with openFile(completeName, mode = 'w', newline = '') as pullsheet:
+            pullsheet_writer = csv.writer(pullsheet)
+            pullsheet_writer.writerow(["Batch Name", "Ballot Position in Batch"])
+            pullsheet_writer.writerows(zip(names[start:end].tolist(), position[start:end].tolist()))
+        return completeName
+
+    with ThreadPoolExecutor(max_workers = max(1, maxWriters)) as writers:
+        return list(writers.map(writeSheet, zip(starts, ends)))
+
+def pullListSelect(size, seed, manifest_file, consolidated = True, maxWriters = 8, pullList = None):
+    '''
+    Summary: Vectorized ballotSelect for large samples: draws the pull list with drawPullList and writes it with writePullSheets.
+    The sample follows the same distribution as ballotSelect but not the same random sequence, so the ballots differ for a seed.
+    Parameters: Sample size, seed for randomness, manifest file path, one consolidated sheet or per-batch sheets, writer pool size,
+    pullList (the drawPullList result for this size and seed if it was drawn ahead)
+    Returns: dict of batch name: ballot positions drawn (repeats kept), like ballotSelect
+    '''
+    batchNames, batch, position, times = pullList if pullList is not None else drawPullList(size, seed, manifest_file)
+    print("Making ballot pull sheets now.")
+    writePullSheets(batchNames, batch, position, consolidated = consolidated, maxWriters = maxWriters)
+    print("After sampling, there are", len(position), "ballots to pull. Check ballot_polling_pull_list folder for the list of ballots.")
+    drawn = {}
+    for batchIndex, ballot, count in zip(batch.tolist(), position.tolist(), times.tolist()):
+        drawn.setdefault(batchNames[batchIndex], []).extend([ballot]*count)
+    return drawn
+
+def likelyTallies(sampleSize, winnerShare, runnerupShare, spread = (0, -1, 1, -2, 2)):
+    '''
+    Summary: Tallies a round of sampleSize ballots is likely to show at the given shares: the winner ballots at their expected
+    number and the given numbers of standard deviations away, with winner and runnerup ballots together at their expected number
+    Returns: list of (winner ballots, runnerup ballots), most likely first
+    '''
+    valid = min(sampleSize, int(round(sampleSize*(winnerShare + runnerupShare))))
+    share = winnerShare/(winnerShare + runnerupShare) if winnerShare + runnerupShare > 0 else 0
+    deviation = sqrt(valid*share*(1 - share))
+    tallies = []
+    for k in spread:
+        winner = min(valid, max(0, int(round(valid*share + k*deviation))))
+        if (winner, valid - winner) not in tallies:
+            tallies.append((winner, valid - winner))
+    return tallies
+
+def prepareRounds(tallies, sampleSize, sw, logT, riskLimit, roundTarget, seed, manifest_file, manifest):
+    '''
+    Summary: Runs on a background thread while a round's tally is entered. Sizes the next round for each likely tally (which also
+    fills the pollingRoundSize cache for roundTarget) and, for the vectorized pull list, draws it
+    Parameters: likely tallies, this round's sample size, sw, log test statistic before this round, risk limit, target stopping
+    probability, seed, manifest file path, ManifestColumns read on the main thread for the vectorized pull list (None otherwise;
+    the thread does not use the file caches)
+    Returns: dict of next sample size: drawPullList result (None if not vectorized)
+    '''
+    prepared = {}
+    for sampledWinner, sampledRunnerup in tallies:
+        nextLogT = logRiskUpdate(sw, logT, sampledWinner, sampledRunnerup)
+        if nextLogT >= -log(riskLimit) or nextLogT < 0 or sampledWinner + sampledRunnerup == 0:
+            #that tally ends the audit
+            continue
+        size = roundSize(sampleSize, sampledWinner, sampledRunnerup, roundTarget, riskLimit, nextLogT)
+        if size not in prepared:
+            prepared[size] = drawPullList(size, seed, manifest_file, manifest) if manifest is not None else None
+    return prepared
 
 def roundInput():
     '''
@@ -123,24 +262,59 @@ def roundInput():
     sampledRunnerup = input("Please enter the number of runnerup ballots: ")
     return sampledWinner, sampledRunnerup
 
+def logRiskUpdate(sw, logT, sampledWinner, sampledRunnerup):
+    '''
+    Summary: Closed form of the BRAVO update: log T grows by sampledWinner*log(2sw) + sampledRunnerup*log(2(1-sw))
+    Parameters: sw, log of the test statistic, the number of Winner votes and the number of Runnerup votes in the sample
+    Returns: log of the test statistic
+    '''
+    winnerWeight, runnerupWeight = bravoWeights(sw)
+    if sampledWinner > 0:
+        logT += sampledWinner*winnerWeight
+    if sampledRunnerup > 0:
+        logT += sampledRunnerup*runnerupWeight
+    return logT
+
 def calculateRisk(sw, T, sampledWinner, sampledRunnerup):
     '''
     Summary: Uses math from Stark's A Gentle Introduction to calculate the risk limit for the round
     Parameters: sw and T, the number of Winner votes and the number of Runnerup votes in the sample
     Returns: Test statistic T
     '''
-    while (sampledWinner > 0):
-        T *= sw/.5
-        sampledWinner -= 1
-    while (sampledRunnerup > 0):
-        T *= (1 - sw)/.5
-        sampledRunnerup -= 1
-    return T
+    logT = logRiskUpdate(sw, log(T) if T > 0 else -inf, sampledWinner, sampledRunnerup)
+    return exp(logT) if logT < 709 else inf
+
+def stoppingTable(sw, riskLimit, maxSampleSize, logT = 0.0):
+    '''
+    Summary: BRAVO stopping table. For each number of ballots sampled n (winner plus runnerup ballots), the audit can stop once
+    k*log(2sw) + (n-k)*log(2(1-sw)) >= log(1/riskLimit) - logT, so the smallest such winner count k has a closed form.
+    Parameters: sw, risk limit, largest sample size in the table, log of the test statistic before the sample (0 for a new audit)
+    Returns: numpy array where entry n-1 is the minimum winner count to stop after n ballots, or -1 if n ballots cannot stop the audit
+    '''
+    n = np.arange(1, int(maxSampleSize) + 1, dtype = np.int64)
+    k = bravoMinimumWinners(n, sw, -log(riskLimit) - logT)
+    return np.where(k <= n, k, -1).astype(np.int64)
+
+def writeStoppingTable(table, file_name):
+    '''
+    Summary: Writes a stopping table as a lookup sheet for auditors
+    Parameters: table from stoppingTable, file path
+    '''
+    with openFile(file_name, mode = 'w', newline = '') as writeTable:
+        tableWriter = csv.writer(writeTable)
+        tableWriter.writerow(["Ballots Sampled", "Winner Ballots Needed to Stop"])
+        tableWriter.writerows((n, stop if stop >= 0 else '') for n, stop in enumerate(table.tolist(), 1))
 
-def pollingAudit(E1 = None, flag = 0):
+def pollingAudit(E1 = None, flag = 0, vectorized = False, numTeams = 0, roundTarget = None, observations = None, speculate = False):
     '''
     Summary: Run a ballot polling audit.
-    Parameters: An election object
+    Parameters: An election object, flag = 1 to create the election files, vectorized = True to build the pull list with
+    pullListSelect (one consolidated sheet) instead of ballotSelect, numTeams > 0 to also write a retrieval plan with that many
+    team packets, roundTarget (e.g. 0.9) to size each round for that probability of stopping instead of the BRAVO ASN,
+    observations to take each round's tally from a function (round number, sample size) -> (winner ballots, runnerup ballots)
+    instead of asking with roundInput, speculate = True to size (and, vectorized, draw) the next round for the likely tallies on a
+    background thread while a round's tally is entered. Speculation only runs when vectorized or with a roundTarget: otherwise
+    the next round is the closed-form BRAVO ASN, which there is nothing to gain from computing ahead
     Returns: The observed risk limit
     '''
     if (flag == 1):
@@ -149,28 +323,60 @@ def pollingAudit(E1 = None, flag = 0):
     #Reads in data from the tabulation and ballot manifest
     numBallots, winnerBallots, runnerupBallots, tabulation_file, manifest_file = readFiles()
     seed = 2368607141
-    T = 1 #Test statistic for ballot polling risk limit
+    logT = 0.0 #log of the test statistic for ballot polling risk limit
+    roundNumber = 0
+    speculation = None #rounds being prepared while the tally is entered
+    executor = ThreadPoolExecutor(max_workers = 1) if speculate and (vectorized or roundTarget is not None) else None
     #Continues running rounds until risk limit is met
-    while True:
-        #Calculate a sample size
-        sampleSize = roundSample(numBallots, winnerBallots, runnerupBallots)
-        #Select the ballots from the sample size
-        ballotSelect(sampleSize, seed, manifest_file)
-        #Enter the number of Winner ballots and Runnerup ballots observed in the sample
-        sampledWinner, sampledRunnerup = roundInput()
-        sampledWinner = int(sampledWinner)
-        sampledRunnerup = int(sampledRunnerup)
-        #Calculate the observed risk limit
-        sw = winnerBallots/numBallots
-        T = calculateRisk(sw, T, sampledWinner, sampledRunnerup)
-        #Determine if more auditing is necessary
-        if (T >= 1/E1.riskLimit):
-            print("Audit complete. You may stop auditing. Observed risk limit = ", 1/T)
-            break
-        elif (1/T > 1): #How to actually get this value?
-            raise ValueError("A full hand recount is necessary to determine the winner.")
-        else:
-            print("Another round is necessary. Observed risk limit for the round =", 1/T)
-            winnerBallots = sampledWinner
-            runnerupBallots = sampledRunnerup
-            numBallots = sampleSize
+    try:
+        while True:
+            roundNumber += 1
+            #Calculate a sample size
+            sampleSize = roundSample(numBallots, winnerBallots, runnerupBallots, roundTarget, E1.riskLimit, logT)
+            prepared = {}
+            if speculation is not None:
+                try:
+                    prepared = speculation.result()
+                except Exception as error:
+                    print('Preparing the next round ahead failed (' + str(error) + '), selecting it now.')
+                speculation = None
+                if vectorized and sampleSize in prepared:
+                    print('Round ' + str(roundNumber) + ' was prepared while the last tally was entered.')
+            #Select the ballots from the sample size
+            if vectorized:
+                drawn = pullListSelect(sampleSize, seed, manifest_file, pullList = prepared.get(sampleSize))
+            else:
+                drawn = ballotSelect(sampleSize, seed, manifest_file)
+            if numTeams > 0:
+                retrievalPlan(drawn, loadManifest(manifest_file).rows, numTeams, os.path.join('ballot_polling_pull_list', 'retrieval_plan'))
+            #lookup sheet: winner ballots needed to stop for each number of ballots tallied this round
+            sw = winnerBallots/numBallots
+            writeStoppingTable(stoppingTable(sw, E1.riskLimit, sampleSize, logT), os.path.join(sys.path[0], 'ballot_polling_pull_list', csvName('BRAVO_Stopping_Table.csv')))
+            if executor is not None:
+                #the tally is expected to follow the shares the sample was drawn at
+                speculation = executor.submit(prepareRounds, likelyTallies(sampleSize, winnerBallots/numBallots, runnerupBallots/numBallots), sampleSize,
+                                              sw, logT, E1.riskLimit, roundTarget, seed, manifest_file,
+                                              loadManifest(manifest_file) if vectorized else None)
+            #Enter the number of Winner ballots and Runnerup ballots observed in the sample
+            if observations is None:
+                sampledWinner, sampledRunnerup = roundInput()
+            else:
+                sampledWinner, sampledRunnerup = observations(roundNumber, sampleSize)
+            sampledWinner = int(sampledWinner)
+            sampledRunnerup = int(sampledRunnerup)
+            #Calculate the observed risk limit
+            logT = logRiskUpdate(sw, logT, sampledWinner, sampledRunnerup)
+            #Determine if more auditing is necessary
+            if (logT >= -log(E1.riskLimit)):
+                print("Audit complete. You may stop auditing. Observed risk limit = ", exp(-logT))
+                return exp(-logT)
+            elif (logT < 0): #How to actually get this value?
+                raise ValueError("A full hand recount is necessary to determine the winner.")
+            else:
+                print("Another round is necessary. Observed risk limit for the round =", exp(-logT))
+                winnerBallots = sampledWinner
+                runnerupBallots = sampledRunnerup
+                numBallots = sampleSize
+    finally:
+        if executor is not None:
+            executor.shutdown()
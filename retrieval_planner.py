@@ -0,0 +1,156 @@
+import heapq
+from election_files import *
+
+#Estimated audit-room seconds for each step of pulling ballots. Opening a container dominates, then finding a tabulator's
+#stack and a batch in it; a ballot drawn k times is pulled once and recorded k times.
+retrievalCosts = {'container': 120.0, 'tabulator': 30.0, 'batch': 20.0, 'ballot': 8.0, 'repeat': 2.0}
+planHeader = ['Container', 'Tabulator', 'Batch Name', 'Ballot Position in Batch', 'Times Selected', 'Pull']
+
+
+def manifestLocations(manifest_rows):
+    '''
+    Summary: Physical location of every batch from the manifest rows (Container, Tabulator, Batch Name, Number of Ballots)
+    Returns: dict of batch name: (container, tabulator, batch rank), where the rank is the batch's place in the manifest; containers,
+    tabulators and batches are retrieved in the order they are listed in the manifest, which is the order they were stored
+    '''
+    containerRank = {}
+    tabulatorRank = {}
+    locations = {}
+    for rank, row in enumerate(manifest_rows):
+        container, tabulator, batch = row[0], row[1], row[2]
+        containerRank.setdefault(container, len(containerRank))
+        tabulatorRank.setdefault((container, tabulator), len(tabulatorRank))
+        locations[batch] = (container, tabulator, (containerRank[container], tabulatorRank[(container, tabulator)], rank))
+    return locations
+
+def planRetrieval(selections, manifest_rows):
+    '''
+    Summary: Orders the selected ballots for retrieval: by container, then tabulator, then batch as stored, then position in the
+    batch. Ballots drawn more than once (sampling with replacement) become a single entry pulled once, "position × k".
+    Parameters: dict of batch name: ballot positions drawn (repeats kept), manifest rows
+    Returns: list of plan rows [container, tabulator, batch, position, times selected, pull text]
+    '''
+    locations = manifestLocations(manifest_rows)
+    entries = []
+    for batch in selections:
+        if batch not in locations:
+            raise ValueError('Batch ' + str(batch) + ' was selected but is not in the manifest.')
+        container, tabulator, rank = locations[batch]
+        times = {}
+        for position in selections[batch]:
+            position = int(position)
+            times[position] = times.get(position, 0) + 1
+        for position in times:
+            entries.append((rank, position, [container, tabulator, batch, position, times[position]]))
+    entries.sort(key = lambda entry: (entry[0], entry[1]))
+
+    plan = []
+    for rank, position, row in entries:
+        row.append(str(position) if row[4] == 1 else str(position) + ' × ' + str(row[4]))
+        plan.append(row)
+    return plan
+
+def retrievalCost(plan, costs = retrievalCosts):
+    '''
+    Summary: Estimated seconds to pull the ballots in a plan (rows in plan order)
+    Returns: estimated seconds
+    '''
+    containers = set()
+    tabulators = set()
+    batches = set()
+    seconds = 0.0
+    for container, tabulator, batch, position, times, pull in plan:
+        if container not in containers:
+            containers.add(container)
+            seconds += costs['container']
+        if (container, tabulator) not in tabulators:
+            tabulators.add((container, tabulator))
+            seconds += costs['tabulator']
+        if batch not in batches:
+            batches.add(batch)
+            seconds += costs['batch']
+        seconds += costs['ballot'] + costs['repeat']*(times - 1)
+    return seconds
+
+def teamPackets(plan, numTeams, costs = retrievalCosts):
+    '''
+    Summary: Splits a plan into work packets for numTeams retrieval teams. Work is handed out in whole containers so a container
+    is opened by one team; only a container with more than a fair share (total cost / numTeams) is split, first by tabulator and
+    then by batch. The pieces are handed out longest first, each to the team with the least estimated work so far
+    (longest-processing-time greedy, within 4/3 of the best possible balance).
+    Parameters: plan from planRetrieval, number of teams, step costs
+    Returns: list of (estimated seconds, plan rows) per team, rows kept in plan order
+    '''
+    numTeams = max(1, int(numTeams))
+    fairShare = retrievalCost(plan, costs)/numTeams
+    levels = [lambda row: row[0], lambda row: (row[0], row[1]), lambda row: row[2]] #container, tabulator, batch
+
+    units = [] #(index of the first row in the plan, rows)
+    pending = [(0, 0, plan)] #(level to group by, first row index, rows)
+    while pending:
+        level, start, rows = pending.pop()
+        groups = {} #key: (first row index, rows)
+        for index, row in enumerate(rows, start):
+            key = levels[level](row)
+            if key not in groups:
+                groups[key] = (index, [])
+            groups[key][1].append(row)
+        for index, groupRows in groups.values():
+            #split an oversized group at the next level that actually divides it
+            nextLevel = level + 1
+            while nextLevel < len(levels) and len(set(map(levels[nextLevel], groupRows))) == 1:
+                nextLevel += 1
+            if nextLevel < len(levels) and retrievalCost(groupRows, costs) > fairShare:
+                pending.append((nextLevel, index, groupRows))
+            else:
+                units.append((index, groupRows))
+    units.sort(key = lambda unit: retrievalCost(unit[1], costs), reverse = True)
+
+    loads = [(0.0, team) for team in range(numTeams)]
+    assigned = [[] for team in range(numTeams)]
+    for unit in units:
+        load, team = heapq.heappop(loads)
+        assigned[team].append(unit)
+        heapq.heappush(loads, (load + retrievalCost(unit[1], costs), team))
+
+    packets = []
+    for team in range(numTeams):
+        #keep each team's work in storage order
+        rows = [row for index, unitRows in sorted(assigned[team], key = lambda unit: unit[0]) for row in unitRows]
+        packets.append((retrievalCost(rows, costs), rows))
+    return packets
+
+def writeRetrievalPlan(packets, save_path):
+    '''
+    Summary: Writes Team<n>_Packet.csv for every team and a Retrieval_Summary.csv with each team's workload
+    Parameters: packets from teamPackets, output folder
+    Returns: list of packet file paths
+    '''
+    os.makedirs(save_path, exist_ok = True)
+    packet_files = []
+    with openFile(os.path.join(save_path, csvName('Retrieval_Summary.csv')), mode = 'w', newline = '') as writeSummary:
+        summaryWriter = csv.writer(writeSummary)
+        summaryWriter.writerow(['Team', 'Containers', 'Batches', 'Ballots', 'Ballots Selected', 'Estimated Minutes'])
+        for team, (seconds, rows) in enumerate(packets, 1):
+            packet_file = os.path.join(save_path, csvName('Team' + str(team) + '_Packet.csv'))
+            packet_files.append(packet_file)
+            with openFile(packet_file, mode = 'w', newline = '') as writePacket:
+                packetWriter = csv.writer(writePacket)
+                packetWriter.writerow(planHeader)
+                packetWriter.writerows(rows)
+            summaryWriter.writerow([team, len(set(row[0] for row in rows)), len(set(row[2] for row in rows)), len(rows),
+                                    sum(row[4] for row in rows), round(seconds/60, 1)])
+    return packet_files
+
+def retrievalPlan(selections, manifest_rows, numTeams = 1, save_path = 'retrieval_plan', costs = retrievalCosts):
+    '''
+    Summary: Plans and writes the retrieval of the selected ballots for numTeams teams
+    Parameters: dict of batch name: ballot positions drawn (repeats kept), manifest rows, number of teams, output folder, step costs
+    Returns: packets from teamPackets
+    '''
+    plan = planRetrieval(selections, manifest_rows)
+    packets = teamPackets(plan, numTeams, costs)
+    writeRetrievalPlan(packets, save_path)
+    print("Retrieval plan: " + str(len(plan)) + " ballots in " + str(len(set(row[0] for row in plan))) + " containers for " + str(len(packets)) +
+          " teams, estimated " + str(round(max([packet[0] for packet in packets] + [0])/60, 1)) + " minutes. Check the " + save_path + " folder for the packets.")
+    return packets
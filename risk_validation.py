@@ -0,0 +1,227 @@
+import argparse
+import csv
+import json
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from math import ceil, exp, lgamma, log, log1p
+from fast_comparison import *
+from rng_streams import childGenerator, seedEntropy
+
+#Checks that ballot comparison audits, with each treatment of questionable ballots, keep the chance of confirming a wrong
+#outcome at or below the risk limit. nullDistribution adds one-vote (or two-vote) overstatements to a cell's discrepancies
+#until the expected net overstatement of the true ballots erases the reported margin (a tie) or reverses it by a vote
+#(flipped); validateRisk then runs millions of audits of that election on the vectorized engine of fast_comparison, in chunks
+#spread over worker processes, and streams the running false-acceptance rate with exact (Clopper-Pearson) bounds.
+#Under a wrong outcome 1/observedrisk is a nonnegative supermartingale, so an audit whose observedrisk has reached r can still
+#meet the risk limit with probability at most riskLimit/r (Ville's inequality). Audits above riskLimit/giveUp are counted as
+#going to a full hand count; this can hide at most giveUp of the acceptance rate, which is added to the upper bound.
+
+
+def betaFraction(x, a, b):
+    #continued fraction of the incomplete beta function (modified Lentz)
+    tiny = 1e-300
+    c = 1.0
+    d = 1 - (a + b)*x/(a + 1)
+    d = 1/(d if abs(d) > tiny else tiny)
+    fraction = d
+    for m in range(1, 200000):
+        for numerator in (m*(b - m)*x/((a + 2*m - 1)*(a + 2*m)), -(a + m)*(a + b + m)*x/((a + 2*m)*(a + 2*m + 1))):
+            d = 1 + numerator*d
+            d = 1/(d if abs(d) > tiny else tiny)
+            c = 1 + numerator/c
+            c = c if abs(c) > tiny else tiny
+            fraction *= d*c
+        if abs(d*c - 1) < 1e-15:
+            break
+    return fraction
+
+def regularizedBeta(x, a, b):
+    '''
+    Returns: I_x(a, b), the regularized incomplete beta function (for a binomial, P(X >= k | n, p) = I_p(k, n - k + 1))
+    '''
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    front = exp(lgamma(a + b) - lgamma(a) - lgamma(b) + a*log(x) + b*log1p(-x))
+    if x < (a + 1)/(a + b + 2):
+        return front*betaFraction(x, a, b)/a
+    return 1 - front*betaFraction(1 - x, b, a)/b
+
+def betaQuantile(q, a, b):
+    #x with I_x(a, b) = q, by bisection
+    low, high = 0.0, 1.0
+    for _ in range(100):
+        middle = (low + high)/2
+        if regularizedBeta(middle, a, b) < q:
+            low = middle
+        else:
+            high = middle
+    return (low + high)/2
+
+def clopperPearson(accepted, trials, confidence = 0.95):
+    '''
+    Summary: Exact binomial confidence interval for a rate of accepted out of trials
+    Returns: lower bound, upper bound
+    '''
+    tail = (1 - confidence)/2
+    if trials == 0:
+        return 0.0, 1.0
+    if accepted == 0:
+        low = 0.0
+        high = 1 - tail**(1/trials)
+    elif accepted == trials:
+        low = tail**(1/trials)
+        high = 1.0
+    else:
+        low = betaQuantile(tail, accepted, trials - accepted + 1)
+        high = betaQuantile(1 - tail, accepted + 1, trials - accepted)
+    return low, high
+
+def nullDistribution(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, gamma, margin,
+                     questionableMath = 0, qAsMark = 1, qAuditor = 0, outcome = 'tied', errors = 'overvotes1'):
+    '''
+    Summary: ComparisonDistribution of an election whose reported outcome (margin, in percent of numBallots) is wrong: the
+    cell's discrepancies, with the questionable ballots at their expected discrepancy, plus enough one-vote ('overvotes1') or
+    two-vote ('overvotes2') overstatements that the net overstatement reaches the margin ('tied') or passes it by a vote ('flipped')
+    Returns: the ComparisonDistribution, number of overstatements added
+    '''
+    if outcome not in ('tied', 'flipped') or errors not in ('overvotes1', 'overvotes2'):
+        raise ValueError("outcome is 'tied' or 'flipped', errors 'overvotes1' or 'overvotes2'.")
+    questionableMean = sum(value*probability for value, probability in questionableOutcomes(questionableMath, qAsMark, qAuditor).items())
+    overstated = overvotes1 + 2*overvotes2 - undervotes1 - 2*undervotes2 + questionable*questionableMean
+    needed = margin/100*numBallots + (1 if outcome == 'flipped' else 0) - overstated
+    added = max(int(ceil((needed if errors == 'overvotes1' else needed/2) - 1e-9)), 0)
+    if errors == 'overvotes1':
+        overvotes1 += added
+    else:
+        overvotes2 += added
+    if overvotes1 + undervotes1 + overvotes2 + undervotes2 + questionable > numBallots:
+        raise ValueError("The margin is too large to overturn with " + errors + " in " + str(numBallots) + " ballots.")
+    return ComparisonDistribution(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, gamma, margin,
+                                  questionableMath, qAsMark, qAuditor), added
+
+def validationChunk(distribution, seed, chunk, trials, ceiling):
+    '''
+    Summary: One chunk of validateRisk (run in a worker process): trials audits drawn from childGenerator(seed, chunk)
+    Returns: chunk, trials, audits that met the risk limit, ballots drawn in total
+    '''
+    ballots, success = comparisonAudits(distribution, trials, childGenerator(seed, chunk), ceiling = ceiling)
+    return chunk, trials, int(np.count_nonzero(success)), int(ballots.sum())
+
+def validateRisk(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, gamma, margin,
+                 questionableMath = 0, qAsMark = 1, qAuditor = 0, outcome = 'tied', errors = 'overvotes1', trials = 1000000,
+                 chunk = 50000, workers = None, seed = None, confidence = 0.95, giveUp = 1e-9, ndjson_file = None, quiet = False):
+    '''
+    Summary: False-acceptance rate of incremental comparison audits of a wrong outcome (see nullDistribution), from trials audits
+    run chunk at a time in worker processes (os.cpu_count() by default). After every chunk the running totals are printed
+    and, with ndjson_file, appended to it as one JSON object. Chunk k draws from childGenerator(seed, k), so the result does not
+    depend on the number of workers.
+    Parameters: cell parameters as in collectData, 'tied' or 'flipped', overstatements to add, number of audits, audits per
+    chunk, worker processes, seed, confidence level of the bounds, give-up probability (see above), NDJSON file, no printing
+    Returns: dict of the final totals: 'accepted', 'trials', 'rate', 'low' and 'high' (Clopper-Pearson bounds, high including
+    giveUp), 'riskLimit', 'withinLimit' (whether high <= riskLimit), 'addedErrors', 'meanBallots', 'seed', 'seconds'
+    '''
+    seed = seedEntropy(seed)
+    distribution, added = nullDistribution(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, gamma,
+                                           margin, questionableMath, qAsMark, qAuditor, outcome, errors)
+    ceiling = log(riskLimit) - log(giveUp) if giveUp else None
+    sizes = [min(chunk, trials - first) for first in range(0, trials, chunk)]
+    totals = {'outcome': outcome, 'questionableMath': questionableMath, 'qAsMark': qAsMark, 'qAuditor': qAuditor, 'margin': margin,
+              'addedErrors': added, 'errors': errors, 'riskLimit': riskLimit, 'seed': seed, 'chunks': 0, 'trials': 0, 'accepted': 0, 'ballots': 0}
+    start = time.time()
+
+    def report(result):
+        #add a finished chunk to the totals and stream them
+        totals['chunks'] += 1
+        totals['trials'] += result[1]
+        totals['accepted'] += result[2]
+        totals['ballots'] += result[3]
+        low, high = clopperPearson(totals['accepted'], totals['trials'], confidence)
+        totals.update({'rate': totals['accepted']/totals['trials'], 'low': low, 'high': min(high + (giveUp or 0), 1.0),
+                       'meanBallots': totals['ballots']/totals['trials'], 'seconds': round(time.time() - start, 3)})
+        totals['withinLimit'] = totals['high'] <= riskLimit
+        if ndjson_file is not None:
+            with open(ndjson_file, mode = 'a') as writeReport:
+                writeReport.write(json.dumps(totals) + '\n')
+        if not quiet:
+            print('QMath ' + str(questionableMath) + ' ' + outcome + ': ' + str(totals['accepted']) + '/' + str(totals['trials']) +
+                  ' accepted, rate ' + str(round(totals['rate'], 6)) + ' [' + str(round(low, 6)) + ', ' + str(round(totals['high'], 6)) +
+                  '], risk limit ' + str(riskLimit) + ', ' + str(totals['seconds']) + 's', flush = True)
+
+    workers = max(1, min(int(workers or os.cpu_count() or 1), len(sizes)))
+    if workers == 1:
+        for index, size in enumerate(sizes):
+            report(validationChunk(distribution, seed, index, size, ceiling))
+    else:
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            #keep two chunks a worker in flight, so results stream in without queueing every chunk up front
+            pending = set()
+            upcoming = iter(enumerate(sizes))
+            for index, size in upcoming:
+                pending.add(pool.submit(validationChunk, distribution, seed, index, size, ceiling))
+                if len(pending) >= 2*workers:
+                    break
+            while pending:
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    report(future.result())
+                    following = next(upcoming, None)
+                    if following is not None:
+                        pending.add(pool.submit(validationChunk, distribution, seed, following[0], following[1], ceiling))
+    return totals
+
+def validateTreatments(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, gamma, margin,
+                       qAsMark = 0.5, qAuditor = 0.5, outcomes = ('tied', 'flipped'), csv_file = None, **options):
+    '''
+    Summary: validateRisk for the baseline (0), Bayesian (1) and conservative (2) treatments and each outcome. As in tests(),
+    the reported margin of the baseline and Bayesian treatments counts the questionable ballots marked on the CVR
+    (margin + 100*questionable/numBallots*qAsMark); the conservative one uses margin.
+    Parameters: cell parameters as in collectData, outcomes to check, CSV file for the table, options for validateRisk
+    Returns: list of validateRisk results
+    '''
+    if options.get('ndjson_file') is not None:
+        open(options['ndjson_file'], mode = 'w').close()
+    results = []
+    for questionableMath in (0, 1, 2):
+        reported = margin if questionableMath == 2 else 100*(margin/100 + questionable/numBallots*qAsMark)
+        for outcome in outcomes:
+            results.append(validateRisk(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, gamma, reported,
+                                        questionableMath, qAsMark, qAuditor, outcome, **options))
+    if csv_file is not None:
+        with open(csv_file, mode = 'w', newline = '') as writeTable:
+            table = csv.writer(writeTable)
+            table.writerow(["QMath", "Outcome", "Margin", "Added Overstatements", "Trials", "Accepted", "Rate", "Lower Bound", "Upper Bound", "Risk Limit", "Within Limit"])
+            for result in results:
+                table.writerow([result['questionableMath'], result['outcome'], result['margin'], result['addedErrors'], result['trials'], result['accepted'],
+                                result['rate'], result['low'], result['high'], result['riskLimit'], result['withinLimit']])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = 'False-acceptance rates of comparison audits of wrong outcomes, for the questionable-ballot treatments.')
+    parser.add_argument('--ballots', type = int, default = 20000)
+    parser.add_argument('--overvotes1', type = int, default = 0)
+    parser.add_argument('--undervotes1', type = int, default = 0)
+    parser.add_argument('--overvotes2', type = int, default = 0)
+    parser.add_argument('--undervotes2', type = int, default = 0)
+    parser.add_argument('--questionable', type = int, default = 0)
+    parser.add_argument('--risk-limit', type = float, default = 0.05)
+    parser.add_argument('--gamma', type = float, default = 1.1)
+    parser.add_argument('--margin', type = float, default = 1, help = 'reported margin in percent')
+    parser.add_argument('--q-as-mark', type = float, default = 0.5)
+    parser.add_argument('--q-auditor', type = float, default = 0.5)
+    parser.add_argument('--trials', type = int, default = 1000000)
+    parser.add_argument('--chunk', type = int, default = 50000)
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--ndjson', help = 'stream the running totals of every cell to this file')
+    parser.add_argument('--csv', help = 'write the final table to this file')
+    args = parser.parse_args()
+    validateTreatments(args.ballots, args.overvotes1, args.undervotes1, args.overvotes2, args.undervotes2, args.questionable, args.risk_limit,
+                       args.gamma, args.margin, args.q_as_mark, args.q_auditor, csv_file = args.csv, trials = args.trials, chunk = args.chunk,
+                       workers = args.workers, seed = args.seed, ndjson_file = args.ndjson)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import random
+import numpy as np
+
+#Seeded random streams for the simulations. A run has one seed (an int, or None for fresh entropy that is recorded so the run
+#can be repeated); every trial, worker or round draws from a child stream keyed by its place in the run, for example
+#childGenerator(seed, margin index, trial number). A child stream depends only on the seed and its key, so results do not
+#depend on the number of workers or the order trials run in, and any single trial can be replayed from the seed and its key.
+#The audit procedures themselves (selectBatches, ballotSelect, drawPullList) keep drawing from the published audit seed.
+blockSize = 4096
+
+
+def seedSequence(seed = None):
+    '''
+    Summary: numpy SeedSequence for an int seed, a SeedSequence, or fresh entropy for None
+    '''
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+def seedEntropy(seed):
+    '''
+    Returns: the entropy of a seed (an int to record with the results; passing it back as the seed repeats the run)
+    '''
+    return seedSequence(seed).entropy
+
+def childSeed(seed, *key):
+    '''
+    Summary: Independent child of a seed for the place in a run given by key (non-negative ints, e.g. margin index and trial)
+    Returns: SeedSequence
+    '''
+    parent = seedSequence(seed)
+    return np.random.SeedSequence(parent.entropy, spawn_key = tuple(parent.spawn_key) + tuple(int(part) for part in key))
+
+def childGenerator(seed, *key):
+    '''
+    Summary: numpy Generator for the child stream of a seed at key
+    '''
+    return np.random.Generator(np.random.PCG64(childSeed(seed, *key)))
+
+
+class GeneratorRandom(random.Random):
+    '''
+    Summary: The random module's interface (random, randint, choices, shuffle, sample, ...) drawing from a numpy Generator, so
+    code written against the random module can take a seeded stream. Doubles and 32-bit words are drawn from the Generator
+    in blocks; seed() does nothing, the Generator holds the state.
+    Parameters: numpy Generator
+    '''
+    def __init__(self, rng):
+        self.rng = rng
+        self._doubles = []
+        self._words = []
+        self._nextDouble = self._nextWord = 0
+        super(GeneratorRandom, self).__init__()
+
+    def seed(self, *args, **kwargs):
+        pass
+
+    def random(self):
+        if self._nextDouble == len(self._doubles):
+            self._doubles = self.rng.random(blockSize).tolist()
+            self._nextDouble = 0
+        self._nextDouble += 1
+        return self._doubles[self._nextDouble - 1]
+
+    def getrandbits(self, k):
+        if k <= 0:
+            return 0
+        bits = 0
+        filled = 0
+        while filled < k:
+            if self._nextWord == len(self._words):
+                self._words = self.rng.integers(0, 2**32, blockSize, dtype = np.uint64).tolist()
+                self._nextWord = 0
+            bits |= self._words[self._nextWord] << filled
+            self._nextWord += 1
+            filled += 32
+        return bits >> (filled - k)
+
+    def __reduce__(self):
+        #random.Random pickles through getstate; this one pickles the Generator and the unused part of the blocks
+        return self.__class__, (self.rng,), dict(self.__dict__)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def getstate(self):
+        raise NotImplementedError('GeneratorRandom keeps its state in the numpy Generator.')
+
+    def setstate(self, state):
+        raise NotImplementedError('GeneratorRandom keeps its state in the numpy Generator.')
+
+
+def randomSource(rng = None):
+    '''
+    Summary: What simulation code draws from: the random module itself when rng is None (the global stream, as before), else
+    a GeneratorRandom over rng (a numpy Generator, or a seed for one)
+    '''
+    if rng is None:
+        return random
+    if not isinstance(rng, np.random.Generator):
+        rng = np.random.default_rng(rng)
+    return GeneratorRandom(rng)
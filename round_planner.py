@@ -0,0 +1,177 @@
+import numpy as np
+from math import log, sqrt, lgamma, ceil, floor, inf
+from functools import lru_cache
+
+#Round sizes chosen so the audit has at least a target probability of stopping at the end of the round, assuming the reported
+#results (and, for comparison audits, the discrepancy rates) are what the sample will show. Probabilities are exact binomial
+#sums over a window of +/- tailWidth standard deviations; the mass outside the window is below 1e-30.
+tailWidth = 40
+#entries kept by each planner cache; the arguments are continuous (risks, rates), so an unbounded cache would grow with every
+#trial and round that calls the planner
+cacheSize = 4096
+
+
+def binomialWindow(n, p):
+    #range of outcomes of Binomial(n, p) holding all but a negligible part of the mass
+    mean = n*p
+    spread = tailWidth*sqrt(n*p*(1 - p)) + tailWidth
+    return max(0, int(floor(mean - spread))), min(n, int(ceil(mean + spread)))
+
+def binomialPMF(n, p, low, high):
+    '''
+    Summary: Binomial(n, p) probabilities of low..high, from the log probability of low and the ratios between neighbours
+    Returns: numpy array of probabilities
+    '''
+    k = np.arange(low + 1, high + 1, dtype = np.float64)
+    logFirst = lgamma(n + 1) - lgamma(low + 1) - lgamma(n - low + 1) + low*log(p) + (n - low)*log(1 - p)
+    logPMF = logFirst + np.concatenate(([0.0], np.cumsum(np.log((n - k + 1)/k) + log(p/(1 - p)))))
+    return np.exp(logPMF)
+
+@lru_cache(maxsize = cacheSize)
+def binomialTail(n, p, k):
+    '''
+    Summary: P(X >= k) for X ~ Binomial(n, p)
+    '''
+    if k <= 0:
+        return 1.0
+    if k > n or p <= 0:
+        return 0.0
+    if p >= 1:
+        return 1.0
+    low, high = binomialWindow(n, p)
+    if k > high:
+        return 0.0
+    return float(min(1.0, binomialPMF(n, p, low, high)[max(k, low) - low:].sum()))
+
+def bravoWeights(sw):
+    #log of the factor T is multiplied by for each winner and each runnerup ballot in the sample
+    winnerWeight = log(sw/.5) if sw > 0 else -inf
+    runnerupWeight = log((1 - sw)/.5) if sw < 1 else -inf
+    return winnerWeight, runnerupWeight
+
+def bravoMinimumWinners(n, sw, needed):
+    '''
+    Summary: Smallest winner count k with k*log(2sw) + (n-k)*log(2(1-sw)) >= needed, for each number of ballots in n
+    Parameters: numpy array of ballot counts, sw, log(1/riskLimit) minus the log test statistic so far
+    Returns: numpy array of winner counts, n + 1 where n ballots cannot stop the audit
+    '''
+    n = np.asarray(n, dtype = np.float64)
+    winnerWeight, runnerupWeight = bravoWeights(sw)
+    if sw >= 1:
+        #a single runnerup ballot sets T to 0, so every ballot has to be for the winner
+        k = np.where(n*winnerWeight >= needed - 1e-9, n, n + 1)
+    elif sw <= .5:
+        #winner ballots never raise T, so the fewest winner ballots (none) is the best case
+        k = np.where(n*runnerupWeight >= needed - 1e-9, 0, n + 1)
+    else:
+        k = np.maximum(np.ceil((needed - n*runnerupWeight)/(winnerWeight - runnerupWeight) - 1e-9), 0)
+    return np.minimum(k, n + 1).astype(np.int64)
+
+@lru_cache(maxsize = cacheSize)
+def pollingStopProbability(n, pw, pl, riskLimit, logT = 0.0):
+    '''
+    Summary: Probability that a BRAVO audit stops after n more ballots, when each ballot is for the winner with probability pw,
+    for the runnerup with probability pl, and for neither otherwise (sw = pw as in pollingAudit)
+    Parameters: ballots in the round, reported winner and runnerup shares, risk limit, log test statistic from earlier rounds
+    Returns: probability
+    '''
+    needed = -log(riskLimit) - logT
+    if needed <= 0:
+        return 1.0
+    if n <= 0 or needed == inf:
+        return 0.0
+    valid = min(1.0, pw + pl)
+    if valid >= 1:
+        return binomialTail(n, pw, int(bravoMinimumWinners(n, pw, needed)))
+    if valid <= 0:
+        return 0.0
+    #condition on the number of winner or runnerup ballots m among the n
+    low, high = binomialWindow(n, valid)
+    mass = binomialPMF(n, valid, low, high)
+    kmin = bravoMinimumWinners(np.arange(low, high + 1), pw, needed).tolist()
+    share = pw/valid
+    return float(min(1.0, sum(weight*binomialTail(m, share, k) for m, weight, k in zip(range(low, high + 1), mass.tolist(), kmin) if weight > 1e-30)))
+
+@lru_cache(maxsize = cacheSize)
+def comparisonStopProbability(n, dilutedMargin, r1, r2, riskLimit, gamma = 1.1, logRisk = 0.0):
+    '''
+    Summary: Probability that a Kaplan-Markov comparison audit stops after n more ballots, when each ballot is a one-vote
+    overstatement with probability r1 and a two-vote overstatement with probability r2. Understatements only lower the risk, so
+    leaving them out gives a lower bound on the probability (and a round size that is, if anything, too large)
+    Parameters: ballots in the round, diluted margin (fraction), overstatement rates, risk limit, gamma, log risk from earlier rounds
+    Returns: probability
+    '''
+    if n <= 0:
+        return 1.0 if logRisk < log(riskLimit) else 0.0
+    oneWeight = -log(1 - 1/(2*gamma))
+    twoWeight = -log(1 - 1/gamma) if gamma > 1 else inf
+    #risk stays above the limit unless o1*oneWeight + o2*twoWeight < room
+    room = log(riskLimit) - logRisk - n*log(1 - dilutedMargin/(2*gamma))
+    if room <= 0:
+        return 0.0
+    rate = r1 + r2
+    if rate <= 0:
+        return 1.0
+    maxDiscrepancies = min(n, int(ceil(room/oneWeight)) - 1) #every discrepancy costs at least oneWeight
+    if maxDiscrepancies < 0:
+        return 0.0
+    if rate >= 1:
+        counts, mass = [n], [1.0]
+    else:
+        low, high = binomialWindow(n, rate)
+        high = min(high, maxDiscrepancies)
+        if high < low:
+            return 0.0
+        counts, mass = range(low, high + 1), binomialPMF(n, rate, low, high).tolist()
+    twoShare = r2/rate
+    probability = 0.0
+    for d, weight in zip(counts, mass):
+        if d > maxDiscrepancies or weight <= 1e-30:
+            continue
+        #at most maxTwo of the d discrepancies may be two-vote overstatements
+        maxTwo = d if twoWeight == oneWeight else int(ceil((room - d*oneWeight)/(twoWeight - oneWeight))) - 1
+        probability += weight*(1 - binomialTail(d, twoShare, maxTwo + 1))
+    return float(min(1.0, probability))
+
+def smallestRoundSize(stopProbability, target, maxSize):
+    '''
+    Summary: Smallest round size n <= maxSize with stopProbability(n) >= target, by doubling and then bisecting (the stopping
+    probability grows with n, apart from small steps from the discreteness of the counts)
+    Returns: round size, maxSize if even maxSize does not reach the target
+    '''
+    maxSize = int(maxSize)
+    if maxSize <= 1:
+        return max(maxSize, 0)
+    high = 1
+    while high < maxSize and stopProbability(high) < target:
+        high = min(2*high, maxSize)
+    if stopProbability(high) < target:
+        return maxSize
+    low = high//2
+    while high - low > 1:
+        middle = (low + high)//2
+        if stopProbability(middle) >= target:
+            high = middle
+        else:
+            low = middle
+    return high
+
+@lru_cache(maxsize = cacheSize)
+def pollingRoundSize(pw, pl, riskLimit, logT = 0.0, target = 0.9, maxSize = 10**7):
+    '''
+    Summary: Smallest ballot polling round with at least target probability of meeting the risk limit at the end of the round
+    Parameters: reported winner and runnerup shares of all ballots, risk limit, log test statistic from earlier rounds,
+    target stopping probability, largest round allowed (e.g. the number of ballots)
+    Returns: round size
+    '''
+    return smallestRoundSize(lambda n: pollingStopProbability(n, pw, pl, riskLimit, logT), target, maxSize)
+
+@lru_cache(maxsize = cacheSize)
+def comparisonRoundSize(dilutedMargin, r1, r2, riskLimit, gamma = 1.1, logRisk = 0.0, target = 0.9, maxSize = 10**7):
+    '''
+    Summary: Smallest ballot comparison round with at least target probability of meeting the risk limit at the end of the round
+    Parameters: diluted margin (fraction), expected one- and two-vote overstatement rates, risk limit, gamma, log risk from
+    earlier rounds, target stopping probability, largest round allowed (e.g. the number of ballots)
+    Returns: round size
+    '''
+    return smallestRoundSize(lambda n: comparisonStopProbability(n, dilutedMargin, r1, r2, riskLimit, gamma, logRisk), target, maxSize)
@@ -0,0 +1,89 @@
+import numpy as np
+try:
+    from multiprocessing import shared_memory
+except ImportError: #Python 3.7
+    shared_memory = None
+
+#Numpy arrays published once in a multiprocessing.shared_memory block for the worker processes of a pool. A SharedArrays
+#object pickles as its handle (block name and array layout), so passing it to a worker, as an argument or through a pool
+#initializer, sends a few hundred bytes, and the worker gets read-only views of the same memory instead of copies.
+#Blocks are attached once per worker process and kept open until it exits.
+attachedBlocks = {} #block name: SharedMemory, in processes that attached a block published elsewhere
+alignment = 64
+
+
+def sharedMemoryAvailable():
+    return shared_memory is not None
+
+
+class SharedArrays(object):
+    '''
+    Summary: Read-only numpy arrays in one shared memory block. The process that creates it owns the block and has to release()
+    it once the workers are done with it; workers only read.
+    Parameters: dict of name: numpy array to publish
+    '''
+    def __init__(self, arrays):
+        if shared_memory is None:
+            raise RuntimeError('Shared memory needs Python 3.8 or later.')
+        self.layout = {} #name: (dtype, shape, offset)
+        size = 0
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            self.layout[name] = (array.dtype.str, array.shape, size)
+            size += -(-array.nbytes//alignment)*alignment
+        self.block = shared_memory.SharedMemory(create = True, size = max(size, 1))
+        self.owner = True
+        self.arrays = self._views()
+        for name, array in arrays.items():
+            self.arrays[name].setflags(write = True)
+            self.arrays[name][...] = array
+            self.arrays[name].setflags(write = False)
+
+    def _views(self):
+        views = {}
+        for name, (dtype, shape, offset) in self.layout.items():
+            views[name] = np.ndarray(shape, dtype = np.dtype(dtype), buffer = self.block.buf, offset = offset)
+            views[name].setflags(write = False)
+        return views
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def keys(self):
+        return self.arrays.keys()
+
+    def __getstate__(self):
+        return {'name': self.block.name, 'layout': self.layout}
+
+    def __setstate__(self, state):
+        self.layout = state['layout']
+        self.owner = False
+        if state['name'] not in attachedBlocks:
+            attachedBlocks[state['name']] = shared_memory.SharedMemory(name = state['name'])
+        self.block = attachedBlocks[state['name']]
+        self.arrays = self._views()
+
+    def release(self):
+        '''
+        Summary: Frees the block (publishing process only; workers still attached keep their mapping until they exit)
+        '''
+        if not self.owner or self.block is None:
+            return
+        self.arrays = {}
+        self.block.unlink()
+        try:
+            self.block.close()
+        except BufferError:
+            #views handed out from this object are still alive; the mapping goes when they do
+            pass
+        self.block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+        return False
@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import multiprocessing.util
+from shutil import rmtree
+
+#Live progress for long simulation sweeps. Off unless the RLA_PROGRESS environment variable holds a report interval in seconds
+#(or startProgress is called); when off, progressTrial costs one dictionary lookup. Every process counts its own trials, sampled
+#ballots and finished cells; worker processes (which inherit RLA_PROGRESS) leave their running totals in <progress folder>/<pid>.json
+#at most once an interval, and a reporter thread in the main process adds them to its own and writes one line to stderr and,
+#with RLA_PROGRESS_FILE (or ndjson_file), one JSON object to an NDJSON file per interval.
+progressVariable = 'RLA_PROGRESS'
+progressState = {'enabled': False, 'interval': 10.0, 'folder': None, 'file': None, 'owner': False, 'pid': None, 'start': None,
+                 'nextWrite': 0.0, 'cells': None, 'trialsPerCell': None, 'last': None}
+progressTotals = {'trials': 0, 'ballots': 0, 'cells': 0}
+progressReporter = {'thread': None, 'stop': None}
+
+
+def startProgress(cells = None, trialsPerCell = None, interval = 10.0, ndjson_file = None):
+    '''
+    Summary: Switches progress reports on for this process and the worker processes it starts, and starts the reporter thread
+    (only the first call starts anything; later calls add to the plan)
+    Parameters: number of cells (simulation runs) planned, trials in each cell, seconds between reports, NDJSON file for the reports
+    '''
+    if progressState['enabled'] and progressState['owner']:
+        planProgress(cells, trialsPerCell)
+        return
+    interval = float(interval)
+    if ndjson_file is not None:
+        ndjson_file = os.path.abspath(ndjson_file)
+    folder = os.path.join(tempfile.gettempdir(), 'rla_progress_' + str(os.getpid()))
+    if os.path.isdir(folder):
+        rmtree(folder)
+    os.environ[progressVariable] = str(interval)
+    os.environ[progressVariable + '_OWNER'] = str(os.getpid())
+    os.environ[progressVariable + '_DIR'] = folder
+    if ndjson_file is not None:
+        os.environ[progressVariable + '_FILE'] = ndjson_file
+        open(ndjson_file, mode = 'w').close()
+    progressState.update({'enabled': True, 'interval': interval, 'folder': folder, 'file': ndjson_file, 'owner': True, 'pid': os.getpid(),
+                          'start': time.time(), 'cells': None, 'trialsPerCell': None, 'last': None})
+    progressTotals.update({'trials': 0, 'ballots': 0, 'cells': 0})
+    planProgress(cells, trialsPerCell)
+    progressReporter['stop'] = threading.Event()
+    progressReporter['thread'] = threading.Thread(target = _reportLoop, args = (progressReporter['stop'],), name = 'progress reporter', daemon = True)
+    progressReporter['thread'].start()
+    multiprocessing.util.Finalize(None, stopProgress, exitpriority = 10)
+
+def planProgress(cells = None, trialsPerCell = None):
+    '''
+    Summary: Adds cells to the plan the ETA is worked out from
+    Parameters: number of cells, trials in each cell
+    '''
+    if cells is None or not progressState['enabled']:
+        return
+    progressState['cells'] = (progressState['cells'] or 0) + cells
+    if trialsPerCell is not None:
+        progressState['trialsPerCell'] = trialsPerCell
+
+def progressEnabled():
+    return progressState['enabled']
+
+def progressTrial(ballots = 0):
+    '''
+    Summary: Counts one finished trial and the ballots it sampled (when progress reports are on)
+    '''
+    if not progressState['enabled']:
+        return
+    progressTotals['trials'] += 1
+    progressTotals['ballots'] += int(ballots)
+    if not progressState['owner']:
+        _workerWrite()
+
+def progressCellDone():
+    '''
+    Summary: Counts one finished cell (when progress reports are on)
+    '''
+    if not progressState['enabled']:
+        return
+    progressTotals['cells'] += 1
+    if not progressState['owner']:
+        _workerWrite(force = True)
+
+def _workerWrite(force = False):
+    #worker process: leave the running totals for the reporter, at most once an interval
+    if not progressState['folder']:
+        return
+    now = time.monotonic()
+    if not force and now < progressState['nextWrite']:
+        return
+    progressState['nextWrite'] = now + progressState['interval']
+    os.makedirs(progressState['folder'], exist_ok = True)
+    part_file = os.path.join(progressState['folder'], str(os.getpid()) + '.json')
+    with open(part_file + '.tmp', mode = 'w') as writePart:
+        json.dump(progressTotals, writePart)
+    os.replace(part_file + '.tmp', part_file)
+
+def _childCounts():
+    #a forked worker starts with a copy of its parent's totals; count its own and write them for the reporter
+    if not progressState['enabled']:
+        return
+    progressTotals.update({'trials': 0, 'ballots': 0, 'cells': 0})
+    progressState.update({'owner': False, 'pid': os.getpid(), 'nextWrite': 0.0})
+    progressReporter.update({'thread': None, 'stop': None})
+    multiprocessing.util.Finalize(None, _workerWrite, args = (True,), exitpriority = 10)
+
+def progressSnapshot():
+    '''
+    Returns: totals of this process and the worker processes it started: {'trials', 'ballots', 'cells', 'processes'}
+    '''
+    merged = dict(progressTotals)
+    merged['processes'] = 1
+    folder = progressState['folder']
+    if folder and os.path.isdir(folder):
+        for name in os.listdir(folder):
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(folder, name), mode = 'r') as readPart:
+                        part = json.load(readPart)
+                except (OSError, ValueError):
+                    continue
+                for key in ('trials', 'ballots', 'cells'):
+                    merged[key] += part[key]
+                merged['processes'] += 1
+    return merged
+
+def progressReport(final = False):
+    '''
+    Summary: Works out the rates since the start and since the last report, cells done and remaining and the ETA (from the trials
+    remaining in the plan, or the cells remaining when the trials per cell are not known)
+    Returns: report dict
+    '''
+    now = time.time()
+    merged = progressSnapshot()
+    elapsed = now - progressState['start']
+    last = progressState['last'] or {'time': progressState['start'], 'trials': 0, 'ballots': 0}
+    window = now - last['time']
+    report = {'time': round(now, 3), 'elapsed': round(elapsed, 3), 'processes': merged['processes'], 'trials': merged['trials'],
+              'ballots': merged['ballots'], 'cellsDone': merged['cells'], 'cellsRemaining': None,
+              'trialsPerSecond': round(merged['trials']/elapsed, 3) if elapsed > 0 else None,
+              'ballotsPerSecond': round(merged['ballots']/elapsed, 3) if elapsed > 0 else None,
+              'recentTrialsPerSecond': round((merged['trials'] - last['trials'])/window, 3) if window > 0 else None,
+              'recentBallotsPerSecond': round((merged['ballots'] - last['ballots'])/window, 3) if window > 0 else None,
+              'eta': None, 'final': final}
+    if progressState['cells'] is not None:
+        report['cellsRemaining'] = max(progressState['cells'] - merged['cells'], 0)
+        if progressState['trialsPerCell'] and merged['trials'] > 0:
+            remaining = max(progressState['cells']*progressState['trialsPerCell'] - merged['trials'], 0)
+            report['eta'] = round(remaining*elapsed/merged['trials'], 1)
+        elif merged['cells'] > 0:
+            report['eta'] = round(report['cellsRemaining']*elapsed/merged['cells'], 1)
+    progressState['last'] = {'time': now, 'trials': merged['trials'], 'ballots': merged['ballots']}
+    return report
+
+def clockTime(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(round(seconds))
+    return str(seconds//3600) + ':' + str(seconds//60 % 60).zfill(2) + ':' + str(seconds % 60).zfill(2)
+
+def emitProgress(final = False):
+    '''
+    Summary: Writes a report line to stderr and, if there is one, to the NDJSON file
+    Returns: the report
+    '''
+    report = progressReport(final)
+    cells = str(report['cellsDone']) + ('/' + str(report['cellsDone'] + report['cellsRemaining']) if report['cellsRemaining'] is not None else '')
+    print('progress: ' + cells + ' cells, ' + str(report['trials']) + ' trials (' + str(report['recentTrialsPerSecond']) + '/s), ' +
+          str(report['ballots']) + ' ballots (' + str(report['recentBallotsPerSecond']) + '/s), ' + str(report['processes']) +
+          ' processes, elapsed ' + clockTime(report['elapsed']) + ', ETA ' + clockTime(report['eta']), file = sys.stderr, flush = True)
+    if progressState['file']:
+        with open(progressState['file'], mode = 'a') as writeReport:
+            writeReport.write(json.dumps(report) + '\n')
+    return report
+
+def _reportLoop(stop):
+    while not stop.wait(progressState['interval']):
+        emitProgress()
+
+def stopProgress():
+    '''
+    Summary: Stops the reporter thread and writes a final report (main process only)
+    Returns: the final report, None if progress reports are off
+    '''
+    if not progressState['enabled'] or not progressState['owner']:
+        return None
+    if progressReporter['stop'] is not None:
+        progressReporter['stop'].set()
+        progressReporter['thread'].join()
+    report = emitProgress(final = True)
+    progressState['enabled'] = False
+    for name in ('', '_OWNER', '_DIR', '_FILE'):
+        os.environ.pop(progressVariable + name, None)
+    if progressState['folder'] and os.path.isdir(progressState['folder']):
+        rmtree(progressState['folder'], ignore_errors = True)
+    return report
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = _childCounts)
+if os.environ.get(progressVariable):
+    if os.environ.get(progressVariable + '_OWNER', str(os.getpid())) == str(os.getpid()):
+        startProgress(interval = float(os.environ[progressVariable]), ndjson_file = os.environ.get(progressVariable + '_FILE'))
+    else:
+        #a worker process started by a reporting one: count from here, leave the totals for the reporter
+        progressState.update({'enabled': True, 'interval': float(os.environ[progressVariable]), 'folder': os.environ.get(progressVariable + '_DIR'),
+                              'owner': False, 'pid': os.getpid(), 'start': time.time()})
+        multiprocessing.util.Finalize(None, _workerWrite, args = (True,), exitpriority = 10)
@@ -0,0 +1,325 @@
+import Questionable_Simulation
+import rng_streams
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import numpy as np
+
+#Distributed Questionable_Simulation sweeps through one SQLite file. A coordinator enqueues collectData cells split into
+#chunks of trials; any number of workers, on this machine or on any host that can open the file, claim a chunk with a lease,
+#run its trials and commit the result. A worker renews its lease while it runs; a chunk whose lease runs out (the worker died
+#or lost the file) goes back to the queue and is retried, up to maxAttempts claims. Trial t of a cell draws from
+#childGenerator(sweep seed, cell, t), so the results do not depend on the chunk size, the number of workers or which worker
+#runs a chunk; a retried chunk draws the same trials, and a late commit of a chunk that is already done is ignored.
+#  python sweep_queue.py worker sweep.db          (run a worker until the queue is empty)
+#  python sweep_queue.py status sweep.db
+#  python sweep_queue.py summary sweep.db [csv]
+queueSchema = '''
+CREATE TABLE IF NOT EXISTS cells (cell INTEGER PRIMARY KEY, params TEXT, trials INTEGER, seed TEXT);
+CREATE TABLE IF NOT EXISTS chunks (chunk INTEGER PRIMARY KEY, cell INTEGER, position INTEGER, first INTEGER, trials INTEGER,
+                                   status TEXT, worker TEXT, lease_until REAL, attempts INTEGER, result TEXT, error TEXT);
+CREATE INDEX IF NOT EXISTS chunks_status ON chunks (status, chunk);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+#collectData parameters a cell sets (num is the cell's number of trials)
+cellParameters = ['numBallots', 'overvotes1', 'undervotes1', 'overvotes2', 'undervotes2', 'questionable', 'riskLimit', 'gamma',
+                  'margin', 'simulationType', 'questionableMath', 'qAsMark', 'qAuditor']
+cellDefaults = {'simulationType': 1, 'questionableMath': 0, 'qAsMark': 1, 'qAuditor': 0}
+
+
+def questionableCells(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, num, gamma, margins,
+                      qMarks, auditorOffsets = (-.4, -.2, 0, .2, .4), questionableMaths = (0, 1, 2)):
+    '''
+    Summary: The cells of a p_cvr x p_a x margin x QMath grid, set up the way Questionable_Simulation.tests sets up its cells: the
+    baseline (0) and Bayesian (1) approaches audit the margin widened by the questionable ballots marked for the winner, the
+    conservative approach (2) the margin itself; auditor rates outside [0, 1] are left out
+    Parameters: election parameters as in collectData, margins, rates questionable ballots are marked on the CVR (qAsMark),
+    auditor rates as offsets from qMark, questionable math approaches
+    Returns: list of cell dicts
+    '''
+    cells = []
+    for margin in margins:
+        for qMark in qMarks:
+            for offset in auditorOffsets:
+                auditorRate = round(qMark + offset, 10)
+                if auditorRate < 0 or auditorRate > 1:
+                    continue
+                largeMargin = 100 * (margin / 100 + questionable / numBallots * qMark)
+                for questionableMath in questionableMaths:
+                    cells.append({'numBallots': numBallots, 'overvotes1': overvotes1, 'undervotes1': undervotes1, 'overvotes2': overvotes2,
+                                  'undervotes2': undervotes2, 'questionable': questionable, 'riskLimit': riskLimit, 'num': num, 'gamma': gamma,
+                                  'margin': margin if questionableMath == 2 else largeMargin, 'simulationType': 1,
+                                  'questionableMath': questionableMath, 'qAsMark': qMark, 'qAuditor': auditorRate})
+    return cells
+
+
+class SweepQueue(object):
+    '''
+    Summary: Work queue of sweep chunks in a SQLite file. Claims run in an immediate transaction, so two workers never hold the
+    same chunk under a live lease.
+    Parameters: database file path, lease length in seconds, claims allowed per chunk before it is marked failed
+    '''
+    def __init__(self, db_file = 'sweepQueue.db', lease = 300.0, maxAttempts = 3):
+        self.db_file = db_file
+        self.lease = float(lease)
+        self.maxAttempts = maxAttempts
+        self.db = sqlite3.connect(db_file, timeout = 60, isolation_level = None)
+        self.db.executescript(queueSchema)
+
+    def close(self):
+        self.db.close()
+
+    def setState(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO state VALUES (?,?)', (key, json.dumps(value)))
+
+    def getState(self, key, default = None):
+        row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def enqueue(self, cells, jsonFile, trialsPerChunk = 100, seed = None):
+        '''
+        Summary: Adds cells, split into chunks of at most trialsPerChunk trials. The election JSON is stored in the queue, so
+        workers on other hosts need only the database file.
+        Parameters: list of cell dicts (collectData parameters, num = trials), JSON file information, chunk size, sweep seed
+        (fresh entropy if None; it is stored with the cells)
+        Returns: list of cell ids
+        '''
+        seed = rng_streams.seedEntropy(seed)
+        cellIDs = []
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.setState('jsonFile', jsonFile)
+            for cell in cells:
+                params = dict(cellDefaults)
+                params.update({key: value for key, value in cell.items() if key != 'num'})
+                missing = [key for key in cellParameters if key not in params]
+                if missing:
+                    raise ValueError('Cell is missing ' + ', '.join(missing) + '.')
+                cellID = self.db.execute('INSERT INTO cells (params, trials, seed) VALUES (?,?,?)',
+                                         (json.dumps(params), int(cell['num']), str(seed))).lastrowid
+                for position, start in enumerate(range(0, int(cell['num']), trialsPerChunk)):
+                    self.db.execute('INSERT INTO chunks (cell, position, first, trials, status, attempts) VALUES (?,?,?,?,?,0)',
+                                    (cellID, position, start, min(trialsPerChunk, int(cell['num']) - start), 'pending'))
+                cellIDs.append(cellID)
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        return cellIDs
+
+    def claim(self, worker):
+        '''
+        Summary: Leases the first pending chunk, or the first chunk whose lease has run out
+        Returns: (chunk id, cell id, cell parameters, sweep seed, first trial, trials), None if there is nothing to claim
+        '''
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            #chunks whose last lease ran out after the last allowed claim will not be retried
+            self.db.execute("UPDATE chunks SET status = 'failed', error = 'lease expired' WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                            (now, self.maxAttempts))
+            row = self.db.execute("SELECT chunk, cell, first, trials FROM chunks WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) "
+                                  "ORDER BY chunk LIMIT 1", (now,)).fetchone()
+            if row is None:
+                self.db.execute('COMMIT')
+                return None
+            chunk, cell, first, trials = row
+            self.db.execute("UPDATE chunks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE chunk = ?",
+                            (worker, now + self.lease, chunk))
+            params, seed = self.db.execute('SELECT params, seed FROM cells WHERE cell = ?', (cell,)).fetchone()
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        return chunk, cell, json.loads(params), int(seed), first, trials
+
+    def renew(self, chunk, worker):
+        #extend a lease this worker still holds; False if it has lost it
+        return self.db.execute("UPDATE chunks SET lease_until = ? WHERE chunk = ? AND worker = ? AND status = 'leased'",
+                               (time.time() + self.lease, chunk, worker)).rowcount == 1
+
+    def complete(self, chunk, result):
+        #the first result committed for a chunk is kept (a retried chunk draws the same trials)
+        return self.db.execute("UPDATE chunks SET status = 'done', result = ?, error = NULL WHERE chunk = ? AND status != 'done'",
+                               (json.dumps(result), chunk)).rowcount == 1
+
+    def fail(self, chunk, worker, error):
+        #give the chunk back for a retry, or mark it failed after maxAttempts claims
+        self.db.execute("UPDATE chunks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?, lease_until = NULL "
+                        "WHERE chunk = ? AND worker = ? AND status = 'leased'", (self.maxAttempts, error, chunk, worker))
+
+    def status(self):
+        '''
+        Returns: dict of chunk status: number of chunks, with the trials done and planned
+        '''
+        counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        counts.update(dict(self.db.execute('SELECT status, COUNT(*) FROM chunks GROUP BY status')))
+        counts['trialsDone'] = self.db.execute("SELECT COALESCE(SUM(trials), 0) FROM chunks WHERE status = 'done'").fetchone()[0]
+        counts['trials'] = self.db.execute('SELECT COALESCE(SUM(trials), 0) FROM chunks').fetchone()[0]
+        return counts
+
+    def finished(self):
+        return self.db.execute("SELECT COUNT(*) FROM chunks WHERE status IN ('pending', 'leased')").fetchone()[0] == 0
+
+    def cellResults(self):
+        '''
+        Summary: Results of the cells whose chunks are all done, chunks joined in order
+        Returns: list of (cell parameters, ballots compared per trial, successes per trial)
+        '''
+        results = []
+        for cell, params in self.db.execute("SELECT cell, params FROM cells WHERE cell NOT IN (SELECT cell FROM chunks WHERE status != 'done') "
+                                            "ORDER BY cell").fetchall():
+            ballots, success = [], []
+            for (result,) in self.db.execute('SELECT result FROM chunks WHERE cell = ? ORDER BY position', (cell,)):
+                result = json.loads(result)
+                ballots += result['ballots']
+                success += result['success']
+            results.append((json.loads(params), ballots, success))
+        return results
+
+
+def runChunk(jsonFile, cell, params, seed, first, trials):
+    '''
+    Summary: Runs one chunk of a cell: comparisonTrial for trials first, first + 1, ..., each on its own stream
+    Returns: {'ballots': ballots compared per trial, 'success': risk limit success per trial}
+    '''
+    ballots, success = [], []
+    for trial in range(first, first + trials):
+        trialBallots, trialSuccess, E1 = Questionable_Simulation.comparisonTrial(jsonFile, rng = rng_streams.childGenerator(seed, cell, trial), **params)
+        del E1
+        ballots.append(int(trialBallots))
+        success.append(int(trialSuccess))
+    return {'ballots': ballots, 'success': success}
+
+def _renewLease(db_file, lease, chunk, worker, stop, lost):
+    #heartbeat thread: renew the lease a few times per lease length; SQLite connections stay in the thread that opened them
+    queue = SweepQueue(db_file, lease)
+    try:
+        while not stop.wait(lease/3):
+            if not queue.renew(chunk, worker):
+                lost.set()
+                return
+    finally:
+        queue.close()
+
+def runWorker(db_file, worker = None, lease = 300.0, maxAttempts = 3, wait = False, poll = 5.0):
+    '''
+    Summary: Claims and runs chunks until the queue has nothing left to claim (or, with wait, until every chunk is done or failed,
+    so chunks whose lease runs out are picked up again)
+    Parameters: queue database, worker name (default host:pid), lease length, claims per chunk, keep polling, seconds between polls
+    Returns: number of chunks this worker completed
+    '''
+    worker = worker or socket.gethostname() + ':' + str(os.getpid())
+    queue = SweepQueue(db_file, lease, maxAttempts)
+    jsonFile = queue.getState('jsonFile')
+    done = 0
+    try:
+        while 1:
+            claimed = queue.claim(worker)
+            if claimed is None:
+                if wait and not queue.finished():
+                    time.sleep(poll)
+                    continue
+                break
+            chunk = claimed[0]
+            stop, lost = threading.Event(), threading.Event()
+            heartbeat = threading.Thread(target = _renewLease, args = (db_file, lease, chunk, worker, stop, lost), daemon = True)
+            heartbeat.start()
+            try:
+                result = runChunk(jsonFile, *claimed[1:])
+            except Exception:
+                stop.set()
+                heartbeat.join()
+                queue.fail(chunk, worker, traceback.format_exc())
+                continue
+            stop.set()
+            heartbeat.join()
+            if queue.complete(chunk, result):
+                done += 1
+    finally:
+        queue.close()
+    return done
+
+def runLocalWorkers(db_file, workers = None, lease = 300.0, maxAttempts = 3):
+    '''
+    Summary: Runs workers in local processes until every chunk is done or failed
+    Returns: queue status
+    '''
+    workers = workers or os.cpu_count() or 1
+    processes = [multiprocessing.Process(target = runWorker, args = (db_file, None, lease, maxAttempts, True)) for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    queue = SweepQueue(db_file, lease, maxAttempts)
+    try:
+        return queue.status()
+    finally:
+        queue.close()
+
+def sweepSummary(db_file, csv_file = None):
+    '''
+    Summary: Mean, stdev, median and 95th percentile of the ballots compared, and the risk limit success, of every finished cell
+    (the figures Questionable_Simulation.tests prints), optionally written to a CSV file
+    Returns: rows, header first
+    '''
+    queue = SweepQueue(db_file)
+    try:
+        results = queue.cellResults()
+    finally:
+        queue.close()
+    rows = [['Margin', 'q_CVR_Rate', 'q_auditor_rate', 'QMath', 'Trials', 'Mean', 'Stdev', 'Median', '95%', 'Risk Limit Success']]
+    for params, ballots, success in results:
+        ballots = np.sort(np.array(ballots))
+        rows.append([params['margin'], params['qAsMark'], params['qAuditor'], params['questionableMath'], len(ballots), np.mean(ballots),
+                     np.std(ballots), np.median(ballots), ballots[min(round(len(ballots) * .95), len(ballots) - 1)],
+                     round(np.mean(success), 2)])
+    if csv_file is not None:
+        with open(csv_file, mode = 'w', newline = '') as writeSummary:
+            csv.writer(writeSummary).writerows(rows)
+    return rows
+
+def runSweep(cells, jsonFile, db_file = 'sweepQueue.db', workers = None, trialsPerChunk = 100, seed = None, lease = 300.0, csv_file = None):
+    '''
+    Summary: Coordinator on one machine: enqueues the cells, runs local workers (workers on other hosts can join through the same
+    database file) and summarizes the finished cells
+    Returns: summary rows
+    '''
+    queue = SweepQueue(db_file, lease)
+    try:
+        queue.enqueue(cells, jsonFile, trialsPerChunk, seed)
+    finally:
+        queue.close()
+    status = runLocalWorkers(db_file, workers, lease)
+    print(str(status['done']) + ' chunks done, ' + str(status['failed']) + ' failed, ' + str(status['trialsDone']) + ' of ' +
+          str(status['trials']) + ' trials.')
+    return sweepSummary(db_file, csv_file)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run or inspect a Questionable_Simulation sweep queued in a SQLite file.')
+    parser.add_argument('command', choices = ['worker', 'status', 'summary'])
+    parser.add_argument('db_file', help = 'queue database')
+    parser.add_argument('csv_file', nargs = '?', help = 'summary: CSV file to write')
+    parser.add_argument('--lease', type = float, default = 300.0, help = 'worker: lease length in seconds')
+    parser.add_argument('--wait', action = 'store_true', help = 'worker: keep polling until every chunk is done or failed')
+    args = parser.parse_args()
+    if args.command == 'worker':
+        print(str(runWorker(args.db_file, lease = args.lease, wait = args.wait)) + ' chunks done.')
+    elif args.command == 'status':
+        queue = SweepQueue(args.db_file)
+        print(json.dumps(queue.status()))
+        queue.close()
+    else:
+        for row in sweepSummary(args.db_file, args.csv_file):
+            print(', '.join(str(value) for value in row))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import copy
+import numpy as np
+from math import erf, log, sqrt
+from fast_comparison import *
+from rng_streams import childGenerator
+
+#Importance sampling for the tail of comparison audit sample sizes. Plain Monte Carlo needs about 100/p trials to see an event
+#of probability p a hundred times; here the audits are run with the per-draw discrepancy distribution exponentially tilted
+#towards the draws that push observedrisk up, q(value) = p(value) exp(theta step(value) - psi(theta)), psi(theta) the log of
+#E_p[exp(theta step)], so long audits are common, and every audit is weighted by its likelihood ratio
+#p/q = exp(n psi(theta) - theta log(observedrisk at the end)), n the ballots it drew. Weighted means of indicators estimate
+#the exceedance probabilities under the real distribution without bias, and their standard errors give the intervals.
+
+
+def normalQuantile(p):
+    '''
+    Returns: x with P(Z <= x) = p for a standard normal Z
+    '''
+    low, high = -40.0, 40.0
+    for _ in range(200):
+        middle = (low + high)/2
+        if 0.5*(1 + erf(middle/sqrt(2))) < p:
+            low = middle
+        else:
+            high = middle
+    return (low + high)/2
+
+def logMoment(distribution, theta):
+    '''
+    Returns: psi(theta) = log E[exp(theta step)] for one draw of a ComparisonDistribution
+    '''
+    exponents = theta*distribution.steps + np.log(distribution.probabilities)
+    top = exponents.max()
+    return top + log(np.exp(exponents - top).sum())
+
+def tiltedDistribution(distribution, theta):
+    '''
+    Summary: The distribution tilted by theta (theta > 0 makes overstatements, and so long audits, more likely)
+    Returns: copy of the ComparisonDistribution with the tilted probabilities and alias table, and theta and psi(theta)
+    '''
+    tilted = copy.copy(distribution)
+    tilted.theta = theta
+    tilted.logMoment = logMoment(distribution, theta)
+    tilted.probabilities = np.exp(theta*distribution.steps + np.log(distribution.probabilities) - tilted.logMoment)
+    tilted.table = AliasTable(tilted.probabilities)
+    tilted.cumulative = np.cumsum(tilted.probabilities)
+    return tilted
+
+def tiltFor(distribution, ballots):
+    '''
+    Summary: Tilt under which the mean log(observedrisk) step is log(riskLimit)/ballots, so a tilted audit takes about ballots
+    draws; 0 when untilted audits already take that long
+    Returns: theta
+    '''
+    drift = log(distribution.riskLimit)/ballots
+    def tiltedDrift(theta):
+        weights = np.exp(theta*distribution.steps + np.log(distribution.probabilities) - logMoment(distribution, theta))
+        return float((weights*distribution.steps).sum())
+    if tiltedDrift(0.0) >= drift:
+        return 0.0
+    high = 1.0
+    while tiltedDrift(high) < drift and high < 1e4:
+        high *= 2
+    low = 0.0
+    for _ in range(100):
+        middle = (low + high)/2
+        if tiltedDrift(middle) < drift:
+            low = middle
+        else:
+            high = middle
+    return high
+
+def weightedTail(ballots, weights):
+    '''
+    Summary: Importance sampling estimates of P(ballots > t) at every distinct sample size t
+    Returns: sample sizes (sorted), estimates, standard errors
+    '''
+    order = np.argsort(ballots, kind = 'stable')
+    ballots, weights = ballots[order], weights[order]
+    total = len(ballots)
+    #sums of the weights (and squared weights) of the audits from each position on
+    above = np.concatenate((np.cumsum(weights[::-1])[::-1], [0.0]))
+    aboveSquares = np.concatenate((np.cumsum((weights**2)[::-1])[::-1], [0.0]))
+    sizes = np.unique(ballots)
+    first = np.searchsorted(ballots, sizes, side = 'right')
+    estimates = above[first]/total
+    errors = np.sqrt(np.maximum(aboveSquares[first]/total - estimates**2, 0.0)/max(total - 1, 1))
+    return sizes, estimates, errors
+
+def tailEstimates(distribution, num, rng, quantiles = (0.99, 0.999), thresholds = (), target = None, theta = None, pilot = 2000,
+                  confidence = 0.95, maxBallots = None):
+    '''
+    Summary: Importance sampling estimates of the tail of the sample size of incremental comparison audits
+    The tilt is theta if given, else the one that centres the tilted audits on target ballots; without a target, on the largest
+    threshold, or on 1.25 times the 99th percentile of a plain pilot run of pilot audits.
+    Parameters: ComparisonDistribution, number of tilted audits, numpy Generator, quantiles to estimate, sample sizes to estimate
+    P(ballots > threshold) for, target sample size, tilt, pilot audits, confidence level of the intervals, maximum draws
+    Returns: dict: 'theta', 'trials', 'effectiveTrials' (Kish effective sample size of the weights), 'mean' (estimated mean sample
+    size), 'quantiles' {quantile: [estimate, low, high]}, 'exceedance' {threshold: [estimate, low, high, standard error]},
+    'fullHandCount' [estimate, low, high, standard error] of the chance of reaching maxBallots without meeting the risk limit
+    '''
+    maxBallots = distribution.numBallots if maxBallots is None else maxBallots
+    if theta is None:
+        if target is None and thresholds:
+            target = max(thresholds)
+        if target is None:
+            pilotBallots = comparisonAudits(distribution, pilot, rng, maxBallots)[0]
+            target = 1.25*np.quantile(pilotBallots, 0.99)
+        theta = tiltFor(distribution, min(target, maxBallots))
+    tilted = tiltedDistribution(distribution, theta)
+    ballots, success, finalRisk = comparisonAudits(tilted, num, rng, maxBallots, logRisks = True)
+    weights = np.exp(ballots*tilted.logMoment - theta*finalRisk)
+    z = normalQuantile(1 - (1 - confidence)/2)
+
+    def interval(indicator):
+        values = weights*indicator
+        estimate = values.mean()
+        error = values.std(ddof = 1)/sqrt(num) if num > 1 else float('nan')
+        return [float(estimate), float(max(estimate - z*error, 0.0)), float(min(estimate + z*error, 1.0)), float(error)]
+
+    sizes, estimates, errors = weightedTail(ballots, weights)
+    results = {'theta': theta, 'trials': num, 'effectiveTrials': float(weights.sum()**2/(weights**2).sum()),
+               'mean': float((weights*ballots).mean()), 'quantiles': {}, 'exceedance': {},
+               'fullHandCount': interval(success == 0)}
+    for quantile in quantiles:
+        #smallest sample size whose exceedance estimate (or its upper / lower bound) is at most 1 - quantile
+        bounds = []
+        for tail in (estimates, estimates - z*errors, estimates + z*errors):
+            within = np.flatnonzero(tail <= 1 - quantile)
+            bounds.append(int(sizes[within[0]]) if len(within) else maxBallots)
+        results['quantiles'][quantile] = bounds
+    for threshold in thresholds:
+        results['exceedance'][threshold] = interval(ballots > threshold)
+    return results
+
+def questionableTails(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, num, gamma, margin,
+                      questionableMath = 0, qAsMark = 1, qAuditor = 0, quantiles = (0.99, 0.999), thresholds = (), seed = None, **options):
+    '''
+    Summary: tailEstimates for a Questionable_Simulation cell (the parameters of its collectData), drawing from
+    childGenerator(seed) (see rng_streams)
+    Returns: tailEstimates dict
+    '''
+    distribution = ComparisonDistribution(numBallots, overvotes1, undervotes1, overvotes2, undervotes2, questionable, riskLimit, gamma,
+                                          margin, questionableMath, qAsMark, qAuditor)
+    rng = childGenerator(seed)
+    return tailEstimates(distribution, num, rng, quantiles, thresholds, **options)
@@ -0,0 +1,119 @@
+import numpy as np
+from math import sqrt
+from fast_comparison import *
+from comparison_traces import comparisonDiscrepancies
+
+#Variance reduction for mean comparison audit sample sizes.
+#Control variates: an audit draws N ballots, each with discrepancy value v with known probability p_v (overvotes1/numBallots,
+#..., and the questionable outcomes). N is a stopping time, so by Wald's identity the count of draws with value v minus p_v N has
+#mean 0, and these controls move with N: audits that stop late are the ones that met more overstatements than expected. The
+#mean of N minus its regression on the controls estimates E[N] with much less variance. The controls work for the
+#ballot-by-ballot audits of collectData (counted from each election's draws) as well as the vectorized engine, where the
+#Wald control log(observedrisk at the end) - N E[step] is used; it is the combination of the counts the log risk adds up.
+#Antithetic pairs (comparisonAudits(antithetic = True)) mirror the uniforms of one audit in the other; the sample size is
+#monotone in the uniforms, so the two are negatively correlated and their average varies less than two independent audits.
+#The _comparisonSample prediction is the same for every trial of a cell (the discrepancy counts are fixed), so it cannot
+#serve as a covariate here.
+
+
+class ControlVariates(object):
+    '''
+    Summary: Running control variate estimate of a mean: keeps only sums (of the values, controls and their products), so it
+    can take any number of trials in constant memory
+    Parameters: number of controls
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.trials = 0
+        self.sums = np.zeros(size + 1) #value, controls
+        self.products = np.zeros((size + 1, size + 1))
+
+    def add(self, value, controls):
+        '''
+        Summary: Adds one trial: its value and its controls (each with known mean 0)
+        '''
+        row = np.concatenate(([value], controls))
+        self.trials += 1
+        self.sums += row
+        self.products += np.outer(row, row)
+
+    def addMany(self, values, controls):
+        '''
+        Summary: Adds trials: array of values, array of controls with one row per trial
+        '''
+        rows = np.column_stack((np.asarray(values, dtype = np.float64), np.asarray(controls, dtype = np.float64).reshape(len(values), self.size)))
+        self.trials += len(rows)
+        self.sums += rows.sum(axis = 0)
+        self.products += rows.T @ rows
+
+    def estimate(self):
+        '''
+        Returns: dict: 'mean' and 'standardError' adjusted by the controls, 'plainMean' and 'plainStandardError' without them,
+        'varianceRatio' (plain over adjusted variance, about the factor fewer trials needed), 'beta' (regression coefficients), 'trials'
+        '''
+        n = self.trials
+        mean = self.sums/n
+        covariance = (self.products - n*np.outer(mean, mean))/max(n - 1, 1)
+        plainVariance = covariance[0, 0]
+        #regression of the value on the controls; pinv copes with controls that never varied
+        beta = np.linalg.pinv(covariance[1:, 1:]) @ covariance[1:, 0]
+        residualVariance = max(plainVariance - covariance[0, 1:] @ beta, 0.0)*(n - 1)/max(n - 1 - self.size, 1)
+        return {'mean': float(mean[0] - beta @ mean[1:]), 'standardError': sqrt(residualVariance/n),
+                'plainMean': float(mean[0]), 'plainStandardError': sqrt(plainVariance/n),
+                'varianceRatio': float(plainVariance/residualVariance) if residualVariance > 0 else float('inf'),
+                'beta': beta.tolist(), 'trials': n}
+
+
+class ElectionControls(object):
+    '''
+    Summary: Control variate estimate of the mean sample size of a collectData cell from its elections: the controls of a trial
+    are its count of draws of each non-zero discrepancy value minus the count expected for its number of draws
+    Parameters: the first Election of the cell (its discrepancy counts and questionable settings are the cell's)
+    '''
+    def __init__(self, E1):
+        values, probabilities = discrepancyDistribution(E1.numBallots, E1.overvotes1, E1.undervotes1, E1.overvotes2, E1.undervotes2,
+                                                        getattr(E1, 'questionable', 0), getattr(E1, 'questionableMath', 0),
+                                                        getattr(E1, 'qAsMark', 1), getattr(E1, 'qAuditorRate', 0))
+        nonZero = values != 0
+        self.values = values[nonZero].tolist()
+        self.probabilities = probabilities[nonZero]
+        self.position = {value: index for index, value in enumerate(self.values)}
+        self.controls = ControlVariates(len(self.values))
+
+    def add(self, E1, ballots):
+        '''
+        Summary: Adds the trial E1 ran (after its comparison audit)
+        '''
+        counts = np.zeros(len(self.values))
+        for discrepancy in comparisonDiscrepancies(E1):
+            if discrepancy != 0:
+                counts[self.position[discrepancy]] += 1
+        self.controls.add(ballots, counts - self.probabilities*ballots)
+
+    def estimate(self):
+        return self.controls.estimate()
+
+
+def antitheticMean(ballots):
+    '''
+    Summary: Mean of antithetic pairs (audits 2j and 2j + 1) and its standard error from the spread of the pair averages
+    Returns: mean, standard error
+    '''
+    pairs = (np.asarray(ballots[0::2], dtype = np.float64) + ballots[1::2])/2
+    return float(pairs.mean()), float(pairs.std(ddof = 1)/sqrt(len(pairs)))
+
+def comparisonMeans(distribution, num, rng, maxBallots = None):
+    '''
+    Summary: Mean sample size of incremental comparison audits from the vectorized engine, plain and with each variance reduction:
+    num independent audits (with the Wald control variate), and num audits in antithetic pairs
+    Parameters: ComparisonDistribution, number of audits of each kind (even), numpy Generator, maximum draws
+    Returns: dict: 'plain' [mean, standard error], 'controlVariate' [mean, standard error], 'antithetic' [mean, standard error]
+    '''
+    ballots, success, finalRisk = comparisonAudits(distribution, num, rng, maxBallots, logRisks = True)
+    drift = float((distribution.probabilities*distribution.steps).sum())
+    controls = ControlVariates(1)
+    controls.addMany(ballots, finalRisk - drift*ballots)
+    estimate = controls.estimate()
+    return {'plain': [estimate['plainMean'], estimate['plainStandardError']],
+            'controlVariate': [estimate['mean'], estimate['standardError']],
+            'antithetic': list(antitheticMean(comparisonAudits(distribution, num, rng, maxBallots, antithetic = True)[0]))}